@@ -0,0 +1,1235 @@
+"""
+Multi-resolution two dimensional density maps.
+
+A density map is a `Tree` of bin contingencies over two continuous
+columns (optionally split by the values of a discrete column). Cells
+of interest can be refined into sub-grids on demand (see `sharpen_region`
+and `sharpen_region_recur`) and any level of the tree can be rendered
+into an image array (see `Tree_raster` and `create_image`).
+
+The module does not depend on Qt; rectangles are passed as
+`(x, y, width, height)` tuples (a `QRectF` is also accepted).
+
+Example
+-------
+
+>>> data = Orange.data.Table("iris")
+>>> dmap = DensityMap.from_table(data, "petal length", "petal width",
+...                              "iris", nbins=8)
+>>> root = dmap.refine(depth=2)
+>>> dmap.image().shape
+(64, 64, 3)
+
+"""
+import os
+import pickle
+import hashlib
+import colorsys
+import concurrent.futures
+
+from functools import reduce
+from collections import namedtuple, OrderedDict
+
+import numpy as np
+
+import Orange.data
+from Orange.statistics import contingency
+from Orange.preprocess.discretize import Discretizer
+
+
+__all__ = ["Tree", "DensityMap", "density_image", "SpatialIndex",
+           "TreeCache", "grid_bin", "grid_bin_indexed", "grid_bin_sql",
+           "sharpen_region", "sharpen_region_recur", "resample",
+           "Tree_raster", "create_image", "color_scale_func"]
+
+#: Color scales (linear, square root and logarithmic)
+Linear, Sqrt, Log = 1, 2, 3
+
+
+def is_not_none(obj):
+    return obj is not None
+
+
+Tree = namedtuple(
+    "Tree",
+    ["xbins",          # bin edges on the first axis
+     "ybins",          # bin edges on the second axis
+     "contingencies",  # x/y contingency table/s
+     "children",       # an (nbins, nbins) array of sub trees or None (if leaf)
+     ]
+)
+
+
+class Tree(Tree):
+    @property
+    def is_leaf(self):
+        """Is this node a leaf."""
+        return self.children is None
+
+    @property
+    def is_empty(self):
+        """Is this node empty, i.e. is it's contingency matrix empty."""
+        return not np.any(self.contingencies)
+
+    @property
+    def brect(self):
+        """The bounding rect `(x, y, width, height)` tuple of the node's bins.
+        """
+        return (self.xbins[0], self.ybins[0],
+                self.xbins[-1] - self.xbins[0],
+                self.ybins[-1] - self.ybins[0])
+
+    @property
+    def nbins(self):
+        """Number of bins."""
+        return self.xbins.size - 1
+
+    def depth(self):
+        """Return the tree depth."""
+        return (1 if self.is_leaf
+                  else max(ch.depth() + 1
+                           for ch in filter(is_not_none, self.children.flat)))
+
+
+def max_contingency(node):
+    """Return the maximum contingency value from node."""
+    if node.is_leaf:
+        return node.contingencies.max()
+    else:
+        valid = np.nonzero(node.children)
+        children = node.children[valid]
+        mask = np.ones_like(node.children, dtype=bool)
+        mask[valid] = False
+        ctng = node.contingencies[mask]
+        v = 0.0
+        if len(children):
+            v = max(max_contingency(ch) for ch in children)
+        if len(ctng):
+            v = max(ctng.max(), v)
+        return v
+
+
+def blockshaped(arr, rows, cols):
+    """
+    Return an array of (rows, cols) `arr` sub blocks.
+
+    E.g. given an (N, M) array return a (N//rows, M//cols, rows, cols)
+    array A, such that A[0, 0] contains the upper left sub-block of `arr`
+    (`arr[0:rows, 0:cols]`), A[0, 1] the sub-block left to it
+    (arr[0: rows, rows: 2 * rows]), ...
+
+    Example
+    -------
+
+    >>> A = numpy.array(
+    ...     [[1, 2, 3,  4,  5,  6],
+    ...      [7, 8, 9, 10, 11, 12]]
+    ... )
+
+    >>> blockshaped(A, 2, 3)
+    array([[[[ 1,  2,  3],
+             [ 7,  8,  9]],
+            [[ 4,  5,  6],
+             [10, 11, 12]]]])
+
+    >>> blockshaped(A, 1, 2)
+    array([[[[ 1,  2]],
+            [[ 3,  4]],
+            [[ 5,  6]]],
+           [[[ 7,  8]],
+            [[ 9, 10]],
+            [[11, 12]]]])
+
+    """
+    N, M = arr.shape[:2]
+    rest = arr.shape[2:]
+    assert N % rows == 0
+    assert M % cols == 0
+    return (arr.reshape((N // rows, rows, -1, cols) + rest)
+               .swapaxes(1, 2)
+               .reshape((N // rows, M // cols, rows, cols) + rest))
+
+
+def max_contingency_resampled(node, samplewidth):
+    """
+    Return the maximum contingency value of `resample(node, samplewidth)`.
+    """
+    if samplewidth >= 1:
+        return max_contingency(resample(node, samplewidth))
+    elif node.is_leaf:
+        return node.contingencies.max()
+    else:
+        mask = np.equal(node.children, None)
+        ctng = node.contingencies[mask]
+        v = ctng.max() if ctng.size else 0.0
+        children = filter(is_not_none, node.children.flat)
+        return max([v] + [max_contingency_resampled(ch, samplewidth * node.nbins)
+                          for ch in children])
+
+
+def gaussian_smooth(contingencies, sigma):
+    """
+    Smooth the contingencies with a Gaussian kernel of width `sigma` (in
+    bins) using FFT convolution.
+
+    Each class channel (the last axis of a 3 dimensional contingency) is
+    smoothed separately. The contingencies are zero padded (i.e. the
+    density outside is assumed to be 0).
+
+    :param contingencies: An (N, M) or (N, M, n_classes) array.
+    :param sigma: Kernel standard deviation in bins.
+    :rtype: np.ndarray
+    """
+    if sigma <= 0:
+        return contingencies
+    radius = int(np.ceil(3 * sigma))
+    x = np.arange(-radius, radius + 1)
+    kernel = np.exp(-0.5 * (x / sigma) ** 2)
+    kernel = np.outer(kernel, kernel) / kernel.sum() ** 2
+
+    N, M = contingencies.shape[:2]
+    # Pad to the full linear convolution size to avoid wrapping around
+    shape = (N + 2 * radius, M + 2 * radius)
+    fc = np.fft.rfft2(contingencies, s=shape, axes=(0, 1))
+    fk = np.fft.rfft2(kernel, s=shape)
+    if contingencies.ndim == 3:
+        fk = fk[:, :, np.newaxis]
+    smoothed = np.fft.irfft2(fc * fk, s=shape, axes=(0, 1))
+    smoothed = smoothed[radius: radius + N, radius: radius + M]
+    # Remove the round off noise so empty regions stay empty
+    eps = 1e-9 * max(contingencies.max(), 1)
+    return np.where(smoothed > eps, smoothed, 0.0)
+
+
+def resample(node, samplewidth):
+    """
+    Resample/aggregate the node's contingency, joining `samplewidth` bins.
+
+    `samplewidth` is the number of bins which should be joined and MUST
+    be a power of 2.
+
+    If `samplewidth` == 1 then return the node as is. If larger then
+    1 then sum `samplewidth` neighboring contingency cells returning a
+    new node with shape ``(nbins//samplewidth, nbins//samplewidth)``.
+    If smaller then 1 (i.e. undersampled) recurse into node's
+    subcontingencies with a samplewidth * nbins
+
+    """
+    assert 0 < samplewidth <= node.nbins
+    assert int(np.log2(samplewidth)) == np.log2(samplewidth)
+
+    if samplewidth == 1:
+        return node._replace(children=None)
+    elif samplewidth > 1:
+        samplewidth = int(samplewidth)
+        ctng = blockshaped(node.contingencies, samplewidth, samplewidth)
+        ctng = ctng.sum(axis=(2, 3))
+        assert ctng.shape[0] == node.nbins // samplewidth
+        return Tree(node.xbins[::samplewidth],
+                    node.ybins[::samplewidth],
+                    ctng,
+                    None)
+    elif node.is_leaf:
+        return Tree(*node)
+    else:
+        nbins = node.nbins
+        children = [resample(ch, samplewidth * nbins)
+                    if ch is not None else None
+                    for ch in node.children.flat]
+
+        children_ar = np.full(nbins ** 2, None, dtype=object)
+        children_ar[:] = children
+        return node._replace(children=children_ar.reshape((-1, nbins)))
+
+
+def Tree_nbytes(node):
+    """Return the (approximate) memory used by the tree `node` in bytes."""
+    nbytes = (node.xbins.nbytes + node.ybins.nbytes +
+              node.contingencies.nbytes)
+    if not node.is_leaf:
+        nbytes += node.children.nbytes
+        nbytes += sum(Tree_nbytes(ch)
+                      for ch in filter(is_not_none, node.children.flat))
+    return nbytes
+
+
+def columns_digest(data, variables):
+    """
+    Return a SHA-1 digest of the number of rows and the values of
+    `variables` in `data` (for keys of persisted trees).
+    """
+    sha = hashlib.sha1(str(len(data)).encode("utf-8"))
+    for var in variables:
+        column = data.get_column_view(var)[0]
+        sha.update(var.name.encode("utf-8"))
+        sha.update(np.ascontiguousarray(column, dtype=float).tobytes())
+    return sha.hexdigest()
+
+
+class TreeCache:
+    """
+    A memory bounded LRU cache of density `Tree` roots, backed by a disk
+    store.
+
+    Keys are tuples whose first element is a digest of the data (see
+    `columns_digest`). Entries
+    with a `None` digest are only kept in memory. The least recently
+    used trees are evicted from memory when their total size exceeds
+    `max_memory` and the least recently used files are removed from the
+    disk store when it exceeds `max_disk`.
+
+    :param max_memory: Memory budget in bytes.
+    :param max_disk: Disk budget in bytes.
+    :param directory: The disk store directory (None disables the store).
+    """
+    def __init__(self, max_memory=256 * 2 ** 20, max_disk=1024 * 2 ** 20,
+                 directory=None):
+        self.max_memory = max_memory
+        self.max_disk = max_disk
+        self.directory = directory
+        self._trees = OrderedDict()
+        self._nbytes = OrderedDict()
+
+    def __contains__(self, key):
+        filename = self._filename(key)
+        return key in self._trees or \
+            filename is not None and os.path.exists(filename)
+
+    def get(self, key, default=None):
+        """Return the tree for `key` from memory or the disk store."""
+        if key in self._trees:
+            self._trees.move_to_end(key)
+            self._nbytes.move_to_end(key)
+            return self._trees[key]
+        filename = self._filename(key)
+        if filename is None or not os.path.exists(filename):
+            return default
+        try:
+            with open(filename, "rb") as f:
+                stored_key, tree = pickle.load(f)
+            os.utime(filename)
+        except Exception:  # pylint: disable=broad-except
+            return default
+        if stored_key != key:
+            return default
+        self._insert(key, tree)
+        return tree
+
+    def put(self, key, tree, persist=True):
+        """
+        Store the `tree` for `key`.
+
+        If `persist` is `True` also write it to the disk store.
+        """
+        self._insert(key, tree)
+        if persist:
+            self.persist(key)
+
+    def persist(self, key):
+        """Write the (in memory) tree for `key` to the disk store."""
+        filename = self._filename(key)
+        if filename is None or key not in self._trees:
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(filename + ".tmp", "wb") as f:
+                pickle.dump((key, self._trees[key]), f,
+                            protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(filename + ".tmp", filename)
+        except OSError:
+            return
+        self._prune_disk()
+
+    def clear(self):
+        """Clear the memory cache (the disk store is retained)."""
+        self._trees.clear()
+        self._nbytes.clear()
+
+    def _insert(self, key, tree):
+        self._trees[key] = tree
+        self._trees.move_to_end(key)
+        self._nbytes[key] = Tree_nbytes(tree)
+        self._nbytes.move_to_end(key)
+        # Evict the least recently used trees, but always keep the last one
+        while len(self._trees) > 1 and \
+                sum(self._nbytes.values()) > self.max_memory:
+            self._trees.popitem(last=False)
+            self._nbytes.popitem(last=False)
+
+    def _filename(self, key):
+        if self.directory is None or key[0] is None:
+            return None
+        digest = hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, digest + ".pickle")
+
+    def _prune_disk(self):
+        try:
+            entries = [(entry.stat(), entry.path)
+                       for entry in os.scandir(self.directory)
+                       if entry.name.endswith(".pickle")]
+        except OSError:
+            return
+        entries = sorted(entries, key=lambda e: e[0].st_mtime)
+        total = sum(stat.st_size for stat, _ in entries)
+        # Never remove the most recently used (just written) tree
+        for stat, path in entries[:-1]:
+            if total <= self.max_disk:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= stat.st_size
+
+
+class SpatialIndex:
+    """
+    A static k-d tree of row indices over two continuous columns.
+
+    The rows with defined x and y are reordered so that every tree node
+    covers a contiguous range of positions; rectangle queries can then
+    return whole node ranges and only filter the points in the leaves
+    crossing the query boundary. The cost of a query therefore scales
+    with the number of points in the rectangle, not the dataset size.
+
+    :param x: The x coordinates.
+    :type x: np.ndarray
+    :param y: The y coordinates.
+    :type y: np.ndarray
+    :param leaf_size: Maximum number of points in a leaf node.
+    :type leaf_size: int
+    """
+    def __init__(self, x, y, leaf_size=256):
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        order = np.flatnonzero(np.isfinite(x) & np.isfinite(y))
+        x, y = x[order], y[order]
+
+        # node ranges, bounding boxes and children (-1 for leaves)
+        ranges, bboxes, children = [], [], []
+        stack = [(0, order.size, -1, 0)]
+        while stack:
+            start, stop, parent, side = stack.pop()
+            node = len(ranges)
+            if parent >= 0:
+                children[parent][side] = node
+            xs, ys = x[start:stop], y[start:stop]
+            if stop > start:
+                bbox = (xs.min(), xs.max(), ys.min(), ys.max())
+            else:
+                bbox = (np.inf, -np.inf, np.inf, -np.inf)
+            ranges.append((start, stop))
+            bboxes.append(bbox)
+            children.append([-1, -1])
+            if stop - start > leaf_size:
+                # split on the wider axis at the median
+                axis = xs if bbox[1] - bbox[0] >= bbox[3] - bbox[2] else ys
+                mid = (stop - start) // 2
+                perm = np.argpartition(axis, mid)
+                x[start:stop] = xs[perm]
+                y[start:stop] = ys[perm]
+                order[start:stop] = order[start:stop][perm]
+                stack.append((start + mid, stop, node, 1))
+                stack.append((start, start + mid, node, 0))
+
+        self.x, self.y = x, y
+        #: Table row indices in the index (k-d tree) order
+        self.order = order
+        self._ranges = np.array(ranges, dtype=np.intp).reshape(-1, 2)
+        self._bboxes = np.array(bboxes, dtype=float).reshape(-1, 4)
+        self._children = np.array(children, dtype=np.intp).reshape(-1, 2)
+
+    def __len__(self):
+        return self.order.size
+
+    def query(self, xmin, xmax, ymin, ymax):
+        """
+        Return the positions (in index order) of all points in a rectangle.
+
+        The rectangle is closed (bounds are inclusive). Use `order` to map
+        the returned positions to table rows.
+
+        :rtype: np.ndarray
+        """
+        parts = []
+        stack = [0] if len(self) else []
+        ranges, bboxes, children = self._ranges, self._bboxes, self._children
+        while stack:
+            node = stack.pop()
+            bx0, bx1, by0, by1 = bboxes[node]
+            if bx0 > xmax or bx1 < xmin or by0 > ymax or by1 < ymin:
+                continue
+            start, stop = ranges[node]
+            if xmin <= bx0 and bx1 <= xmax and ymin <= by0 and by1 <= ymax:
+                parts.append(np.arange(start, stop))
+            elif children[node, 0] < 0:
+                xs, ys = self.x[start:stop], self.y[start:stop]
+                mask = (xmin <= xs) & (xs <= xmax) & (ymin <= ys) & (ys <= ymax)
+                parts.append(start + np.flatnonzero(mask))
+            else:
+                stack.extend(children[node])
+        if not parts:
+            return np.array([], dtype=np.intp)
+        return np.concatenate(parts)
+
+
+def grid_bin_indexed(index, xbins, ybins, zcol=None, nvalues=0):
+    """
+    Compute the `Tree` leaf node for the grid `xbins` x `ybins` using a
+    `SpatialIndex`.
+
+    This is equivalent to `grid_bin`, but only touches the points inside
+    the grid.
+
+    :param index: Spatial index over the x and y columns.
+    :type index: SpatialIndex
+    :param zcol: The (discrete) color column in table order, or None.
+    :param nvalues: The number of distinct values in `zcol`.
+    :rtype: Tree
+    """
+    pos = index.query(xbins[0], xbins[-1], ybins[0], ybins[-1])
+    nx, ny = xbins.size - 1, ybins.size - 1
+    xi = np.searchsorted(xbins[1:-1], index.x[pos], side="right")
+    yi = np.searchsorted(ybins[1:-1], index.y[pos], side="right")
+    cell = xi * ny + yi
+    if zcol is not None:
+        z = zcol[index.order[pos]]
+        defined = ~np.isnan(z)
+        cell = cell[defined] * nvalues + z[defined].astype(np.intp)
+        counts = np.bincount(cell, minlength=nx * ny * nvalues)
+        contingencies = counts.reshape((nx, ny, nvalues))
+    else:
+        counts = np.bincount(cell, minlength=nx * ny)
+        contingencies = counts.reshape((nx, ny))
+    return Tree(xbins, ybins, contingencies.astype(float), None)
+
+
+def grid_bin(data, xvar, yvar, xbins, ybins, zvar=None):
+    x_disc = Discretizer.create_discretized_var(xvar, xbins[1:-1])
+    y_disc = Discretizer.create_discretized_var(yvar, ybins[1:-1])
+
+    x_min, x_max = xbins[0], xbins[-1]
+    y_min, y_max = ybins[0], ybins[-1]
+
+    querydomain = [x_disc, y_disc]
+    if zvar is not None:
+        querydomain = querydomain + [zvar]
+
+    querydomain = Orange.data.Domain(querydomain)
+
+    def interval_filter(var, low, high):
+        return Orange.data.filter.Values(
+            [Orange.data.filter.FilterContinuous(
+                 var, max=high, min=low,
+                 oper=Orange.data.filter.FilterContinuous.Between)]
+        )
+
+    def value_filter(var, val):
+        return Orange.data.filter.Values(
+            [Orange.data.filter.FilterDiscrete(var, [val])]
+        )
+
+    def filters_join(filters):
+        return Orange.data.filter.Values(
+            reduce(list.__iadd__, (f.conditions for f in filters), [])
+        )
+
+    inf_bounds = np.isinf([x_min, x_max, y_min, y_max])
+    if not all(inf_bounds):
+        # No need to filter the data
+        range_filters = [interval_filter(xvar, x_min, x_max),
+                         interval_filter(yvar, y_min, y_max)]
+        range_filter = filters_join(range_filters)
+        subset = range_filter(data)
+    else:
+        subset = data
+
+    if zvar and zvar.is_discrete:
+        filters = [value_filter(zvar, val) for val in zvar.values]
+        contingencies = [
+            contingency.get_contingency(
+                filter_(subset.from_table(querydomain, subset)),
+                col_variable=y_disc, row_variable=x_disc
+            )
+            for filter_ in filters
+        ]
+        contingencies = np.dstack(contingencies)
+    else:
+        contingencies = contingency.get_contingency(
+            subset.from_table(querydomain, subset),
+            col_variable=y_disc, row_variable=x_disc
+        )
+
+    contingencies = np.asarray(contingencies)
+    return Tree(xbins, ybins, contingencies, None)
+
+
+def grid_bin_sql(data, xvar, yvar, xbins, ybins, zvar=None):
+    """
+    Compute the `Tree` leaf node for the grid `xbins` x `ybins` of a
+    `SqlTable` in the database.
+
+    This is equivalent to `grid_bin` but only the bin counts are
+    transferred; the rows are counted in a single
+    `GROUP BY width_bucket(x), width_bucket(y)[, z]` query.
+
+    .. note:: Requires a PostgreSQL backend (`width_bucket` with an array
+        of thresholds).
+
+    :type data: SqlTable
+    :rtype: Tree
+    """
+    def sql_float(value):
+        return "'{!r}'::double precision".format(float(value))
+
+    def bucket(var, bins):
+        # width_bucket(operand, thresholds) returns the number of
+        # thresholds less than or equal to operand (like `np.digitize`)
+        thresholds = ", ".join(map(sql_float, bins[1:-1]))
+        return "width_bucket(({})::double precision, " \
+               "ARRAY[{}]::double precision[])".format(var.to_sql(),
+                                                       thresholds)
+
+    def between(var, low, high):
+        field = "({})::double precision".format(var.to_sql())
+        filters = ["{} IS NOT NULL".format(var.to_sql())]
+        if np.isfinite(low):
+            filters.append("{} >= {}".format(field, sql_float(low)))
+        if np.isfinite(high):
+            filters.append("{} <= {}".format(field, sql_float(high)))
+        return filters
+
+    nx, ny = xbins.size - 1, ybins.size - 1
+    fields = [bucket(xvar, xbins), bucket(yvar, ybins)]
+    filters = (between(xvar, xbins[0], xbins[-1]) +
+               between(yvar, ybins[0], ybins[-1]))
+    has_z = zvar is not None and zvar.is_discrete
+    if has_z:
+        fields.append(zvar.to_sql())
+        filters.append("{} IS NOT NULL".format(zvar.to_sql()))
+    query = data._sql_query(fields + ["COUNT(*)"], filters=filters,
+                            group_by=fields)
+
+    with data.backend.execute_sql_query(query) as cur:
+        rows = cur.fetchall()
+
+    if has_z:
+        contingencies = np.zeros((nx, ny, len(zvar.values)))
+        for xi, yi, z, count in rows:
+            contingencies[xi, yi, int(zvar.to_val(z))] += count
+    else:
+        contingencies = np.zeros((nx, ny))
+        if rows:
+            xi, yi, counts = np.array(rows, dtype=float).T
+            contingencies[xi.astype(int), yi.astype(int)] = counts
+    return Tree(xbins, ybins, contingencies, None)
+
+
+def sharpen_node_cell(node, i, j, nbins, gridbin_func):
+    if node.is_leaf:
+        children = np.full((nbins, nbins), None, dtype=object)
+    else:
+        children = np.array(node.children, dtype=None)
+
+    xbins = np.linspace(node.xbins[i], node.xbins[i + 1], nbins + 1)
+    ybins = np.linspace(node.ybins[j], node.ybins[j + 1], nbins + 1)
+
+    if node.contingencies[i, j].any():
+        t = gridbin_func(xbins, ybins)
+        assert t.contingencies.shape[:2] == (nbins, nbins)
+        children[i, j] = t
+        return node._replace(children=children)
+    else:
+        return node
+
+
+def sharpen_region(node, region, nbins, gridbin_func):
+    """
+    Refine the cells of `node` intersecting `region` one at a time and
+    yield the updated node after every cell.
+
+    The cells are refined in order of their `max_chi_squares` score if
+    the node has class contingencies.
+    """
+    if not rect_intersects(node.brect, region):
+        raise ValueError()
+
+    xs, xe, ys, ye = bindices(node, region)
+    ndim = node.contingencies.ndim
+
+    if node.children is not None:
+        children = np.array(node.children, dtype=object)
+        assert children.ndim == 2
+    else:
+        children = np.full((nbins, nbins), None, dtype=object)
+
+    rows, cols = np.nonzero(np.equal(children[xs: xe, ys: ye], None))
+    if ndim == 3:
+        # Highest score first, ties in row major order
+        scores = max_chi_squares(node.contingencies[xs: xe, ys: ye])
+        order = np.lexsort((cols, rows, -scores[rows, cols]))
+        rows, cols = rows[order], cols[order]
+
+    update_node = node
+    for i, j in zip(rows + xs, cols + ys):
+        xbins = np.linspace(node.xbins[i], node.xbins[i + 1], nbins + 1)
+        ybins = np.linspace(node.ybins[j], node.ybins[j + 1], nbins + 1)
+
+        if node.contingencies[i, j].any():
+            t = gridbin_func(xbins, ybins)
+            assert t.contingencies.shape[:2] == (nbins, nbins)
+        else:
+            t = None
+
+        children[i, j] = t
+        if t is None:
+            yield update_node
+        else:
+            update_node = update_node._replace(
+                children=np.array(children, dtype=object)
+            )
+            yield update_node
+
+
+def sharpen_cell_bins(node, region, nbins, depth, gridbin_func,
+                      is_cancelled=lambda: False):
+    """
+    Run `sharpen_region_recur` and return all the nodes it binned.
+
+    The result is a dict mapping `(xbins, ybins)` keys (see `bins_key`)
+    to binned `Tree` nodes which can be merged into a (possibly changed)
+    tree with `lookup_bin_func`. Raise `concurrent.futures.CancelledError`
+    if `is_cancelled` returns `True` before any binning step.
+    """
+    computed = {}
+
+    def bin_func(xbins, ybins):
+        if is_cancelled():
+            raise concurrent.futures.CancelledError()
+        t = gridbin_func(xbins, ybins)
+        computed[bins_key(xbins, ybins)] = t
+        return t
+
+    sharpen_region_recur(node, region, nbins, depth, bin_func)
+    return computed
+
+
+def lookup_bin_func(computed, gridbin_func):
+    """
+    Return a binning function returning precomputed nodes from `computed`
+    and falling back to `gridbin_func`.
+    """
+    def bin_func(xbins, ybins):
+        t = computed.get(bins_key(xbins, ybins))
+        return t if t is not None else gridbin_func(xbins, ybins)
+    return bin_func
+
+
+def bins_key(xbins, ybins):
+    return xbins.tobytes(), ybins.tobytes()
+
+
+def Node_mask(node):
+    if node.contingencies.ndim == 3:
+        return node.contingencies.any(axis=2)
+    else:
+        return node.contingencies > 0
+
+
+def Node_nonzero(node):
+    return np.nonzero(Node_mask(node))
+
+
+def sharpen_region_recur(node, region, nbins, depth, gridbin_func):
+    """
+    Refine all the non empty cells of `node` intersecting `region` down
+    to `depth` levels and return the new node.
+
+    :param node: The tree to refine.
+    :type node: Tree
+    :param region: An `(x, y, width, height)` rectangle.
+    :param nbins: The number of bins (in each dimension) of a new node.
+    :param depth: The depth of the refined tree (in `region`).
+    :param gridbin_func: A `(xbins, ybins) -> Tree` binning function.
+    :rtype: Tree
+    """
+    if depth <= 1:
+        return node
+    elif not rect_intersects(node.brect, region):
+        return node
+    elif node.is_empty:
+        return node
+    elif node.is_leaf:
+        xs, xe, ys, ye = bindices(node, region)
+        # indices in need of update
+        indices = Node_nonzero(node)
+        for i, j in zip(*indices):
+            if xs <= i < xe and ys <= j < ye:
+                node = sharpen_node_cell(node, i, j, nbins, gridbin_func)
+
+        # if the exposed region is empty the node.is_leaf property
+        # is preserved
+        if node.is_leaf:
+            return node
+
+        return sharpen_region_recur(node, region, nbins, depth, gridbin_func)
+    else:
+        xs, xe, ys, ye = bindices(node, region)
+
+        # indices is need of update
+        indices1 = Node_nonzero(node)
+        indices2 = node.children.nonzero()
+        indices = sorted(set(list(zip(*indices1))) - set(list(zip(*indices2))))
+
+        for i, j in indices:
+            if xs <= i < xe and ys <= j < ye:
+                node = sharpen_node_cell(node, i, j, nbins, gridbin_func)
+
+        children = np.array(node.children, dtype=object)
+        children[xs: xe, ys: ye] = [
+            [sharpen_region_recur(ch, region, nbins, depth - 1, gridbin_func)
+             if ch is not None else None
+             for ch in row]
+            for row in np.array(children[xs: xe, ys: ye])
+        ]
+        return node._replace(children=children)
+
+
+def as_rect(rect):
+    """
+    Return `rect` as an `(x, y, width, height)` tuple.
+
+    `rect` can be a tuple or any object with a `getRect` method (e.g.
+    `QRectF`).
+    """
+    if hasattr(rect, "getRect"):
+        return tuple(rect.getRect())
+    x, y, w, h = rect
+    return x, y, w, h
+
+
+def rect_intersected(rect1, rect2):
+    """
+    Return the intersection of two (normalized) rectangles or None if
+    they do not overlap (i.e. the intersection has no area).
+    """
+    x1, y1, w1, h1 = as_rect(rect1)
+    x2, y2, w2, h2 = as_rect(rect2)
+    left, right = max(x1, x2), min(x1 + w1, x2 + w2)
+    top, bottom = max(y1, y2), min(y1 + h1, y2 + h2)
+    if left < right and top < bottom:
+        return left, top, right - left, bottom - top
+    else:
+        return None
+
+
+def rect_intersects(rect1, rect2):
+    """Do the two (normalized) rectangles overlap."""
+    return rect_intersected(rect1, rect2) is not None
+
+
+def bindices(node, rect):
+    """
+    Return the `(xs, xe, ys, ye)` ranges of `node` bins intersecting
+    `rect`.
+    """
+    x, y, w, h = as_rect(rect)
+    assert w >= 0 and h >= 0
+    assert rect_intersects(node.brect, (x, y, w, h))
+
+    xs = np.searchsorted(node.xbins, x, side="left") - 1
+    xe = np.searchsorted(node.xbins, x + w, side="right")
+    ys = np.searchsorted(node.ybins, y, side="left") - 1
+    ye = np.searchsorted(node.ybins, y + h, side="right")
+
+    return np.clip([xs, xe, ys, ye],
+                   [0, 0, 0, 0],
+                   [node.xbins.size - 2, node.xbins.size - 1,
+                    node.ybins.size - 2, node.ybins.size - 1])
+
+
+def create_image(contingencies, colors=None, scale=None):
+    """
+    Return an (N, M, 3) RGB color array for an (N, M) or (N, M, n_classes)
+    contingency.
+
+    A 2 dimensional contingency is drawn in shades of gray, otherwise
+    every cell is drawn in the color of its majority class with intensity
+    proportional to the (scaled) count.
+
+    :param contingencies: The contingency array.
+    :param colors: An (n_classes, 3) array of RGB class colors (default
+        `default_colors(n_classes)`).
+    :param scale: A function mapping the contingencies to [0, 1] (default
+        is a linear scale).
+    :rtype: np.ndarray
+    """
+    if scale is None:
+        scale = lambda c: c / (contingencies.max() or 1)
+
+    P = scale(contingencies)
+
+    if P.ndim == 3:
+        ncol = P.shape[-1]
+        if colors is None:
+            colors = default_colors(ncol)
+        colors = np.asarray(colors, dtype=float)[:, :3]
+
+        argmax = np.argmax(P, axis=2)
+        irow, icol = np.indices(argmax.shape)
+        P_max = P[irow, icol, argmax]
+        positive = P_max > 0
+        P_max = np.where(positive, P_max * 0.95 + 0.05, 0.0)
+
+        colors = 255 - colors[argmax.ravel()]
+
+        # XXX: Non linear intensity scaling
+        colors = colors * P_max.ravel().reshape(-1, 1)
+        colors = colors.reshape(P_max.shape + (3,))
+        colors = 255 - colors
+    elif P.ndim == 2:
+        mix = P
+        positive = mix > 0
+        mix = np.where(positive, mix * 0.99 + 0.01, 0.0)
+
+        colors = np.zeros((np.prod(mix.shape), 3)) + 255
+        colors = colors - mix.ravel().reshape(-1, 1) * 255
+        colors = colors.reshape(mix.shape + (3,))
+
+    return colors.astype(int)
+
+
+def default_colors(n):
+    """Return an (n, 3) array of evenly spaced (in hue) RGB colors."""
+    hsv = [(i / max(n, 1), 0.8, 0.9) for i in range(n)]
+    return (np.array([colorsys.hsv_to_rgb(*c) for c in hsv])
+            .reshape((n, 3)) * 255).astype(int)
+
+
+def color_scale_func(scale, vmax):
+    """
+    Return a function mapping contingencies in the range [0, `vmax`] to
+    [0, 1] on a `Linear`, `Sqrt` or `Log` color scale.
+    """
+    def log_scale(ctng):
+        log_max = np.log(vmax + 1)
+        log_ctng = np.log(ctng + 1)
+        return log_ctng / (log_max or 1)
+
+    def sqrt_scale(ctng):
+        sqrt_max = np.sqrt(vmax)
+        sqrt_ctng = np.sqrt(ctng)
+        return sqrt_ctng / (sqrt_max or 1)
+
+    def lin_scale(ctng):
+        return ctng / (vmax or 1)
+
+    return {Linear: lin_scale, Sqrt: sqrt_scale, Log: log_scale}[scale]
+
+
+def score_candidate_rects(node, region):
+    """
+    Score candidate bins in node.
+
+    Candidates are the non empty and not yet expanded bins intersecting
+    `region`. Return a `(scores, rows, cols)` tuple of arrays (use
+    `cell_rect` to get the bin rects).
+
+    """
+    xs, xe, ys, ye = bindices(node, region)
+
+    mask = Node_mask(node)[xs: xe, ys: ye]
+    if not node.is_leaf:
+        mask &= np.equal(node.children[xs: xe, ys: ye], None)
+    rows, cols = np.nonzero(mask)
+
+    if node.contingencies.ndim == 3:
+        scores = max_chi_squares(node.contingencies[xs: xe, ys: ye])
+        scores = scores[rows, cols]
+    else:
+        scores = np.ones(rows.size)
+    return scores, rows + xs, cols + ys
+
+
+def cell_rect(node, i, j):
+    """Return the (i, j) bin rect of node as an `(x, y, w, h)` tuple."""
+    return (node.xbins[i], node.ybins[j],
+            node.xbins[i + 1] - node.xbins[i],
+            node.ybins[j + 1] - node.ybins[j])
+
+
+def max_chi_squares(contingencies):
+    """
+    Return the maximum chi2 score of the neighbouring bin pairs (left,
+    right, up and down) of every bin in an (N, M, n_classes) contingency.
+
+    Only the pairs with both indices in the range of the chi2 arrays
+    (i.e. `i < N - 1` and `j < M - 1`) are scored.
+    """
+    N, M = contingencies.shape[:2]
+    # compute_chisqares expects classes in 1 dim
+    chi_lr, chi_up = compute_chi_squares(
+        contingencies.swapaxes(1, 2).swapaxes(0, 1)
+    )
+    n, m = N - 1, M - 1
+    scores = np.zeros((4, N, M))
+    scores[0, :n, :m] = chi_lr[:n, :m]
+    scores[1, :n, 1:] = chi_lr[:n, :m]
+    scores[2, :n, :m] = chi_up[:n, :m]
+    scores[3, 1:, :m] = chi_up[:n, :m]
+    return scores.max(axis=0)
+
+
+def compute_chi_squares(observes):
+    """Compute chi2 scores of given observations.
+
+    Assumes that data is generated by two independent distributions,
+    one for rows and one for columns and estimate distribution parameters
+    from data.
+
+    Parameters
+    ----------
+    observes : numpy array with dimensions (N_CLASSES * N_ROWS * N_COLUMNS)
+        Multiple contingencies containing observations for multiple classes.
+    """
+    CLASSES, COLS, ROWS = 0, 1, 2
+
+    n = observes.sum((ROWS, COLS), keepdims=True)
+    row_sums = observes.sum(ROWS, keepdims=True)
+    col_sums = observes.sum(COLS, keepdims=True)
+    estimates = row_sums * col_sums / n
+
+    chi2 = np.nan_to_num(np.nansum((observes - estimates)**2 / estimates, axis=CLASSES))
+
+    # compute chi squares for left-right neighbours
+    chi2lr = chi2[:,:-1] + chi2[:,1:]
+    chi2ud = chi2[:-1,:] + chi2[1:,:]
+
+    return chi2lr, chi2ud
+
+
+def Tree_raster(node, depth=None):
+    """
+    Return the contingencies of the tree flattened into a single grid of
+    `node.nbins ** depth` bins in each dimension (`depth` defaults to the
+    tree depth).
+
+    Cells which are not refined down to `depth` are spread uniformly
+    over their sub-bins (the total counts are preserved).
+
+    :type node: Tree
+    :rtype: np.ndarray
+    """
+    if depth is None:
+        depth = node.depth()
+    ctng = node.contingencies
+    if depth <= 1:
+        return np.asarray(ctng, dtype=float)
+    n = node.nbins ** (depth - 1)
+    raster = np.repeat(np.repeat(ctng, n, axis=0), n, axis=1) / n ** 2
+    if not node.is_leaf:
+        for i, j in zip(*np.nonzero(np.not_equal(node.children, None))):
+            raster[i * n: (i + 1) * n, j * n: (j + 1) * n] = \
+                Tree_raster(node.children[i, j], depth - 1)
+    return raster
+
+
+def Tree_sample(node, n, rows, cols):
+    """
+    Return the contingencies of the tree sampled on a uniform grid of
+    `n` x `n` bins over `node.brect` in the window of bin indices
+    `rows` x `cols` (`(start, stop)` pairs, which can extend outside the
+    grid; the bins outside are 0).
+
+    `n` and `node.nbins` must be powers of 2. Finer bins are summed and
+    bins which are not refined down to `n` are spread uniformly over
+    their sub-bins (see `Tree_raster`).
+
+    :type node: Tree
+    :rtype: np.ndarray
+    """
+    (r0, r1), (c0, c1) = rows, cols
+    out = np.zeros((r1 - r0, c1 - c0) + node.contingencies.shape[2:])
+    R0, R1, C0, C1 = max(r0, 0), min(r1, n), max(c0, 0), min(c1, n)
+    if R0 >= R1 or C0 >= C1:
+        return out
+    nbins = node.nbins
+    if n <= nbins:
+        ctng = resample(node, nbins // n).contingencies
+        out[R0 - r0: R1 - r0, C0 - c0: C1 - c0] = ctng[R0: R1, C0: C1]
+        return out
+
+    # every node bin spans k x k sampled bins
+    k = n // nbins
+    i0, i1 = R0 // k, (R1 - 1) // k + 1
+    j0, j1 = C0 // k, (C1 - 1) // k + 1
+    ctng = node.contingencies[i0: i1, j0: j1]
+    spread = np.repeat(np.repeat(ctng, k, axis=0), k, axis=1) / k ** 2
+    out[R0 - r0: R1 - r0, C0 - c0: C1 - c0] = \
+        spread[R0 - i0 * k: R1 - i0 * k, C0 - j0 * k: C1 - j0 * k]
+    if not node.is_leaf:
+        children = node.children[i0: i1, j0: j1]
+        for i, j in zip(*np.nonzero(np.not_equal(children, None))):
+            i, j = i + i0, j + j0
+            a0, a1 = max(R0, i * k), min(R1, (i + 1) * k)
+            b0, b1 = max(C0, j * k), min(C1, (j + 1) * k)
+            out[a0 - r0: a1 - r0, b0 - c0: b1 - c0] = Tree_sample(
+                node.children[i, j], k,
+                (a0 - i * k, a1 - i * k), (b0 - j * k, b1 - j * k))
+    return out
+
+
+def equal_width_bins(values, nbins):
+    """
+    Return `nbins + 1` equal width bin edges spanning the (finite)
+    `values`.
+    """
+    values = np.asarray(values, dtype=float)
+    values = values[np.isfinite(values)]
+    if not values.size:
+        raise ValueError("no finite values")
+    vmin, vmax = values.min(), values.max()
+    if vmin == vmax:
+        vmin, vmax = vmin - 0.5, vmax + 0.5
+    return np.linspace(vmin, vmax, nbins + 1)
+
+
+class DensityMap:
+    """
+    A multi-resolution density map of two continuous columns.
+
+    The map starts as a single `nbins` x `nbins` grid over the range of
+    the data; `refine` splits the non empty cells in a region into
+    sub-grids. The binning uses a `SpatialIndex` so refining a small
+    region only touches the points inside it.
+
+    The map (including the index) can be pickled, e.g. to compute the
+    maps of many column pairs in worker processes.
+
+    :param x: The x coordinates.
+    :param y: The y coordinates.
+    :param z: Optional (discrete) class values (`0 ... nvalues - 1` or
+        nan).
+    :param nvalues: The number of distinct values of `z` (default
+        `max(z) + 1`).
+    :param nbins: The number of bins in each dimension of a tree node.
+    """
+    def __init__(self, x, y, z=None, nvalues=None, nbins=16):
+        if nbins < 2:
+            raise ValueError("nbins must be at least 2")
+        self.nbins = nbins
+        self.index = SpatialIndex(x, y)
+        if z is not None:
+            z = np.asarray(z, dtype=float)
+            if nvalues is None:
+                nvalues = int(np.nanmax(z)) + 1 if np.any(~np.isnan(z)) \
+                    else 1
+        self.z = z
+        self.nvalues = nvalues if z is not None else 0
+
+        xbins = equal_width_bins(self.index.x, nbins)
+        ybins = equal_width_bins(self.index.y, nbins)
+        # Bin all the points (the outer edges are extended to infinity)
+        root = self.bin(np.r_[-np.inf, xbins[1:-1], np.inf],
+                        np.r_[-np.inf, ybins[1:-1], np.inf])
+        #: The root node of the density tree
+        self.root = root._replace(xbins=xbins, ybins=ybins)
+
+    @classmethod
+    def from_table(cls, data, xvar, yvar, zvar=None, nbins=16):
+        """
+        Create a density map of `xvar` and `yvar` columns of an
+        `Orange.data.Table`, optionally split by values of (a discrete)
+        `zvar`.
+        """
+        xvar = data.domain[xvar]
+        yvar = data.domain[yvar]
+        x = data.get_column_view(xvar)[0]
+        y = data.get_column_view(yvar)[0]
+        if zvar is not None:
+            zvar = data.domain[zvar]
+            if not zvar.is_discrete:
+                raise ValueError("{} is not discrete".format(zvar.name))
+            z = data.get_column_view(zvar)[0]
+            return cls(x, y, z, len(zvar.values), nbins=nbins)
+        return cls(x, y, nbins=nbins)
+
+    def bin(self, xbins, ybins):
+        """Return a `Tree` leaf node for the grid `xbins` x `ybins`."""
+        return grid_bin_indexed(self.index, xbins, ybins, self.z,
+                                self.nvalues)
+
+    @property
+    def brect(self):
+        """The `(x, y, width, height)` bounds of the map."""
+        return self.root.brect
+
+    def depth(self):
+        """Return the current depth of the density tree."""
+        return self.root.depth()
+
+    def refine(self, region=None, depth=2):
+        """
+        Refine the map in `region` (default the whole map) so that the
+        tree is `depth` levels deep there, and return the new root.
+
+        The refinement is incremental; cells which were already refined
+        are not binned again.
+        """
+        if region is None:
+            region = self.brect
+        self.root = sharpen_region_recur(
+            self.root, as_rect(region), self.nbins, depth, self.bin)
+        return self.root
+
+    def query(self, region):
+        """
+        Return the (sorted) row indices of the points in `region` (the
+        bounds are inclusive).
+        """
+        x, y, w, h = as_rect(region)
+        pos = self.index.query(x, x + w, y, y + h)
+        return np.sort(self.index.order[pos])
+
+    def raster(self, depth=None):
+        """
+        Return the density at `depth` as a single contingency array (see
+        `Tree_raster`).
+        """
+        return Tree_raster(self.root, depth)
+
+    def image(self, depth=None, colors=None, scale=Sqrt, smoothing=0):
+        """
+        Render the map as an RGB image.
+
+        :param depth: The level of detail (default the tree depth); the
+            image is `nbins ** depth` pixels wide and high.
+        :param colors: The class colors (see `create_image`).
+        :param scale: The color scale (`Linear`, `Sqrt` or `Log`).
+        :param smoothing: Gaussian smoothing kernel width in pixels (the
+            colors are scaled to the maximum of the smoothed density).
+        :return: A (height, width, 3) uint8 array; the first row is the
+            top (largest y) of the map.
+        :rtype: np.ndarray
+        """
+        raster = gaussian_smooth(self.raster(depth), smoothing)
+        vmax = raster.max() if raster.size else 0
+        rgb = create_image(raster, colors,
+                           scale=color_scale_func(scale, vmax))
+        return np.ascontiguousarray(
+            rgb.swapaxes(0, 1)[::-1]).astype(np.uint8)
+
+
+def density_image(x, y, z=None, nvalues=None, nbins=16, depth=2,
+                  **kwargs):
+    """
+    Return an RGB image array of the density map of `x` and `y` refined
+    to `depth` (the remaining keyword arguments are passed to
+    `DensityMap.image`).
+
+    This is a convenience function suitable for mapping over many column
+    pairs in a process pool.
+    """
+    dmap = DensityMap(x, y, z, nvalues, nbins=nbins)
+    dmap.refine(depth=depth)
+    return dmap.image(depth=depth, **kwargs)
@@ -0,0 +1,65 @@
+"""
+Hashes of table rows.
+
+`hash_rows` combines per-column hashes into 64-bit row hashes; rows with
+equal values (as compared by `hash_column`) have equal hashes. The module
+does not depend on Qt, so it is shared by widgets and scripts.
+"""
+import numpy as np
+
+
+def hash_column(column):
+    """
+    Return an array of 64-bit hashes of the values in the column; equal
+    values (including missing) have equal hashes.
+    """
+    if column.dtype == object:
+        # Compare the values as strings, like the Unique widget's
+        # `column_codes`
+        return _hash_strings(column.astype(str))
+    column = column.astype(float) + 0.0  # -0.0 becomes 0.0
+    column[np.isnan(column)] = np.nan
+    return column.view(np.uint64)
+
+
+def _mix(hashes):
+    """Mix all bits of (uint64) `hashes` in place (splitmix64's finalizer)."""
+    hashes ^= hashes >> np.uint64(30)
+    hashes *= np.uint64(0xBF58476D1CE4E5B9)
+    hashes ^= hashes >> np.uint64(27)
+    hashes *= np.uint64(0x94D049BB133111EB)
+    hashes ^= hashes >> np.uint64(31)
+    return hashes
+
+
+def _hash_strings(strings):
+    """
+    Return 64-bit hashes of a (fixed width) unicode array.
+
+    Unlike Python's `hash`, the hashes do not change between processes.
+    The characters are mixed in one position at a time for all strings;
+    the padding (zero) characters are skipped, so hashes do not depend on
+    the width of the array.
+    """
+    width = strings.dtype.itemsize // 4
+    chars = np.ascontiguousarray(strings).view(np.uint32) \
+        .reshape(len(strings), width)
+    hashes = np.zeros(len(strings), dtype=np.uint64)
+    for i in range(width):
+        char = chars[:, i].astype(np.uint64)
+        mixed = _mix(hashes * np.uint64(0x9E3779B97F4A7C15) ^ char)
+        hashes = np.where(char != 0, mixed, hashes)
+    return hashes
+
+
+def hash_rows(columns):
+    """Return 64-bit hashes of the rows of `columns` (see `hash_column`)."""
+    hashes = np.zeros(len(columns[0]), dtype=np.uint64)
+    for column in columns:
+        # Mix after every column; values like small integers as floats
+        # have many zero low bits, which a multiplication alone only
+        # spreads upwards, so keys would collide
+        hashes *= np.uint64(0x9E3779B97F4A7C15)
+        hashes ^= hash_column(column)
+        _mix(hashes)
+    return hashes
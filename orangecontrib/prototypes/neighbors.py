@@ -0,0 +1,539 @@
+"""
+Nearest neighbors of a reference set in data.
+
+A data row's distance to the reference set is its distance to the
+nearest reference row. `NeighborIndex` preprocesses the data once per
+data input (removes all-missing columns, imputes the rest and, for cosine
+distance, normalizes the rows) and computes these distances for any
+reference table. `nearest` then selects the closest rows without sorting
+all of them. `NeighborIndex.query` instead finds the nearest rows of each
+reference row separately.
+
+For approximate search on large (e.g. embedding) data, `IVFIndex`
+assigns the data rows to lists of their nearest k-means centroid. A query
+only computes the distances of rows in the lists nearest to the
+references (see `NeighborIndex.candidates`); the number of searched lists
+trades recall for speed. The index is small and can be saved and loaded.
+
+The module does not depend on Qt.
+
+Example
+-------
+
+>>> data = Orange.data.Table("iris")
+>>> index = NeighborIndex(data, Orange.distance.Euclidean)
+>>> dist = index.distances(data[:5])
+>>> indices = nearest(dist, 10)
+
+>>> index.ivf = IVFIndex.build(index.vectors)
+>>> rows = index.candidates(data[:5], n_probe=4)
+>>> indices = rows[nearest(index.distances(data[:5], rows), 10)]
+
+"""
+import os
+import ast
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import scipy.sparse as sp
+from sklearn.metrics import pairwise_distances
+from sklearn.neighbors import KDTree, BallTree
+
+from Orange import distance
+from Orange.preprocess import RemoveNaNColumns, Impute
+from Orange.preprocess.impute import ReplaceUnknowns
+
+#: Metrics computed with a metric tree over the references
+#: (on dense continuous data)
+TREE_METRICS = {
+    distance.Euclidean: "euclidean",
+    distance.Manhattan: "manhattan",
+}
+
+#: Above this number of columns a ball tree is used instead of a k-d tree
+KDTREE_MAX_DIM = 16
+
+
+def _metric_tree(X, metric):
+    """Return a k-d tree (or a ball tree for wide `X`) over the rows of `X`"""
+    tree_type = KDTree if X.shape[1] <= KDTREE_MAX_DIM else BallTree
+    return tree_type(X, metric=metric)
+
+
+def _normalized(X):
+    """Return rows of `X` scaled to unit length (zero rows are kept)."""
+    norms = np.sqrt(np.einsum("ij,ij->i", X, X))
+    norms[norms == 0] = 1
+    return X / norms[:, None]
+
+
+def _nearest_centroids(X, centroids, n=1, block_size=2 ** 22):
+    """Return indices of the `n` centroids nearest to each row of `X`"""
+    sq_norms = np.einsum("ij,ij->i", centroids, centroids)
+    n = min(n, len(centroids))
+    nearest_ = np.empty((len(X), n), dtype=np.int32)
+    step = max(1, block_size // len(centroids))
+    for start in range(0, len(X), step):
+        # squared distances up to the (per row constant) norm of the row
+        dist = sq_norms - 2 * (X[start:start + step] @ centroids.T)
+        if n < len(centroids):
+            part = np.argpartition(dist, n - 1, axis=1)[:, :n]
+        else:
+            part = np.broadcast_to(np.arange(n), dist.shape)
+        order = np.argsort(np.take_along_axis(dist, part, axis=1), axis=1)
+        nearest_[start:start + step] = np.take_along_axis(part, order, axis=1)
+    return nearest_
+
+
+class IVFIndex:
+    """
+    An inverted file index of vectors.
+
+    Rows are assigned to the list of their nearest k-means centroid; rows
+    of list `i` are `order[offsets[i]:offsets[i + 1]]`.
+
+    Parameters
+    ----------
+    centroids : np.ndarray
+        A `(n_lists, n_columns)` array of centroids.
+    order : np.ndarray
+        Row indices sorted by their list.
+    offsets : np.ndarray
+        Starts of lists in `order` (of length `n_lists + 1`).
+    """
+    def __init__(self, centroids, order, offsets):
+        self.centroids = centroids
+        self.order = order
+        self.offsets = offsets
+
+    @property
+    def n_lists(self):
+        return len(self.centroids)
+
+    @classmethod
+    def build(cls, X, n_lists=None, n_iter=10, sample_size=None, seed=0):
+        """
+        Build the index of rows of `X`.
+
+        Parameters
+        ----------
+        X : np.ndarray
+            Vectors (rows) to index.
+        n_lists : Optional[int]
+            The number of lists (by default the square root of the
+            number of rows).
+        n_iter : int
+            The number of k-means iterations.
+        sample_size : Optional[int]
+            The number of rows on which the centroids are fitted (by
+            default 64 rows per list).
+        seed : int
+            Random seed for sampling rows and initial centroids.
+        """
+        n = len(X)
+        if n_lists is None:
+            n_lists = int(np.sqrt(n))
+        n_lists = max(1, min(n_lists, n))
+        if sample_size is None:
+            sample_size = 64 * n_lists
+        rng = np.random.RandomState(seed)
+        if sample_size < n:
+            sample = X[np.sort(rng.choice(n, sample_size, replace=False))]
+        else:
+            sample = X
+        sample = np.asarray(sample, dtype=np.float32)
+        centroids = sample[rng.choice(len(sample), n_lists, replace=False)]
+        for _ in range(n_iter):
+            labels = _nearest_centroids(sample, centroids)[:, 0]
+            members = sp.csr_matrix(
+                (np.ones(len(sample), dtype=np.float32),
+                 (labels, np.arange(len(sample)))),
+                shape=(n_lists, len(sample)))
+            counts = np.bincount(labels, minlength=n_lists)
+            nonempty = counts > 0
+            sums = np.asarray(members @ sample)
+            centroids[nonempty] = sums[nonempty] / counts[nonempty, None]
+        labels = np.empty(n, dtype=np.int32)
+        step = 2 ** 16
+        for start in range(0, n, step):
+            block = np.asarray(X[start:start + step], dtype=np.float32)
+            labels[start:start + step] = \
+                _nearest_centroids(block, centroids)[:, 0]
+        order = np.argsort(labels, kind="stable").astype(np.int64)
+        offsets = np.concatenate(
+            ([0], np.cumsum(np.bincount(labels, minlength=n_lists))))
+        return cls(centroids, order, offsets)
+
+    def probe(self, Y, n_probe=8):
+        """
+        Return sorted indices of rows in the `n_probe` lists nearest to any
+        of the rows of `Y`.
+        """
+        lists = np.unique(_nearest_centroids(
+            np.asarray(Y, dtype=np.float32), self.centroids, n_probe))
+        if not len(lists):
+            return np.array([], dtype=np.int64)
+        return np.sort(np.concatenate(
+            [self.order[self.offsets[i]:self.offsets[i + 1]]
+             for i in lists]))
+
+    def save(self, filename, key=None):
+        """
+        Save the index to `filename` (an .npz file) together with `key`.
+
+        Errors are ignored.
+        """
+        try:
+            os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+            with open(filename + ".tmp", "wb") as f:
+                np.savez(f, centroids=self.centroids, order=self.order,
+                         offsets=self.offsets, key=repr(key))
+            os.replace(filename + ".tmp", filename)
+        except OSError:
+            pass
+
+    @classmethod
+    def load(cls, filename, key=None, shape=None):
+        """
+        Load an index saved with `key` from `filename`.
+
+        Return `None` if the file does not exist, can not be read, was
+        saved with a different key or (if `shape` is given) does not fit
+        the `(n_rows, n_columns)` shape of the indexed vectors.
+        """
+        try:
+            with np.load(filename) as f:
+                if ast.literal_eval(str(f["key"])) != key:
+                    return None
+                index = cls(f["centroids"], f["order"], f["offsets"])
+        except Exception:  # pylint: disable=broad-except
+            return None
+        if shape is not None:
+            n_rows, n_columns = shape
+            if len(index.order) != n_rows or \
+                    index.centroids.ndim != 2 or \
+                    index.centroids.shape[1] != n_columns or \
+                    index.offsets[-1] != n_rows:
+                return None
+        return index
+
+
+class NeighborIndex:
+    """
+    Preprocessed data for computing distances to reference rows.
+
+    Euclidean and Manhattan distances on dense numeric data are computed
+    with metric trees (unless `use_tree` is `False`) or else, like cosine
+    distances, from the data vectors in blocks of rows (with BLAS inner
+    products for Euclidean and cosine distance). Other metrics use the
+    fitted Orange distance on blocks of rows. Blocks are computed in
+    `n_jobs` threads and their size is chosen so that the distances and
+    temporary arrays of all concurrent blocks fit into `memory` bytes.
+
+    Parameters
+    ----------
+    data : Orange.data.Table
+        Data in which the neighbors are searched.
+    metric : Type[Orange.distance.Distance]
+        Distance (from `Orange.distance`).
+    use_tree : bool
+        Use metric trees for Euclidean and Manhattan distance.
+    memory : int
+        Memory budget (in bytes) for blocks of distances.
+    n_jobs : Optional[int]
+        The number of threads (by default the number of CPUs).
+    """
+    def __init__(self, data, metric, use_tree=True, memory=256 * 2 ** 20,
+                 n_jobs=None):
+        self.data = data
+        self.metric = metric
+        self.use_tree = use_tree
+        self.memory = memory
+        self.n_jobs = n_jobs or os.cpu_count() or 1
+        self.pp_data = Impute()(RemoveNaNColumns()(data))
+        #: An `IVFIndex` of `vectors` for approximate search
+        self.ivf = None
+        self._tree = None
+        self._sq_norms = None
+        domain = self.pp_data.domain
+        continuous = all(var.is_continuous for var in domain.attributes) \
+            and not sp.issparse(self.pp_data.X)
+        #: Dense vectors of data rows (normalized for cosine) or `None`
+        self.vectors = None
+        if continuous:
+            self.vectors = self.pp_data.X
+            if metric is distance.Cosine:
+                self.vectors = _normalized(self.vectors)
+        if continuous and metric in TREE_METRICS and use_tree:
+            self.method = "tree"
+        elif continuous and (metric in TREE_METRICS or
+                             metric is distance.Cosine):
+            self.method = "vectors"
+        else:
+            self.method = "model"
+            self._model = metric().fit(self.pp_data)
+
+        # Columns and imputed values for preprocessing references in the
+        # data's domain without `Table.transform`
+        self._columns = self._fill = None
+        transforms = [var.compute_value for var in domain.attributes]
+        if continuous and \
+                all(isinstance(t, ReplaceUnknowns) for t in transforms):
+            attributes = list(data.domain.attributes)
+            self._columns = np.array(
+                [attributes.index(t.variable) for t in transforms],
+                dtype=int)
+            self._fill = np.array([float(t.value) for t in transforms])
+
+    def __len__(self):
+        return len(self.pp_data)
+
+    def preprocess(self, reference):
+        """Return `reference` transformed to the index's (imputed) domain"""
+        return reference.transform(self.pp_data.domain)
+
+    def _reference_X(self, reference):
+        """Return the preprocessed attribute values of `reference`"""
+        if self._fill is not None and not sp.issparse(reference.X) and \
+                reference.domain.attributes == self.data.domain.attributes:
+            X = reference.X[:, self._columns]
+            return np.where(np.isnan(X), self._fill, X)
+        return self.preprocess(reference).X
+
+    def reference_vectors(self, reference):
+        """Return vectors of `reference` rows comparable to `vectors`"""
+        X = self._reference_X(reference)
+        return _normalized(X) if self.metric is distance.Cosine else X
+
+    def distances(self, reference, rows=None):
+        """
+        Return the distances of data rows to the nearest reference row.
+
+        Parameters
+        ----------
+        reference : Orange.data.Table
+        rows : Optional[np.ndarray]
+            Indices of data rows (all rows by default).
+
+        Returns
+        -------
+        dist : np.ndarray
+            An array of length `len(data)` (or `len(rows)`).
+        """
+        n_data = len(self.pp_data) if rows is None else len(rows)
+        if n_data == 0 or len(reference) == 0:
+            return np.full(n_data, np.inf)
+        if self.method == "tree":
+            X = self.vectors if rows is None else self.vectors[rows]
+            tree = _metric_tree(self._reference_X(reference),
+                                TREE_METRICS[self.metric])
+            dist, _ = tree.query(X, k=1)
+            return dist[:, 0]
+
+        prepared = self._prepare(reference)
+        dist = np.empty(n_data)
+
+        def block_min(block):
+            start, stop = block
+            dist[start:stop] = self._pairwise(
+                prepared, _rows(rows, start, stop)).min(axis=1)
+
+        for _ in self._map(block_min, self._blocks(n_data, len(reference))):
+            pass
+        return dist
+
+    def query(self, reference, k, excluded=None, rows=None):
+        """
+        Return the `k` nearest data rows of each reference row.
+
+        Parameters
+        ----------
+        reference : Orange.data.Table
+        k : int
+            The number of neighbors of each reference row.
+        excluded : Optional[np.ndarray]
+            A boolean mask of data rows that are not neighbors.
+        rows : Optional[np.ndarray]
+            Indices of data rows to search (all rows by default).
+
+        Returns
+        -------
+        indices : np.ndarray
+            A `(len(reference), k)` array of data row indices, ordered by
+            distance; missing neighbors (for small data) are -1.
+        dist : np.ndarray
+            A `(len(reference), k)` array of distances (`inf` for missing).
+        """
+        n_ref = len(reference)
+        n_rows = len(self) if rows is None else len(rows)
+        if excluded is not None and rows is not None:
+            excluded = excluded[rows]
+        n_excluded = 0 if excluded is None else np.count_nonzero(excluded)
+        k_ = min(k, n_rows - n_excluded)
+        indices = np.full((n_ref, k), -1, dtype=np.int64)
+        dist = np.full((n_ref, k), np.inf)
+        if k_ <= 0 or n_ref == 0:
+            return indices, dist
+
+        if self.method == "tree" and rows is None:
+            if self._tree is None:
+                self._tree = _metric_tree(self.vectors,
+                                          TREE_METRICS[self.metric])
+            nn_dist, nn = self._tree.query(
+                self._reference_X(reference), k=min(k_ + n_excluded, n_rows))
+            if n_excluded:
+                # move excluded rows to the end (stable, so keep the order)
+                keep = np.argsort(excluded[nn], axis=1, kind="stable")
+                nn = np.take_along_axis(nn, keep, axis=1)
+                nn_dist = np.take_along_axis(nn_dist, keep, axis=1)
+            indices[:, :k_], dist[:, :k_] = nn[:, :k_], nn_dist[:, :k_]
+            return indices, dist
+
+        prepared = self._prepare(reference)
+
+        def block_top_k(block):
+            start, stop = block
+            block_dist = self._pairwise(
+                prepared, _rows(rows, start, stop)).T
+            if n_excluded:
+                block_dist[:, excluded[start:stop]] = np.inf
+            labels = np.broadcast_to(np.arange(start, stop), block_dist.shape)
+            return _top_k(block_dist, labels, k_)
+
+        # Merge the top k of blocks (in order) into the running top k
+        best = np.empty((n_ref, 0), dtype=np.int64)
+        best_dist = np.empty((n_ref, 0))
+        for labels, block_dist in self._map(
+                block_top_k, self._blocks(n_rows, n_ref)):
+            best, best_dist = _top_k(np.hstack((best_dist, block_dist)),
+                                     np.hstack((best, labels)), k_)
+        order = np.lexsort((best, best_dist))
+        best = np.take_along_axis(best, order, axis=1)
+        indices[:, :k_] = best if rows is None else np.asarray(rows)[best]
+        dist[:, :k_] = np.take_along_axis(best_dist, order, axis=1)
+        return indices, dist
+
+    def _blocks(self, n_rows, n_ref):
+        """
+        Return `(start, stop)` ranges of blocks of data rows whose
+        distances to `n_ref` reference rows fit into the memory budget.
+        """
+        # Per row: distances and about twice as much for temporary arrays,
+        # and a copy of the row's vector; up to `2 * n_jobs` blocks are
+        # in flight, but only `n_jobs` of them are being computed
+        n_columns = len(self.pp_data.domain.attributes)
+        row_bytes = 8 * (3 * n_ref + n_columns)
+        step = max(1, self.memory // (self.n_jobs * row_bytes))
+        return [(start, min(start + step, n_rows))
+                for start in range(0, n_rows, step)]
+
+    def _map(self, func, blocks):
+        """
+        Yield results of `func` applied to `blocks` in order.
+
+        At most `2 * n_jobs` blocks are computed (or waiting) at once.
+        """
+        if self.n_jobs == 1 or len(blocks) == 1:
+            yield from map(func, blocks)
+            return
+        with ThreadPoolExecutor(max_workers=self.n_jobs) as executor:
+            pending = deque()
+            for block in blocks:
+                pending.append(executor.submit(func, block))
+                if len(pending) >= 2 * self.n_jobs:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    def _prepare(self, reference):
+        """Return `reference` in the form expected by `_pairwise`"""
+        if self.method == "model":
+            return self.preprocess(reference)
+        return self.reference_vectors(reference)
+
+    def _pairwise(self, reference, rows):
+        """
+        Return an array of distances between data `rows` (indices or a
+        slice) and `reference` (as returned by `_prepare`).
+        """
+        if self.method == "model":
+            return np.asarray(self._model(self.pp_data[rows], reference))
+        X = self.vectors[rows]
+        if self.metric is distance.Cosine:
+            return 1 - X @ reference.T
+        if self.metric is distance.Euclidean:
+            if self._sq_norms is None:
+                self._sq_norms = np.einsum("ij,ij->i",
+                                           self.vectors, self.vectors)
+            dist = X @ reference.T
+            dist *= -2
+            dist += self._sq_norms[rows][:, None]
+            dist += np.einsum("ij,ij->i", reference, reference)
+            np.maximum(dist, 0, out=dist)
+            return np.sqrt(dist, out=dist)
+        return pairwise_distances(X, reference,
+                                  metric=TREE_METRICS[self.metric])
+
+    def candidates(self, reference, n_probe=8):
+        """
+        Return indices of data rows in the `n_probe` lists of `ivf`
+        nearest to each reference row.
+        """
+        return self.ivf.probe(self.reference_vectors(reference), n_probe)
+
+
+def _rows(rows, start, stop):
+    """Return indices (or a slice) of data rows `start:stop` of `rows`"""
+    return slice(start, stop) if rows is None else rows[start:stop]
+
+
+def _top_k(dist, labels, k):
+    """
+    Return `labels` and `dist` of the (unordered) `k` smallest
+    distances in each row of `dist`.
+    """
+    if k >= dist.shape[1]:
+        return labels, dist
+    part = np.argpartition(dist, k - 1, axis=1)[:, :k]
+    return (np.take_along_axis(labels, part, axis=1),
+            np.take_along_axis(dist, part, axis=1))
+
+
+def nearest(dist, k, exclude=None):
+    """
+    Return indices of the `k` smallest distances in ascending order.
+
+    Ties are broken by index. Only a small candidate set is sorted; it
+    is enlarged when `exclude` rejects too many of the candidates.
+
+    Parameters
+    ----------
+    dist : np.ndarray
+        Distances of data rows to the reference.
+    k : int
+        Number of indices to return.
+    exclude : Optional[Callable[[np.ndarray], np.ndarray]]
+        A function returning a boolean mask of rejected candidates for
+        an array of row indices.
+
+    Returns
+    -------
+    indices : np.ndarray
+    """
+    n = len(dist)
+    n_cand = min(k, n)
+    while n_cand > 0:
+        if n_cand < n:
+            part = np.argpartition(dist, n_cand - 1)[:n_cand]
+            # include all rows tied with the largest candidate
+            cand = np.flatnonzero(dist <= dist[part].max())
+        else:
+            cand = np.arange(n)
+        cand = cand[np.lexsort((cand, dist[cand]))]
+        if exclude is not None:
+            cand = cand[~exclude(cand)]
+        if len(cand) >= k or n_cand == n:
+            return cand[:k]
+        n_cand = min(n, 2 * n_cand)
+    return np.array([], dtype=int)
@@ -1,16 +1,31 @@
 import os
 import re
+import bisect
+import glob
+import mmap
+import concurrent.futures
+from html import escape
 
-from tempfile import NamedTemporaryFile
+import numpy as np
 
-from AnyQt.QtCore import Qt, QTimer
-from AnyQt.QtWidgets import QTextEdit, QStyle, QFileDialog, QGridLayout
+from AnyQt.QtCore import (
+    Qt, QTimer, QThread, Slot, QAbstractListModel, QModelIndex
+)
+from AnyQt.QtGui import QFont, QFontDatabase, QFontMetrics, QPalette, QColor
+from AnyQt.QtWidgets import (
+    QTextEdit, QStyle, QFileDialog, QGridLayout, QTableView, QHeaderView,
+    QStyledItemDelegate
+)
 
-from Orange.data import Table
+from Orange.data import (
+    Table, Domain, ContinuousVariable, DiscreteVariable, StringVariable
+)
+from Orange.data.variable import MISSING_VALUES
 from Orange.widgets import gui
 from Orange.widgets.settings import Setting, ContextSetting, ContextHandler
 from Orange.widgets.widget import OWWidget, Msg, Output
 from Orange.widgets.utils.filedialogs import RecentPathsWComboMixin
+from Orange.widgets.utils.concurrent import FutureWatcher
 
 
 class NameContextHandler(ContextHandler):
@@ -25,6 +40,476 @@ class NameContextHandler(ContextHandler):
         return (name == context.name) + \
                (os.path.splitext(name)[1] == os.path.splitext(context.name)[1])
 
+
+def _next_line(buf, start, end):
+    """
+    Return the start of the line following the line at `start` or `None`
+    if this is the last line before `end`.
+    """
+    eol = buf.find(b"\n", start, end)
+    if eol < 0 or eol + 1 >= end:
+        return None
+    return eol + 1
+
+
+def _line_end(buf, start, end):
+    """Return the end (excluding the newline) of the line at `start`."""
+    eol = buf.find(b"\n", start, end)
+    return end if eol < 0 else eol
+
+
+def _find_line(buf, pattern, pos, end):
+    """
+    Return the start of the first line at or after `pos` that matches the
+    (bytes, MULTILINE) `pattern`, or -1 if there is none.
+
+    The regular expression is run over the whole buffer, so lines without
+    a match are skipped at the speed of the regex engine. Matches that
+    span a line break are verified on the line (with its newline) itself.
+    """
+    while pos < end:
+        match = pattern.search(buf, pos, end)
+        if match is None:
+            return -1
+        if match.start() == end and buf[end - 1: end] == b"\n":
+            # An empty match after the last newline is not on any line
+            return -1
+        start = buf.rfind(b"\n", pos, match.start()) + 1 or pos
+        stop = min(_line_end(buf, match.start(), end) + 1, end)
+        if match.end() <= stop or pattern.search(buf, start, stop):
+            return start
+        pos = stop
+    return -1
+
+
+def _block_at(buf, line, skip_lines, block_length, size):
+    """
+    Return the block starting at the matching `line` as a tuple with the
+    start of the line following the block (`None` at the end of data) and
+    the list of `(start, end)` ranges of the block's lines.
+    """
+    lines = []
+    for _ in range(skip_lines):
+        line = _next_line(buf, line, size)
+        if line is None:
+            return None, lines
+    for _ in range(block_length):
+        lines.append((line, _line_end(buf, line, size)))
+        line = _next_line(buf, line, size)
+        if line is None:
+            break
+    return line, lines
+
+
+def iter_blocks(buf, pattern, skip_lines, block_length, pos=0, end=None,
+                size=None):
+    """
+    Yield the blocks of lines selected from `buf`.
+
+    Every line matching the `pattern` starts a block; `skip_lines` lines
+    are skipped (the matching line is the first of them) and the next
+    `block_length` lines are selected. The search continues with the line
+    after the block. A block which is cut off by the end of `buf` is
+    yielded partially.
+
+    Each block is a `(match, resume, lines)` tuple with the offset of the
+    matching line, the offset at which the search continues and a list of
+    `(start, end)` byte ranges of the selected lines.
+
+    :param buf: A bytes-like object (e.g. a memory mapped file).
+    :param pattern: A compiled bytes pattern (with `re.MULTILINE`, so that
+        `^` and `$` match at the line boundaries).
+    :param pos: The offset (a line start) at which to start.
+    :param end: Only the lines starting before `end` (a line start) are
+        searched, but the blocks can extend past it (default `size`).
+    :param size: The end of the data (default `len(buf)`).
+    """
+    if size is None:
+        size = len(buf)
+    if end is None:
+        end = size
+    while pos < end:
+        match = _find_line(buf, pattern, pos, end)
+        if match < 0:
+            return
+        line, lines = _block_at(buf, match, skip_lines, block_length, size)
+        pos = size if line is None else line
+        yield match, pos, lines
+
+
+def grep_blocks(buf, pattern, skip_lines, block_length, pos=0, end=None):
+    """
+    Yield the `(start, end)` byte ranges of the lines selected from `buf`
+    (see `iter_blocks`).
+    """
+    for _, _, lines in iter_blocks(buf, pattern, skip_lines, block_length,
+                                   pos, end):
+        yield from lines
+
+
+def grep_appended(buf, pattern, skip_lines, block_length, pos, cutoff, end):
+    """
+    Continue the search of `buf` up to `end` from the state of a previous
+    search, which ended at `pos` (a line start).
+
+    `cutoff` is `None` or a `(match, n_lines)` tuple describing a block that
+    was cut off by the end of the previously searched data: the start of
+    its matching line and the number of lines that were already selected.
+
+    Return a tuple with the list of `(start, end)` ranges of newly selected
+    lines and the new `pos` and `cutoff`.
+    """
+    ranges = []
+    if cutoff is not None:
+        match, n_lines = cutoff
+        line, lines = _block_at(buf, match, skip_lines, block_length, end)
+        ranges += lines[n_lines:]
+        if len(lines) < block_length:
+            return ranges, end, (match, len(lines))
+        pos, cutoff = end if line is None else line, None
+    for match, resume, lines in iter_blocks(
+            buf, pattern, skip_lines, block_length, pos, end, size=end):
+        ranges += lines
+        if len(lines) < block_length:
+            cutoff = (match, len(lines))
+    return ranges, end, cutoff
+
+
+def split_lines(buf, size):
+    """
+    Return the offsets splitting `buf` into ranges of about `size` bytes at
+    line boundaries (the first offset is 0 and the last is `len(buf)`).
+    """
+    offsets = [0]
+    while offsets[-1] + size < len(buf):
+        eol = buf.find(b"\n", offsets[-1] + size)
+        if eol < 0 or eol + 1 == len(buf):
+            break
+        offsets.append(eol + 1)
+    offsets.append(len(buf))
+    return offsets
+
+
+def match_index(buf, pattern, start=0, end=None):
+    """
+    Return an array with the offsets of all lines matching the `pattern`
+    that start between `start` and `end` (default `len(buf)`).
+
+    Unlike `iter_blocks`, the index does not depend on the skipped and
+    selected lines, so blocks for any of them can be taken from it (see
+    `iter_indexed_blocks`). Indices of consecutive ranges (split at line
+    boundaries) can be concatenated.
+    """
+    if end is None:
+        end = len(buf)
+    matches = []
+    pos = start
+    while pos < end:
+        match = _find_line(buf, pattern, pos, end)
+        if match < 0:
+            break
+        matches.append(match)
+        pos = _next_line(buf, match, end)
+        if pos is None:
+            break
+    return np.array(matches, dtype=np.int64)
+
+
+def iter_indexed_blocks(buf, matches, skip_lines, block_length, size=None):
+    """
+    Yield the blocks of lines (see `iter_blocks`) selected from `buf`, given
+    the `matches` computed by `match_index`.
+
+    Matches within a block are skipped by bisecting the index, so the
+    pattern is not evaluated again.
+    """
+    if size is None:
+        size = len(buf)
+    i = 0
+    while i < len(matches) and matches[i] < size:
+        match = int(matches[i])
+        line, lines = _block_at(buf, match, skip_lines, block_length, size)
+        pos = size if line is None else line
+        yield match, pos, lines
+        i = np.searchsorted(matches, pos)
+
+
+def index_range(filename, pattern, start, end):
+    """
+    Return the `match_index` of the range `start:end` of the file.
+
+    Run in a worker process.
+    """
+    with MappedFile(filename) as buf:
+        return match_index(buf, pattern, start, end)
+
+
+class _TextMatch:
+    """The byte offsets of a `TextPattern` match."""
+    __slots__ = ("_start", "_end")
+
+    def __init__(self, start, end):
+        self._start, self._end = start, end
+
+    def start(self):
+        return self._start
+
+    def end(self):
+        return self._end
+
+
+class TextPattern:
+    """
+    A pattern searching the (utf-8 encoded) bytes with `str` semantics.
+
+    A bytes regular expression sees a multi-byte character as several
+    characters, so `.`, `\\w`, `\\b`, character classes and case
+    folding do not work for non-ASCII text. The data is therefore
+    searched in chunks of lines: ASCII chunks with the (faster) bytes
+    pattern and the others decoded (undecodable bytes are kept as
+    surrogates, so the match offsets can be mapped back to bytes) with
+    the `str` pattern.
+
+    Like a compiled bytes pattern, `search(buf, pos, end)` returns an
+    object with the `start()` and `end()` byte offsets of the match or
+    `None`. `pos` must be a line start.
+    """
+    #: The initial and the maximal size of the searched chunks
+    min_chunk, max_chunk = 2 ** 10, 2 ** 20
+
+    def __init__(self, pattern, flags):
+        self.pattern = pattern
+        self.flags = flags
+        self._text = re.compile(pattern, flags)
+        self._bytes = re.compile(pattern.encode("utf-8"), flags) \
+            if pattern.isascii() else None
+
+    def search(self, buf, pos=0, end=None):
+        if end is None:
+            end = len(buf)
+        chunk = self.min_chunk
+        while pos < end:
+            # Chunks end at line ends; they are short at first so dense
+            # matches are cheap and grow so sparse matches are fast
+            stop = buf.find(b"\n", min(pos + chunk, end), end) + 1 or end
+            chunk = min(2 * chunk, self.max_chunk)
+            data = bytes(buf[pos:stop])
+            if self._bytes is not None and data.isascii():
+                match = self._bytes.search(buf, pos, stop)
+                if match is not None:
+                    return match
+            else:
+                text = data.decode("utf-8", errors="surrogateescape")
+                match = self._text.search(text)
+                if match is not None:
+                    start = pos + len(self._encode(text[:match.start()]))
+                    return _TextMatch(
+                        start,
+                        start + len(self._encode(match.group())))
+            pos = stop
+        return None
+
+    @staticmethod
+    def _encode(text):
+        return text.encode("utf-8", errors="surrogateescape")
+
+
+def _crlf_line_ends(pattern):
+    """
+    Return the regular expression `pattern` with `$` also matching before
+    a `\\r\\n` line end.
+
+    Files are searched as bytes, so (unlike in text mode) the `\\r` of
+    Windows line ends is a part of the line. `$` (outside of character
+    sets) is replaced by `(?=\\r?$)`.
+    """
+    parts = []
+    i, in_set = 0, False
+    while i < len(pattern):
+        char = pattern[i]
+        if char == "\\":
+            parts.append(pattern[i:i + 2])
+            i += 2
+            continue
+        if in_set:
+            if char == "]":
+                in_set = False
+        elif char == "[":
+            in_set = True
+            # A `]` (after an optional `^`) at the start is a literal
+            j = i + 1 + (pattern[i + 1: i + 2] == "^")
+            if pattern[j: j + 1] == "]":
+                parts.append(pattern[i:j + 1])
+                i = j + 1
+                continue
+        elif char == "$":
+            char = r"(?=\r?$)"
+        parts.append(char)
+        i += 1
+    return "".join(parts)
+
+
+def compile_pattern(pattern, case_sensitive=True, regular_expression=False):
+    """
+    Compile the pattern for searching the (utf-8 encoded) bytes.
+
+    A case sensitive plain text pattern is matched on the bytes directly;
+    the others are compiled to a `TextPattern`, which also matches non
+    ASCII text correctly. `$` matches at `\\n` and `\\r\\n` line ends.
+    """
+    if regular_expression:
+        pattern = _crlf_line_ends(pattern)
+    else:
+        pattern = re.escape(pattern)
+    flags = re.MULTILINE
+    if not case_sensitive:
+        flags |= re.IGNORECASE
+    if not regular_expression and case_sensitive:
+        # utf-8 is self synchronizing; a byte match is a character match
+        return re.compile(pattern.encode("utf-8"), flags)
+    return TextPattern(pattern, flags)
+
+
+def matching_files(pattern):
+    """
+    Return the sorted list of files in directory `pattern` or matching the
+    glob `pattern`.
+    """
+    pattern = os.path.expanduser(pattern)
+    if os.path.isdir(pattern):
+        pattern = os.path.join(pattern, "*")
+    return sorted(filter(os.path.isfile, glob.glob(pattern, recursive=True)))
+
+
+def decode_line(line):
+    return bytes(line).decode("utf-8", errors="replace").strip()
+
+
+def complete_size(buf):
+    """Return the end of the last complete (newline terminated) line."""
+    return buf.rfind(b"\n") + 1
+
+
+def tokenize_lines(lines):
+    """
+    Split the lines at white space into an (n_lines, n_columns) string
+    array; missing trailing tokens are empty strings.
+    """
+    split = [line.split() for line in lines]
+    width = max(map(len, split), default=0)
+    return np.array([tokens + [""] * (width - len(tokens))
+                     for tokens in split], dtype=str).reshape(-1, width)
+
+
+def append_tokens(tokens, new_tokens):
+    """Return the token arrays stacked (and padded to the same width)."""
+    width = max(tokens.shape[1], new_tokens.shape[1])
+
+    def pad(arr):
+        padding = np.full((len(arr), width - arr.shape[1]), "", dtype=str)
+        return np.hstack((arr, padding))
+    return np.vstack((pad(tokens), pad(new_tokens)))
+
+
+#: Missing value tokens
+MISSING_TOKENS = sorted(v for v in MISSING_VALUES if isinstance(v, str))
+
+
+def is_number(token):
+    try:
+        float(token)
+    except ValueError:
+        return False
+    return True
+
+
+def column_variable(name, column):
+    """
+    Infer the type of a column of string tokens and return a `(variable,
+    values)` tuple.
+
+    The inference follows Orange's file readers: numeric columns are
+    continuous, unless all values are 0/1 or 1/2, and string columns are
+    discrete if they have few distinct values (and string variables
+    otherwise).
+    """
+    missing = np.isin(column, MISSING_TOKENS)
+    present = column[~missing]
+    try:
+        numbers = present.astype(float)
+    except ValueError:
+        numbers = None
+    if numbers is not None:
+        unique = set(np.unique(numbers))
+        if not unique or not unique <= {0, 1} and not unique <= {1, 2}:
+            values = np.full(len(column), np.nan)
+            values[~missing] = numbers
+            return ContinuousVariable(name), values
+        unique = np.unique(present)
+    else:
+        unique = np.unique(present)
+        max_values = min(int(round(len(column) ** 0.7)), 100)
+        if len(unique) > max_values:
+            return StringVariable(name), np.where(missing, "", column)
+    values = np.full(len(column), np.nan)
+    values[~missing] = np.searchsorted(unique, present)
+    return DiscreteVariable(name, values=[str(v) for v in unique]), values
+
+
+def table_from_tokens(tokens, names, sources=None):
+    """
+    Return a table from an (n_rows, n_columns) array of string tokens.
+
+    Continuous and discrete columns are attributes and string columns are
+    metas. If `sources` is given, it is added as a "Source file" meta
+    column.
+    """
+    names = list(names)
+    names += ["Feature {}".format(i + 1)
+              for i in range(len(names), tokens.shape[1])]
+    attributes, metas, x_cols, meta_cols = [], [], [], []
+    for name, column in zip(names, tokens.T):
+        var, values = column_variable(name, column)
+        if var.is_string:
+            metas.append(var)
+            meta_cols.append(values.astype(object))
+        else:
+            attributes.append(var)
+            x_cols.append(values)
+    if sources is not None:
+        metas.append(StringVariable("Source file"))
+        meta_cols.append(np.array(sources, dtype=object))
+    n_rows = len(tokens)
+    X = np.column_stack(x_cols) if x_cols else np.empty((n_rows, 0))
+    M = np.column_stack(meta_cols) if meta_cols else \
+        np.empty((n_rows, 0), dtype=object)
+    return Table.from_numpy(Domain(attributes, metas=metas), X, metas=M)
+
+
+class MappedFile:
+    """
+    A context manager returning a read-only memory map of the file (or an
+    empty bytes object for an empty file, which can not be mapped).
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = self._map = None
+
+    def __enter__(self):
+        self._file = open(self.filename, "rb")
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        except ValueError:  # empty file
+            return b""
+        return self._map
+
+    def __exit__(self, *_):
+        if self._map is not None:
+            self._map.close()
+        self._file.close()
+
+
 # The data flows through the widget as follows:
 # - open_file set current_file (+ in_view) and calls grep_lines;
 # - grep_lines greps into selected_lines and calls set_out_view and commit
@@ -35,6 +520,102 @@ class NameContextHandler(ContextHandler):
 # - combo with recent files and the button open call open_file
 # - all pattern-related controls except the checkbox for header call grep_lines
 # - the checkbox for header calls set_out_view and commit, without re-grepping
+#
+# grep_lines finds the offsets of all matching lines of each file (see
+# match_index) and selects the blocks from them in _select_lines. The indices
+# are cached in _match_index while the file and the pattern do not change, so
+# changing the skipped and selected lines does not search the file again.
+#
+# When indexing multiple files (or a large file), grep_lines starts a Task
+# which indexes the files (or their parts) in a process pool; when all are
+# done, _on_range_done selects the lines and calls set_out_view and commit.
+#
+# When following the file, a timer calls _poll_file, which greps the newly
+# appended lines (from the _follow_state), appends them to selected_lines
+# and calls set_out_view and commit.
+
+class FollowState:
+    """
+    The state of the search at the end of a followed file.
+
+    :param filename: The file name.
+    :param stat: The file's `os.stat` result.
+    :param end: The end of the searched data.
+    :param pos: The offset at which the search continues.
+    :param cutoff: The block cut off at `end` (see `grep_appended`).
+    """
+    def __init__(self, filename, stat, end, pos, cutoff=None):
+        self.filename = filename
+        self.file_id = (stat.st_dev, stat.st_ino)
+        self.end = end
+        self.pos = pos
+        self.cutoff = cutoff
+
+
+#: The role of the header flag of a line (see `LinesModel`)
+HeaderRole = next(gui.OrangeUserRole)
+
+
+class LinesModel(QAbstractListModel):
+    """
+    A list model of lines.
+
+    If the `block_length` is given, every `block_length`-th line (or the
+    lines at the sorted `block_starts`, if given) is a header; its
+    `HeaderRole` data is 1 for the first header and 2 for the others.
+
+    The model refers to the list of lines, so they are not copied, and the
+    view only asks for the lines it shows.
+    """
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._lines = []
+        self._block_length = None
+        self._block_starts = None
+
+    def set_lines(self, lines, block_length=None, block_starts=None):
+        self.beginResetModel()
+        self._lines = lines
+        self._block_length = block_length
+        self._block_starts = block_starts
+        self.endResetModel()
+
+    def _is_header(self, row):
+        if not self._block_length:
+            return False
+        if self._block_starts is None:
+            return row % self._block_length == 0
+        i = bisect.bisect_left(self._block_starts, row)
+        return i < len(self._block_starts) and self._block_starts[i] == row
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self._lines)
+
+    def data(self, index, role=Qt.DisplayRole):
+        row = index.row()
+        if not index.isValid() or row >= len(self._lines):
+            return None
+        if role == Qt.DisplayRole:
+            return self._lines[row]
+        if role == HeaderRole and self._is_header(row):
+            return 1 if row == 0 else 2
+        return None
+
+
+class HeaderDelegate(QStyledItemDelegate):
+    """Shows the headers (see `LinesModel`) in bold; all but first in gray."""
+    def initStyleOption(self, option, index):
+        super().initStyleOption(option, index)
+        header = index.data(HeaderRole)
+        if header:
+            font = QFont(option.font)
+            font.setWeight(QFont.Black)
+            option.font = font
+            if header == 2:
+                palette = QPalette(option.palette)
+                palette.setColor(QPalette.Text, QColor(Qt.gray))
+                option.palette = palette
+
 
 class OWGrep(OWWidget, RecentPathsWComboMixin):
     name = "Grep"
@@ -56,8 +637,19 @@ class OWGrep(OWWidget, RecentPathsWComboMixin):
     block_length = ContextSetting(1)
     has_header_row = ContextSetting(False)
 
+    follow = Setting(False)
+    multiple_files = Setting(False)
+    files_pattern = Setting("")
+
     auto_send = Setting(True)
 
+    #: The number of bytes shown in the input view
+    preview_size = 64 * 1024
+    #: Files larger than this are split and searched in parallel
+    chunk_size = 32 * 2 ** 20
+    #: The interval (in milliseconds) of checking the followed file
+    follow_interval = 1000
+
     out_css = """
     <style>
         div {
@@ -81,6 +673,8 @@ class OWGrep(OWWidget, RecentPathsWComboMixin):
     class Warning(OWWidget.Warning):
         no_lines = Msg("Pattern not found")
         no_header_row = Msg("Blocks do not appear to have headers.")
+        no_files = Msg("No files match the pattern")
+        unreadable_files = Msg("Some files could not be read: {}")
 
     class Error(OWWidget.Error):
         unreadable = Msg("Data is not readable.\n{}")
@@ -94,6 +688,19 @@ class OWGrep(OWWidget, RecentPathsWComboMixin):
         self.current_file = None
         self.find_text = ""
         self.selected_lines = []
+        #: The source file of each selected line (in multiple files mode)
+        self.line_sources = None
+        #: The index of the first selected line of each block (in multiple
+        #: files mode, where blocks cut off at the end of a file are short)
+        self.block_starts = None
+        self._token_cache = None
+        self._task = None  # type: Optional[OWGrep.Task]
+        self._executor = None  # type: Optional[concurrent.futures.Executor]
+        self._follow_state = None  # type: Optional[FollowState]
+        #: Cached indices of matching lines: filename -> (key, matches)
+        self._match_index = {}  # type: Dict[str, Tuple[tuple, np.ndarray]]
+        self._follow_timer = QTimer(
+            self, interval=self.follow_interval, timeout=self._poll_file)
 
         box = gui.widgetBox(
             self.controlArea, box="File", orientation=QGridLayout())
@@ -111,6 +718,26 @@ class OWGrep(OWWidget, RecentPathsWComboMixin):
                 autoDefault=False,
                 icon=self.style().standardIcon(QStyle.SP_BrowserReload)),
             1, 1)
+        box.layout().addWidget(
+            gui.checkBox(
+                None, self, "follow", label="Follow appended lines",
+                tooltip="Watch the file and output the blocks appended to it",
+                callback=self.grep_lines),
+            2, 0, 1, 2)
+        box.layout().addWidget(
+            gui.checkBox(
+                None, self, "multiple_files", label="Search multiple files:",
+                callback=self.grep_lines),
+            3, 0, 1, 2)
+        files_edit = gui.lineEdit(
+            None, self, "files_pattern",
+            tooltip="A directory or a glob pattern (e.g. logs/**/*.txt)")
+        files_edit.returnPressed.connect(self._on_files_pattern_changed)
+        box.layout().addWidget(files_edit, 4, 0, 1, 2)
+        self.cancel_button = gui.button(
+            None, self, "Stop", callback=self.cancel, autoDefault=False,
+            disabled=True)
+        box.layout().addWidget(self.cancel_button, 5, 0, 1, 2)
 
         box = gui.widgetBox(self.controlArea, box="Pattern")
         lineedit = gui.lineEdit(box, self, "pattern")
@@ -148,7 +775,21 @@ class OWGrep(OWWidget, RecentPathsWComboMixin):
         self.mainArea.layout().addWidget(self.in_view)
 
         gui.widgetLabel(self.mainArea, "Used lines")
-        self.out_view = QTextEdit(readOnly=True)
+        self.out_view = QTableView(
+            showGrid=False, wordWrap=False,
+            selectionBehavior=QTableView.SelectRows)
+        self.out_view.setModel(LinesModel(self))
+        self.out_view.setItemDelegate(HeaderDelegate(self))
+        font = QFontDatabase.systemFont(QFontDatabase.FixedFont)
+        font.setPointSize(11)
+        self.out_view.setFont(font)
+        # Fixed row heights, so the rows need not be laid out
+        header = self.out_view.verticalHeader()
+        header.hide()
+        header.setSectionResizeMode(QHeaderView.Fixed)
+        header.setDefaultSectionSize(QFontMetrics(font).height() + 2)
+        self.out_view.horizontalHeader().hide()
+        self.out_view.horizontalHeader().setStretchLastSection(True)
         self.mainArea.layout().addWidget(self.out_view)
 
         self.set_file_list()
@@ -204,11 +845,26 @@ class OWGrep(OWWidget, RecentPathsWComboMixin):
                 self.Error.file_not_found()
                 self.current_file = None
             else:
-                with open(self.current_file) as f:
-                    text = f.read()
+                text = self._preview_text()
         self.in_view.setHtml(self.out_css + "<div>{}</div>".format(text))
         self.grep_lines()
 
+    def _preview_text(self):
+        """
+        Return the (html escaped) first `preview_size` bytes of
+        `current_file`, cut at the last complete line.
+        """
+        size = os.path.getsize(self.current_file)
+        with open(self.current_file, "rb") as f:
+            data = f.read(self.preview_size)
+        if size <= len(data):
+            return escape(data.decode("utf-8", errors="replace"))
+        data = data[:data.rfind(b"\n") + 1]
+        return '{}<span class="add-header">[showing the first {} of {} ' \
+               'bytes]</span>'.format(
+                   escape(data.decode("utf-8", errors="replace")),
+                   len(data), size)
+
     def grep_lines(self):
         """
         Grep the lines from `current_file` into `selected_lines`.
@@ -216,55 +872,287 @@ class OWGrep(OWWidget, RecentPathsWComboMixin):
         Finally, it calls `set_out_view` and `commit`.
 
         Depends on `current_file` and all settings except `has_header_row`.
-        """
-        def prepare_re():
-            pattern = self.pattern
-            if not self.regular_expression:
-                pattern = re.escape(pattern)
-            flags = re.IGNORECASE if not self.case_sensitive else 0
-            return re.compile(pattern, flags)
 
+        The file is memory mapped and searched with the regular expression
+        over the whole buffer (see `match_index`), so it is never read into
+        memory as a whole. The index of matching lines is kept until the
+        file (its size or modification time) or the pattern changes.
+
+        Multiple files and files larger than `chunk_size` are indexed in
+        a process pool (see `Task`), and `set_out_view` and `commit` are
+        called when all are done.
+        """
+        self.cancel()
         self.Warning.no_lines.clear()
+        self.Warning.no_files.clear()
+        self.Warning.unreadable_files.clear()
         self.selected_lines = []
-        if self.pattern and self.current_file:
-            pattern = prepare_re()
-            with open(self.current_file) as f:
-                file_lines = iter(f)
+        self.line_sources = None
+        self.block_starts = None
+        self._follow_state = None
+        following = self.follow and not self.multiple_files
+        if following and self.pattern and self.current_file:
+            self._follow_timer.start()
+        else:
+            self._follow_timer.stop()
+        if self.multiple_files:
+            files = matching_files(self.files_pattern) \
+                if self.files_pattern else []
+            self.Warning.no_files(shown=bool(self.files_pattern) and not files)
+            self.line_sources = []
+            self.block_starts = []
+        else:
+            files = [self.current_file] if self.current_file else []
+        if self.pattern and files:
+            pattern = compile_pattern(
+                self.pattern, self.case_sensitive, self.regular_expression)
+            keys = {}
+            for filename in files:
                 try:
-                    line = next(file_lines)
-                    while True:
-                        if pattern.search(line):
-                            for _ in range(self.skip_lines):
-                                line = next(file_lines)
-                            for _ in range(self.block_length):
-                                self.selected_lines.append(line.strip())
-                                line = next(file_lines)
-                        else:
-                            line = next(file_lines)
-                except StopIteration:
-                    pass
+                    stat = os.stat(filename)
+                except OSError:
+                    continue
+                keys[filename] = (stat.st_size, stat.st_mtime_ns,
+                                  pattern.pattern, pattern.flags, following)
+            # The index of a followed file is not reused since its end
+            # (and the follow state) changes
+            self._match_index = {
+                filename: index
+                for filename, index in self._match_index.items()
+                if index[0] == keys.get(filename) and not following}
+            ranges, unreadable = self._split_files(
+                [filename for filename in files
+                 if filename not in self._match_index])
+            if len(ranges) > 1 or self.multiple_files and ranges:
+                self._start_task(pattern, files, ranges, keys, unreadable)
+                return
+            elif following and ranges:
+                stat = os.stat(self.current_file)
+                with MappedFile(self.current_file) as buf:
+                    # Only the complete lines; the last one may still be
+                    # written to
+                    lines, pos, cutoff = grep_appended(
+                        buf, pattern, self.skip_lines, self.block_length,
+                        0, None, complete_size(buf))
+                    self.selected_lines = [
+                        decode_line(buf[start:end]) for start, end in lines]
+                self._follow_state = FollowState(
+                    self.current_file, stat, pos, pos, cutoff)
+            else:
+                for filename, _, _ in ranges:
+                    try:
+                        with MappedFile(filename) as buf:
+                            self._match_index[filename] = \
+                                (keys[filename], match_index(buf, pattern))
+                    except OSError:
+                        unreadable.append(os.path.basename(filename))
+                self._select_lines(files, unreadable)
+            if unreadable:
+                self.Warning.unreadable_files(", ".join(unreadable))
             self.Warning.no_lines(shown=not self.selected_lines)
         self.set_out_view()
         self.commit()
 
+    def _poll_file(self):
+        """
+        Grep the lines appended to the followed file since the last search.
+
+        If the file was replaced or truncated, it is searched again.
+        """
+        state = self._follow_state
+        if self._task is not None or state is None:
+            return
+        try:
+            stat = os.stat(state.filename)
+        except OSError:
+            return
+        if (stat.st_dev, stat.st_ino) != state.file_id or \
+                stat.st_size < state.end:
+            self.grep_lines()
+            return
+        if stat.st_size == state.end:
+            return
+        pattern = compile_pattern(
+            self.pattern, self.case_sensitive, self.regular_expression)
+        with MappedFile(state.filename) as buf:
+            end = complete_size(buf)
+            if end <= state.end:
+                return
+            lines, state.pos, state.cutoff = grep_appended(
+                buf, pattern, self.skip_lines, self.block_length,
+                state.pos, state.cutoff, end)
+            state.end = end
+            lines = [decode_line(buf[start:stop]) for start, stop in lines]
+        if lines:
+            self.selected_lines += lines
+            self.Warning.no_lines.clear()
+            self.set_out_view()
+            self.commit()
+
+    def _on_files_pattern_changed(self):
+        if self.multiple_files:
+            self.grep_lines()
+
+    def _split_files(self, files):
+        """
+        Return a list of `(filename, start, end)` ranges of files split at
+        line boundaries into parts of about `chunk_size`, and a list of
+        names of unreadable files.
+        """
+        ranges, unreadable = [], []
+        for filename in files:
+            try:
+                if os.path.getsize(filename) <= self.chunk_size:
+                    ranges.append((filename, 0, os.path.getsize(filename)))
+                    continue
+                with MappedFile(filename) as buf:
+                    offsets = split_lines(buf, self.chunk_size)
+                    if self.follow and not self.multiple_files:
+                        end = complete_size(buf)
+                        offsets = [offset for offset in offsets
+                                   if offset < end] + [end]
+            except OSError:
+                unreadable.append(os.path.basename(filename))
+                continue
+            ranges += [(filename, start, end)
+                       for start, end in zip(offsets, offsets[1:])]
+        return ranges, unreadable
+
+    def _select_lines(self, files, unreadable, size=None):
+        """
+        Append the lines selected from the indexed `files` (see
+        `_match_index`) to `selected_lines` (and `line_sources`), and return
+        the last block (see `iter_blocks`) or `None`.
+
+        Names of files which can no longer be read are appended to the list
+        `unreadable`.
+        """
+        block = None
+        for filename in files:
+            if filename not in self._match_index:
+                continue
+            matches = self._match_index[filename][1]
+            try:
+                with MappedFile(filename) as buf:
+                    for block in iter_indexed_blocks(
+                            buf, matches, self.skip_lines, self.block_length,
+                            size):
+                        lines = [decode_line(buf[start:end])
+                                 for start, end in block[2]]
+                        if self.block_starts is not None and lines:
+                            self.block_starts.append(len(self.selected_lines))
+                        self.selected_lines += lines
+                        if self.line_sources is not None:
+                            self.line_sources += [filename] * len(lines)
+            except OSError:
+                unreadable.append(os.path.basename(filename))
+        return block
+
+    class Task:
+        files = ...  # type: List[str]
+        ranges = ...  # type: List[Tuple[str, int, int]]
+        #: Keys of the indices (see `_match_index`) by filenames
+        keys = ...  # type: Dict[str, tuple]
+        unreadable = ...  # type: List[str]
+        #: The end of the data when following the file (or `None`)
+        size = None  # type: Optional[int]
+        cancelled = False  # type: bool
+
+        def __init__(self):
+            self.futures = []  # type: List[concurrent.futures.Future]
+            self.watchers = []  # type: List[FutureWatcher]
+
+        def cancel(self):
+            self.cancelled = True
+            for future in self.futures:
+                future.cancel()
+
+    def _start_task(self, pattern, files, ranges, keys, unreadable):
+        if self._executor is None:
+            self._executor = concurrent.futures.ProcessPoolExecutor()
+        self._task = task = self.Task()
+        task.files = files
+        task.ranges = ranges
+        task.keys = keys
+        task.unreadable = unreadable
+        if self.follow and not self.multiple_files:
+            task.size = ranges[-1][2]
+            task.stat = os.stat(ranges[-1][0])
+        self.progressBarInit()
+        self.cancel_button.setEnabled(True)
+        for filename, start, end in ranges:
+            future = self._executor.submit(
+                index_range, filename, pattern, start, end)
+            watcher = FutureWatcher(future)
+            watcher.done.connect(self._on_range_done)
+            task.futures.append(future)
+            task.watchers.append(watcher)
+
+    def cancel(self):
+        """Cancel the running search (if any)."""
+        if self._task is not None:
+            task = self._task
+            task.cancel()
+            for watcher in task.watchers:
+                watcher.done.disconnect(self._on_range_done)
+            self._task = None
+            self.progressBarFinished()
+            self.cancel_button.setEnabled(False)
+
+    @Slot(concurrent.futures.Future)
+    def _on_range_done(self, _):
+        assert self.thread() is QThread.currentThread()
+        task = self._task
+        if task is None:
+            return
+        n_done = sum(future.done() for future in task.futures)
+        self.progressBarSet(100 * n_done / len(task.futures))
+        if n_done < len(task.futures):
+            return
+
+        self._task = None
+        self.progressBarFinished()
+        self.cancel_button.setEnabled(False)
+        # Concatenate the indices of the ranges of each file
+        indices, failed = {}, set()
+        for (filename, _, _), future in zip(task.ranges, task.futures):
+            try:
+                indices.setdefault(filename, []).append(future.result())
+            except Exception:  # pylint: disable=broad-except
+                failed.add(filename)
+        for filename, parts in indices.items():
+            if filename not in failed:
+                self._match_index[filename] = \
+                    (task.keys[filename], np.concatenate(parts))
+        unreadable = task.unreadable + \
+            [os.path.basename(filename) for filename in failed]
+        block = self._select_lines(task.files, unreadable, task.size)
+        if unreadable:
+            self.Warning.unreadable_files(", ".join(sorted(set(unreadable))))
+        if task.size is not None:
+            cutoff = None
+            if block is not None and len(block[2]) < self.block_length:
+                cutoff = (block[0], len(block[2]))
+            self._follow_state = FollowState(
+                task.ranges[-1][0], task.stat, task.size, task.size, cutoff)
+        self.Warning.no_lines(shown=not self.selected_lines)
+        self.set_out_view()
+        self.commit()
+
     def set_out_view(self):
         """
         Show the grepped lines in the output view.
 
-        Directly uses `selected_lines`, `has_header_row` and `block_length`;
-        depends on other settings through `selected_lines`.
+        Directly uses `selected_lines`, `block_starts`, `has_header_row` and
+        `block_length`; depends on other settings through `selected_lines`.
+
+        The view's model (`LinesModel`) refers to `selected_lines`, and the
+        view renders only the visible lines, regardless of their number.
         """
-        if self.has_header_row:
-            text = "\n".join(
-                "\n".join(
-                    ['<span class="{}">{}</span>'.format(
-                        "header" if i == 0 else "add-header",
-                        self.selected_lines[i])]
-                    + self.selected_lines[i + 1: i + self.block_length])
-                for i in range(0, len(self.selected_lines), self.block_length))
-        else:
-            text = "\n".join(self.selected_lines)
-        self.out_view.setHtml(self.out_css + "<div>{}</div>".format(text))
+        self.out_view.model().set_lines(
+            self.selected_lines,
+            self.block_length if self.has_header_row else None,
+            self.block_starts)
 
     def has_header_changed(self):
         """
@@ -315,35 +1203,65 @@ class OWGrep(OWWidget, RecentPathsWComboMixin):
     # pylint: disable=broad-except
     def _construct_table(self, with_header_row):
         """
-        Write the `selected_lines` into a temporary file and read it.
+        Construct a table from the tokenized `selected_lines`.
 
-        If `with_header_row` is `True`, the first line in every block is
-        skipped, except for the first block.
+        If `with_header_row` is `True`, the first line in every block (see
+        `block_starts`) is skipped, except for the first block, which gives
+        the column names.
+        If the header looks like data (all its tokens are numbers), the
+        columns are named `Feature 1`, `Feature 2` ...
 
-        If `with_header_row` is `False`, a header row is added.
+        If `with_header_row` is `False`, the columns are named `var001`,
+        `var002` ...
         """
         assert self.selected_lines
-        tempf = NamedTemporaryFile("w", suffix=".csv", delete=False)
+        tokens = self._tokens()
+        n_lines = len(tokens)
         if with_header_row:
-            data = self.selected_lines[0] + "\n" + \
-                "\n".join(
-                    "\n".join(self.selected_lines[i + 1:i + self.block_length])
-                    for i in range(0, len(self.selected_lines),
-                                   self.block_length))
+            data_rows = np.ones(n_lines, dtype=bool)
+            if self.block_starts is not None:
+                data_rows[self.block_starts] = False
+            else:
+                data_rows[::self.block_length] = False
+            rows = np.flatnonzero(data_rows)
+            header = [token for token in tokens[0] if token]
+            if all(is_number(token) for token in header):
+                names = ["Feature {}".format(i + 1)
+                         for i in range(tokens.shape[1])]
+                rows = np.r_[0, rows]
+            else:
+                names = [str(token) for token in header]
         else:
-            n_cols = len(self.selected_lines[0].split())
-            data = (
-                " ".join("var{:03}".format(i + 1) for i in range(n_cols))
-                + "\n"
-                + "\n".join(self.selected_lines))
-        tempf.write(re.sub(" +", " ", data))
-        tempf.close()
+            rows = np.arange(n_lines)
+            names = ["var{:03}".format(i + 1) for i in range(tokens.shape[1])]
+        # Blank lines are skipped
+        rows = rows[np.any(tokens[rows] != "", axis=1)]
+        sources = None
+        if self.line_sources is not None:
+            sources = [os.path.basename(self.line_sources[i]) for i in rows]
         try:
-            return Table.from_file(tempf.name)
+            return table_from_tokens(tokens[rows], names, sources)
         except Exception as err:
-            self.Error.unreadable(str(err).replace(" " + tempf.name, ""))
-        finally:
-            os.remove(tempf.name)
+            self.Error.unreadable(str(err))
+
+    def _tokens(self):
+        """
+        Return the (cached) `tokenize_lines` array of `selected_lines`.
+
+        The tokens are reused until `selected_lines` changes, e.g. when
+        toggling the header row.
+        """
+        lines = self.selected_lines
+        cache = self._token_cache
+        if cache is None or cache[0] is not lines or cache[1] > len(lines):
+            tokens = tokenize_lines(lines)
+        elif cache[1] < len(lines):
+            # Lines were appended (when following the file)
+            tokens = append_tokens(cache[2], tokenize_lines(lines[cache[1]:]))
+        else:
+            return cache[2]
+        self._token_cache = (lines, len(lines), tokens)
+        return tokens
 
     def find_changed(self):
         """Callback for searchin within the file"""
@@ -365,6 +1283,13 @@ class OWGrep(OWWidget, RecentPathsWComboMixin):
         """Overloaded from OWWidget to copy the text from the file"""
         self.in_view.copy()
 
+    def onDeleteWidget(self):
+        self._follow_timer.stop()
+        self.cancel()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+        super().onDeleteWidget()
+
 
 def main():  # pragma: no cover
     from AnyQt.QtWidgets import QApplication
@@ -1,14 +1,22 @@
+import os
+import hashlib
+
 import numpy as np
 
 from PyQt4.QtCore import Qt
 from PyQt4.QtGui import QApplication
 
 from Orange.data import Table, Domain, ContinuousVariable
-from Orange.preprocess import RemoveNaNColumns, Impute
 from Orange import distance
+from Orange.misc.environ import cache_dir
 from Orange.widgets import gui
 from Orange.widgets.settings import Setting
-from Orange.widgets.widget import OWWidget
+from Orange.widgets.widget import OWWidget, Msg
+
+from orangecontrib.prototypes.hashing import hash_rows
+from orangecontrib.prototypes.neighbors import (
+    NeighborIndex, IVFIndex, nearest
+)
 
 METRICS = [
     ("Euclidean", distance.Euclidean),
@@ -35,6 +43,11 @@ class OWNeighbors(OWWidget):
     n_neighbors = Setting(10)
     distance_index = Setting(0)
     exclude_reference = Setting(True)
+    approximate = Setting(False)
+    n_probe = Setting(8)
+    per_reference = Setting(False)
+    brute_force = Setting(False)
+    memory_limit = Setting(256)
     auto_apply = Setting(True)
 
     want_main_area = False
@@ -43,11 +56,17 @@ class OWNeighbors(OWWidget):
     _data_info_default = "No data."
     _ref_info_default = "No reference."
 
+    class Information(OWWidget.Information):
+        exact_search = Msg("Approximate search needs dense numeric data; "
+                           "exact neighbors are shown.")
+
     def __init__(self):
         super().__init__()
 
         self.data = None
         self.reference = None
+        self._index = None
+        self._data_hashes = None
         box = gui.vBox(self.controlArea, "Info")
         self.data_info_label = gui.widgetLabel(box, self._data_info_default)
         self.ref_info_label = gui.widgetLabel(box, self._ref_info_default)
@@ -64,11 +83,33 @@ class OWNeighbors(OWWidget):
         self.exclude_ref_check = gui.checkBox(
             check_box, self, "exclude_reference", label="",
             callback=self.settings_changed)
+        self.probe_spin = gui.spin(
+            box, self, "n_probe", minv=1, maxv=1024, step=1,
+            label="Approximate search, lists searched:",
+            checked="approximate", checkCallback=self.settings_changed,
+            callback=self.settings_changed,
+            tooltip="Search only rows in the lists nearest to references.\n"
+                    "More lists find more true neighbors, but take longer.")
+        gui.checkBox(
+            box, self, "brute_force", "Brute force (no metric trees)",
+            callback=self.settings_changed,
+            tooltip="Compute all distances to references in blocks of rows "
+                    "instead of\nsearching metric trees (for Euclidean and "
+                    "Manhattan distance).")
+        gui.spin(
+            box, self, "memory_limit", minv=16, maxv=65536, step=16,
+            label="Memory limit (MB):", callback=self.settings_changed,
+            tooltip="Memory for the blocks of distances computed at once.")
 
         box = gui.vBox(self.controlArea, "Output")
         self.nn_spin = gui.spin(
             box, self, "n_neighbors", label="Neighbors:", step=1, spinType=int,
             minv=0, maxv=100, callback=self.settings_changed)
+        gui.checkBox(
+            box, self, "per_reference", "Neighbors of each reference",
+            callback=self.settings_changed,
+            tooltip="Output the neighbors of each reference row, with the "
+                    "index of the reference row in column 'reference'.")
 
         box = gui.hBox(self.controlArea, True)
         self.apply_button = gui.auto_commit(box, self, "auto_apply", "&Apply",
@@ -78,6 +119,8 @@ class OWNeighbors(OWWidget):
         text = self._data_info_default if data is None \
             else "{} data instances on input.".format(len(data))
         self.data = data
+        self._index = None
+        self._data_hashes = None
         self.data_info_label.setText(text)
         self.apply()
 
@@ -95,30 +138,96 @@ class OWNeighbors(OWWidget):
         if self.data is None or self.reference is None:
             self.send("Neighbors", None)
             return
-        distance = METRICS[self.distance_index][1]
-        n_data, n_ref = len(self.data), len(self.reference)
-        all_data = Table.concatenate([self.reference, self.data], 0)
-        pp_all_data = Impute()(RemoveNaNColumns()(all_data))
-        pp_data, pp_reference = pp_all_data[n_ref:], pp_all_data[:n_ref]
-        dist = distance(np.vstack((pp_data, pp_reference)))[:n_data, n_data:]
-        data = self._add_similarity(self.data, dist)
-        sorted_indices = list(np.argsort(dist.flatten()))[::-1]
-        indices = []
-        while len(sorted_indices) > 0 and len(indices) < self.n_neighbors:
-            index = int(sorted_indices.pop() / len(self.reference))
-            if (self.data[index] not in self.reference or
-                    not self.exclude_reference) and index not in indices:
-                indices.append(index)
-        neighbors = data[indices]
+        index = self.neighbor_index()
+        approximate = self.approximate and len(index) > 0
+        self.Information.exact_search(
+            shown=approximate and index.vectors is None)
+        rows = None
+        if approximate and index.vectors is not None:
+            rows = index.candidates(self.reference, self.n_probe)
+        excluded = self._reference_rows() if self.exclude_reference else None
+        if self.per_reference:
+            indices, dist = index.query(
+                self.reference, self.n_neighbors, excluded, rows)
+            found = indices >= 0
+            ref_indices = np.nonzero(found)[0]
+            indices, dist = indices[found], dist[found]
+            neighbors = self._add_similarity(
+                self.data[indices], dist, np.max(dist, initial=0),
+                ref_indices)
+        else:
+            dist = index.distances(self.reference, rows)
+            if rows is None:
+                rows = np.arange(len(dist))
+            exclude = (lambda cand: excluded[rows[cand]]) \
+                if excluded is not None else None
+            selected = nearest(dist, self.n_neighbors, exclude)
+            neighbors = self._add_similarity(
+                self.data[rows[selected]], dist[selected],
+                np.max(dist, initial=0))
         neighbors.attributes = self.data.attributes
         self.send("Neighbors", neighbors)
 
+    def neighbor_index(self):
+        """Return the index of data for the current metric.
+
+        The index is kept until the data, the metric or the use of metric
+        trees changes.
+        """
+        metric = METRICS[self.distance_index][1]
+        if self._index is None or self._index.metric is not metric or \
+                self._index.use_tree == self.brute_force:
+            self._index = NeighborIndex(
+                self.data, metric, use_tree=not self.brute_force)
+        index = self._index
+        index.memory = self.memory_limit * 2 ** 20
+        if self.approximate and index.ivf is None and \
+                index.vectors is not None and len(index):
+            index.ivf = self._ivf_index(index)
+        return index
+
+    def _ivf_index(self, index):
+        """Load the approximate search index from the cache or build it"""
+        vectors = index.vectors
+        key = (hashlib.sha1(np.ascontiguousarray(vectors).tobytes())
+               .hexdigest(), vectors.shape)
+        filename = os.path.join(
+            cache_dir(), "neighbors",
+            hashlib.sha1(repr(key).encode("utf-8")).hexdigest() + ".npz")
+        ivf = IVFIndex.load(filename, key, vectors.shape)
+        if ivf is None:
+            ivf = IVFIndex.build(index.vectors)
+            ivf.save(filename, key)
+        return ivf
+
+    def _reference_rows(self):
+        """Return a mask of data rows that are (equal to) reference rows.
+
+        Rows are matched by their ids and by hashes of their values.
+        """
+        if self._data_hashes is None:
+            self._data_hashes = self._row_hashes(self.data)
+        reference = self.reference.transform(self.data.domain)
+        return np.isin(self.data.ids, self.reference.ids) | \
+            np.isin(self._data_hashes, self._row_hashes(reference))
+
+    @staticmethod
+    def _row_hashes(data):
+        columns = [data.get_column_view(var)[0]
+                   for var in data.domain.variables + data.domain.metas]
+        if not columns:
+            return np.zeros(len(data), dtype=np.uint64)
+        return hash_rows(columns)
+
     @staticmethod
-    def _add_similarity(data, dist):
-        dist = np.min(dist, axis=1)[:, None]
+    def _add_similarity(data, dist, max_dist, ref_indices=None):
+        columns = [100 * (1 - dist / max_dist)]
         metas = data.domain.metas + (ContinuousVariable("similarity"),)
+        if ref_indices is not None:
+            columns.append(ref_indices)
+            metas += (ContinuousVariable("reference", number_of_decimals=0),)
         domain = Domain(data.domain.attributes, data.domain.class_vars, metas)
-        data_metas = np.hstack((data.metas, 100 * (1 - dist / np.max(dist))))
+        data_metas = np.hstack((data.metas, np.column_stack(columns)))
         return Table(domain, data.X, data.Y, data_metas)
 
 
@@ -1,6 +1,7 @@
 import sys
 
 import numpy as np
+from scipy import sparse as sp
 
 from AnyQt.QtWidgets import QApplication
 from AnyQt.QtCore import Qt, QSize
@@ -13,7 +14,7 @@ from Orange.widgets.utils import itemmodels
 
 class OWReshape(widget.OWWidget):
     name = "To Shopping List"
-    description = "Reshape from a 'wide' records table to 'long' format."
+    description = "Reshape between 'wide' records and 'long' format tables."
     icon = "icons/ToShoppingList.svg"
 
     inputs = [("Data", Orange.data.Table, "set_data")]
@@ -24,7 +25,15 @@ class OWReshape(widget.OWWidget):
 
     settingsHandler = settings.PerfectDomainContextHandler(metas_in_res=True)
 
+    ToLong, ToWide = 0, 1
+    Aggregations = ["sum", "mean", "first", "count"]
+
+    mode = settings.Setting(ToLong)
     idvar = settings.ContextSetting(0)  # type: Orange.data.Variable
+    itemvar = settings.ContextSetting(0)  # type: Orange.data.Variable
+    valuevar = settings.ContextSetting(0)  # type: Orange.data.Variable
+    aggregation = settings.Setting(0)
+    sparse_output = settings.Setting(False)
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -32,21 +41,48 @@ class OWReshape(widget.OWWidget):
         self.data = None  # type: Orange.data.Table
 
         self.idvar_model = itemmodels.VariableListModel(parent=self)
+        self.itemvar_model = itemmodels.VariableListModel(parent=self)
+        self.valuevar_model = itemmodels.VariableListModel(parent=self)
         self.item_var_name = "Item"
         self.value_var_name = "Rating"
 
         box = gui.widgetBox(self.controlArea, "Info")
         self.info_text = gui.widgetLabel(box, "No data")
 
+        gui.radioButtons(self.controlArea, self, "mode",
+                         ["Wide to long", "Long to wide"], box="Reshape",
+                         callback=self._mode_changed)
+
         box = gui.widgetBox(self.controlArea, "Id var")
         self.var_cb = gui.comboBox(box, self, "idvar",
                                    callback=self._invalidate)
         self.var_cb.setMinimumContentsLength(16)
         self.var_cb.setModel(self.idvar_model)
-        gui.lineEdit(self.controlArea, self, "item_var_name",
-                     box="Item name", callback=self._invalidate)
-        gui.lineEdit(self.controlArea, self, "value_var_name",
-                     box="Value name", callback=self._invalidate)
+        self.item_name_edit = gui.lineEdit(
+            self.controlArea, self, "item_var_name", box="Item name",
+            callback=self._invalidate)
+        self.value_name_edit = gui.lineEdit(
+            self.controlArea, self, "value_var_name", box="Value name",
+            callback=self._invalidate)
+        self.sparse_check = gui.checkBox(
+            self.controlArea, self, "sparse_output", "Sparse output",
+            tooltip="Output ids and items as a sparse matrix of integer codes",
+            callback=self._invalidate)
+
+        self.wide_box = box = gui.widgetBox(self.controlArea, "Long to wide")
+        combo = gui.comboBox(box, self, "itemvar", label="Item var:",
+                             orientation=Qt.Horizontal,
+                             callback=self._invalidate)
+        combo.setModel(self.itemvar_model)
+        combo = gui.comboBox(box, self, "valuevar", label="Value var:",
+                             orientation=Qt.Horizontal,
+                             callback=self._invalidate)
+        combo.setModel(self.valuevar_model)
+        gui.comboBox(box, self, "aggregation", label="Aggregation:",
+                     orientation=Qt.Horizontal,
+                     items=[name.capitalize() for name in self.Aggregations],
+                     callback=self._invalidate)
+        self._update_controls()
 
     def sizeHint(self):
         return QSize(300, 50)
@@ -54,8 +90,20 @@ class OWReshape(widget.OWWidget):
     def clear(self):
         self.data = None
         self.idvar_model[:] = []
+        self.itemvar_model[:] = []
+        self.valuevar_model[:] = []
         self.error("")
 
+    def _update_controls(self):
+        self.item_name_edit.setEnabled(self.mode == self.ToLong)
+        self.value_name_edit.setEnabled(self.mode == self.ToLong)
+        self.sparse_check.setEnabled(self.mode == self.ToLong)
+        self.wide_box.setEnabled(self.mode == self.ToWide)
+
+    def _mode_changed(self):
+        self._update_controls()
+        self.commit()
+
     def set_data(self, data):
         self.closeContext()
         self.clear()
@@ -74,6 +122,13 @@ class OWReshape(widget.OWWidget):
 
         if self.data is not None:
             self.idvar_model[:] = idvars
+            self.itemvar_model[:] = idvars
+            self.valuevar_model[:] = [
+                var for var in domain.metas + domain.variables
+                if isinstance(var, Orange.data.ContinuousVariable)]
+            self.idvar = 0
+            self.itemvar = min(1, len(idvars) - 1)
+            self.valuevar = 0
             self.openContext(data)
             self.info_text.setText("Data with {} instances".format(len(data)))
         else:
@@ -89,6 +144,10 @@ class OWReshape(widget.OWWidget):
             return
 
         self.error("")
+        if self.mode == self.ToWide:
+            self._commit_wide()
+            return
+
         data, domain = self.data, self.data.domain
         idvar = self.idvar_model[self.idvar]
 
@@ -103,7 +162,8 @@ class OWReshape(widget.OWWidget):
                                                 values=item_names)
         value_var = Orange.data.ContinuousVariable(self.value_var_name)
         try:
-            outdata = reshape_long(data, idvar, item_var, value_var)
+            outdata = reshape_long(data, idvar, item_var, value_var,
+                                   sparse=self.sparse_output)
 
         except ValueError as err:
             self.error(str(err))
@@ -111,8 +171,76 @@ class OWReshape(widget.OWWidget):
 
         self.send("Data", outdata)
 
+    def _commit_wide(self):
+        if not self.valuevar_model:
+            self.error("No numeric value columns.")
+            self.send("Data", None)
+            return
+        idvar = self.idvar_model[self.idvar]
+        itemvar = self.itemvar_model[self.itemvar]
+        valuevar = self.valuevar_model[self.valuevar]
+        try:
+            outdata = reshape_wide(self.data, idvar, itemvar, valuevar,
+                                   self.Aggregations[self.aggregation])
+        except ValueError as err:
+            self.error(str(err))
+            outdata = None
+        self.send("Data", outdata)
+
 
-def reshape_long(table, idvar, itemvar, valuevar):
+def defined_entries(X, columns, chunk_size=2 ** 20):
+    """
+    Return the row indices, the indices into `columns` and the values of
+    the defined (not NaN) entries in the `columns` of `X` in row-major
+    order.
+
+    A dense `X` is processed in chunks of rows with (about) `chunk_size`
+    values at a time. For a sparse `X` only the stored entries are defined.
+    """
+    if sp.issparse(X):
+        X = X.tocsc()[:, columns].tocoo()
+        order = np.lexsort((X.col, X.row))
+        rows, cols, values = X.row[order], X.col[order], X.data[order]
+        defined = ~np.isnan(values)
+        return rows[defined], cols[defined], values[defined]
+
+    columns = np.asarray(columns, dtype=np.intp)
+    if columns.size and np.all(np.diff(columns) == 1):
+        # Take a view instead of copying the columns
+        columns = slice(columns[0], columns[-1] + 1)
+    step = max(1, chunk_size // max(X[:1, columns].shape[1], 1))
+    parts = []
+    for start in range(0, X.shape[0], step):
+        chunk = X[start:start + step, columns]
+        defined = ~np.isnan(chunk)
+        rows, cols = np.divmod(np.flatnonzero(defined), chunk.shape[1])
+        parts.append((rows + start, cols, chunk[defined]))
+    if not parts:
+        return (np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp),
+                np.empty(0, dtype=X.dtype))
+    return tuple(np.concatenate(part) for part in zip(*parts))
+
+
+def compact_codes(codes, n_values):
+    """
+    Return the codes of a variable with `n_values` values in the smallest
+    unsigned integer type (or unchanged if some are missing).
+    """
+    if np.isnan(codes).any():
+        return codes
+    return codes.astype(np.min_scalar_type(max(n_values - 1, 0)))
+
+
+def reshape_long(table, idvar, itemvar, valuevar, chunk_size=2 ** 20,
+                 sparse=False):
+    """
+    Reshape a 'wide' table into a 'long' table with `idvar`, `itemvar`
+    and `valuevar` columns, with a row for each defined value of the
+    attributes (except `idvar`).
+
+    If `sparse` is set, the id and item columns are a sparse matrix of
+    compact integer codes. Sparse input is never made dense.
+    """
     assert isinstance(table, Orange.data.Table)
     assert isinstance(valuevar, Orange.data.ContinuousVariable)
     assert isinstance(itemvar, Orange.data.DiscreteVariable)
@@ -136,33 +264,102 @@ def reshape_long(table, idvar, itemvar, valuevar):
 
     outdomain = Orange.data.Domain([idvar, itemvar], [valuevar])
 
-    X_parts, Y_parts = [], []
-    N = 0
-    for id_, row in zip(id_coldata, table):
-        vals = row.x[var_indices]
-        defined = np.flatnonzero(~np.isnan(vals))
-        
-        idcol_ = np.full((defined.size,), id_, dtype=id_coldata.dtype)
-        itemcol_ = defined
-        valcol = vals[defined]
-        X_parts.append([idcol_, itemcol_])
-        Y_parts.append([valcol])
-        N += defined.size
-
-    X = np.empty((N, 2))
-    Y = np.empty((N, 1))
-    i = 0
-    for (x_1, x_2), (y_p,) in zip(X_parts, Y_parts):
-        X[i:i + x_1.size, 0] = x_1
-        X[i:i + x_2.size, 1] = x_2
-        Y[i:i + y_p.size, 0] = y_p
-        i += y_p.size
-    assert i == N
+    rows, items, values = defined_entries(table.X, var_indices, chunk_size)
+    ids = np.asarray(id_coldata, dtype=float)[rows]
+    if sparse:
+        n_items = len(itemvar.values)
+        X = sp.hstack(
+            [sp.csc_matrix(compact_codes(ids, len(idvar.values))[:, None]),
+             sp.csc_matrix(compact_codes(items, n_items)[:, None])],
+            format="csr")
+    else:
+        X = np.empty((rows.size, 2))
+        X[:, 0] = ids
+        X[:, 1] = items
+    Y = values.reshape(-1, 1).astype(float)
 
     table = Orange.data.Table.from_numpy(outdomain, X, Y)
     return table
 
 
+def _column_codes(table, var):
+    """
+    Return the integer codes (-1 for missing) of the values of a discrete
+    or string column, and the names of the codes.
+    """
+    column, _ = table.get_column_view(var)
+    codes = np.full(len(column), -1, dtype=np.int64)
+    if var.is_string:
+        defined = column != ""
+        names, codes[defined] = np.unique(column[defined].astype(str),
+                                          return_inverse=True)
+        return codes, [str(name) for name in names]
+    column = column.astype(float)
+    defined = ~np.isnan(column)
+    used, codes[defined] = np.unique(column[defined].astype(int),
+                                     return_inverse=True)
+    return codes, [var.values[i] for i in used]
+
+
+def reshape_wide(table, idvar, itemvar, valuevar, aggregation="sum",
+                 sparse_threshold=0.1):
+    """
+    Reshape a 'long' table with `idvar`, `itemvar` and `valuevar` columns
+    into a 'wide' table with a row for each id and a column for each item.
+
+    Values of duplicate (id, item) pairs are aggregated with `aggregation`
+    ('sum', 'mean', 'first' or 'count'); missing cells are unknown.
+    If less than `sparse_threshold` of the cells are defined, the table is
+    sparse and its missing cells are zero.
+    """
+    assert isinstance(valuevar, Orange.data.ContinuousVariable)
+    if idvar is itemvar:
+        raise ValueError("Id and item must be different columns.")
+
+    values, _ = table.get_column_view(valuevar)
+    values = np.asarray(values, dtype=float)
+    ids, id_names = _column_codes(table, idvar)
+    items, item_names = _column_codes(table, itemvar)
+    defined = (ids >= 0) & (items >= 0) & ~np.isnan(values)
+    ids, items, values = ids[defined], items[defined], values[defined]
+
+    n_ids, n_items = len(id_names), len(item_names)
+    cells, first, inverse, counts = np.unique(
+        ids * n_items + items,
+        return_index=True, return_inverse=True, return_counts=True)
+    if aggregation == "sum":
+        cell_values = np.bincount(inverse, weights=values,
+                                  minlength=len(cells))
+    elif aggregation == "mean":
+        cell_values = np.bincount(inverse, weights=values,
+                                  minlength=len(cells)) / counts
+    elif aggregation == "first":
+        cell_values = values[first]
+    elif aggregation == "count":
+        cell_values = counts.astype(float)
+    else:
+        raise ValueError("Unknown aggregation '{}'".format(aggregation))
+
+    shape = (n_ids, n_items)
+    if len(cells) < sparse_threshold * n_ids * n_items:
+        X = sp.csr_matrix(
+            (cell_values, (cells // n_items, cells % n_items)), shape=shape)
+    else:
+        X = np.full(shape, np.nan)
+        X.flat[cells] = cell_values
+
+    if idvar.is_string:
+        metas = np.array(id_names, dtype=object).reshape(-1, 1)
+        idvar = Orange.data.StringVariable(idvar.name)
+    else:
+        idvar = Orange.data.DiscreteVariable(idvar.name, values=id_names)
+        metas = np.arange(n_ids, dtype=float).reshape(-1, 1)
+    domain = Orange.data.Domain(
+        [Orange.data.ContinuousVariable(name) for name in item_names],
+        metas=[idvar])
+    return Orange.data.Table.from_numpy(domain, X, metas=metas)
+
+
 def main(argv=None):
     app = QApplication(list(argv) if argv else [])
     argv = app.arguments()
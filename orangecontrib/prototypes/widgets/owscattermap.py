@@ -1,139 +1,45 @@
+import os
 import sys
 import time
-import itertools
-import heapq
 import operator
+import concurrent.futures
 
 from functools import reduce
-from collections import namedtuple
+from collections import OrderedDict
 
 import numpy as np
 
 from AnyQt.QtWidgets import QListView, QFrame, QGraphicsItem
 from AnyQt.QtGui import (
     QColor, QPen, QPainter, QPainterPath, QPicture, QFont, QFontInfo,
-    QPalette
+    QPalette, QImage
 )
-from AnyQt.QtCore import Qt, QRectF, QPointF
+from AnyQt.QtCore import Qt, QRectF, QThread, Slot
 
 import pyqtgraph as pg
 
 import Orange.data
 from Orange.data.sql.table import SqlTable
-from Orange.statistics import contingency
-from Orange.preprocess.discretize import EqualWidth, Discretizer
+from Orange.preprocess.discretize import EqualWidth
+from Orange.misc.environ import cache_dir
 
 from Orange.widgets import widget, gui, settings
 from Orange.widgets.utils import itemmodels, colorpalette
+from Orange.widgets.utils.concurrent import ThreadExecutor, FutureWatcher
 from Orange.widgets.widget import Msg
 from Orange.widgets.io import FileFormat
 from Orange.canvas import report
 
-
-def is_not_none(obj):
-    return obj is not None
-
-
-Tree = namedtuple(
-    "Tree",
-    ["xbins",          # bin edges on the first axis
-     "ybins",          # bin edges on the second axis
-     "contingencies",  # x/y contingency table/s
-     "children",       # an (nbins, nbins) array of sub trees or None (if leaf)
-     ]
+from orangecontrib.prototypes import density
+from orangecontrib.prototypes.density import (
+    TreeCache, SpatialIndex, columns_digest, is_not_none,
+    max_contingency_resampled, gaussian_smooth, resample, grid_bin_indexed,
+    grid_bin_sql, sharpen_cell_bins, sharpen_region_recur,
+    lookup_bin_func, bindices, create_image, score_candidate_rects,
+    cell_rect, Node_mask, Tree_sample
 )
 
 
-class Tree(Tree):
-    @property
-    def is_leaf(self):
-        """Is this node a leaf."""
-        return self.children is None
-
-    @property
-    def is_empty(self):
-        """Is this node empty, i.e. is it's contingency matrix empty."""
-        return not np.any(self.contingencies)
-
-    @property
-    def brect(self):
-        """The bounding rect `(x, y, width, height)` tuple of the node's bins.
-        """
-        return (self.xbins[0], self.ybins[0],
-                self.xbins[-1] - self.xbins[0],
-                self.ybins[-1] - self.ybins[0])
-
-    @property
-    def nbins(self):
-        """Number of bins."""
-        return self.xbins.size - 1
-
-    def depth(self):
-        """Return the tree depth."""
-        return (1 if self.is_leaf
-                  else max(ch.depth() + 1
-                           for ch in filter(is_not_none, self.children.flat)))
-
-
-def max_contingency(node):
-    """Return the maximum contingency value from node."""
-    if node.is_leaf:
-        return node.contingencies.max()
-    else:
-        valid = np.nonzero(node.children)
-        children = node.children[valid]
-        mask = np.ones_like(node.children, dtype=bool)
-        mask[valid] = False
-        ctng = node.contingencies[mask]
-        v = 0.0
-        if len(children):
-            v = max(max_contingency(ch) for ch in children)
-        if len(ctng):
-            v = max(ctng.max(), v)
-        return v
-
-
-def blockshaped(arr, rows, cols):
-    """
-    Return an array of (rows, cols) `arr` sub blocks.
-
-    E.g. given an (N, M) array return a (N//rows, M//cols, rows, cols)
-    array A, such that A[0, 0] contains the upper left sub-block of `arr`
-    (`arr[0:rows, 0:cols]`), A[0, 1] the sub-block left to it
-    (arr[0: rows, rows: 2 * rows]), ...
-
-    Example
-    -------
-
-    >>> A = numpy.array(
-    ...     [[1, 2, 3,  4,  5,  6],
-    ...      [7, 8, 9, 10, 11, 12]]
-    ... )
-
-    >>> blockshaped(A, 2, 3)
-    array([[[[ 1,  2,  3],
-             [ 7,  8,  9]],
-            [[ 4,  5,  6],
-             [10, 11, 12]]]])
-
-    >>> blockshaped(A, 1, 2)
-    array([[[[ 1,  2]],
-            [[ 3,  4]],
-            [[ 5,  6]]],
-           [[[ 7,  8]],
-            [[ 9, 10]],
-            [[11, 12]]]])
-
-    """
-    N, M = arr.shape[:2]
-    rest = arr.shape[2:]
-    assert N % rows == 0
-    assert M % cols == 0
-    return (arr.reshape((N // rows, rows, -1, cols) + rest)
-               .swapaxes(1, 2)
-               .reshape((N // rows, M // cols, rows, cols) + rest))
-
-
 def lod_from_transform(T):
     """
     Return level of detail from a translation/scale only transform T.
@@ -147,6 +53,7 @@ def lod_from_transform(T):
     r = T.mapRect(QRectF(0, 0, 1, 1))
     return np.sqrt(r.width() * r.height())
 
+
 #: Density patch shapes
 Rect, RoundRect, Circle = 0, 1, 2
 
@@ -157,22 +64,36 @@ class DensityPatch(pg.GraphicsObject):
 
     Displays a contingency from a `Tree` instance, automatically
     re-sampling to adjust for level of detail.
+
+    The item is drawn from a pyramid of tiles; a tile is the picture of
+    one tree node's cells (re)sampled to the level of detail matching the
+    current view. Only the tiles intersecting the exposed rect are drawn
+    and the rendered tiles are kept in a (bounded) cache. The item is
+    meant to be updated in place (e.g. with a sharpened root); cached
+    tiles of unchanged subtrees are reused.
     """
     #: Density patch shapes
     Rect, RoundRect, Circle = Rect, RoundRect, Circle
     #: Density patch color scale (linear, square root and logarithmic).
-    Linear, Sqrt, Log = 1, 2, 3
+    Linear, Sqrt, Log = density.Linear, density.Sqrt, density.Log
+
+    #: Maximum number of cached tile pictures
+    max_tiles = 4096
 
     def __init__(self, root=None, cell_size=10, cell_shape=Rect,
-                 color_scale=Sqrt, palette=None):
+                 color_scale=Sqrt, palette=None, smoothing=0):
         super().__init__()
         self.setFlag(QGraphicsItem.ItemUsesExtendedStyleOption, True)
         self._root = root
-        self._cache = {}
+        self._depth = None
+        self._level_max = {}
+        self._cache = OrderedDict()
+        self._smoothed = OrderedDict()
         self._cell_size = cell_size
         self._cell_shape = cell_shape
         self._color_scale = color_scale
         self._palette = palette
+        self._smoothing = smoothing
 
     def boundingRect(self):
         return self.rect()
@@ -187,11 +108,32 @@ class DensityPatch(pg.GraphicsObject):
         """
         Set root `Tree` node.
         """
+        if root is self._root:
+            return
         self.prepareGeometryChange()
         self._root = root
-        self._cache.clear()
+        self._depth = None
+        self._level_max.clear()
+        # The smoothed cells depend on their neighbours anywhere in the
+        # tree; the tiles are validated when drawn (see `_tile`)
+        self._smoothed.clear()
         self.update()
 
+    def root(self):
+        return self._root
+
+    def set_palette(self, palette):
+        """
+        Set the palette of the class colors.
+        """
+        if self._palette != palette:
+            self._palette = palette
+            self._cache.clear()
+            self.update()
+
+    def palette(self):
+        return self._palette
+
     def set_cell_shape(self, shape):
         """
         Set the cell shape (Rect, RoundRect or Circle).
@@ -223,239 +165,252 @@ class DensityPatch(pg.GraphicsObject):
     def color_scale(self):
         return self._color_scale
 
-    def paint(self, painter, option, widget):
-        root = self._root
-        if root is None:
-            return
+    def set_smoothing(self, smoothing):
+        """
+        Set the Gaussian smoothing kernel width (in cells, 0 for none).
+        """
+        if self._smoothing != smoothing:
+            self._smoothing = smoothing
+            self.update()
+
+    def smoothing(self):
+        return self._smoothing
 
-        cell_shape, cell_size = self._cell_shape, self._cell_size
+    def sampling_level(self, transform):
+        """
+        Return the sampling level `p` (the tree is drawn resampled with a
+        sample width of `2 ** p`) for the view `transform`.
+        """
+        root = self._root
         nbins = root.nbins
-        T = painter.worldTransform()
-        lod = lod_from_transform(T)
+        if self._depth is None:
+            self._depth = root.depth()
+        lod = lod_from_transform(transform)
         rect = self.rect()
         # sqrt(area) of one cell in object coordinates.
         size1 = np.sqrt(rect.width() * rect.height()) / nbins
-        scale = cell_size / (lod * size1)
+        scale = self._cell_size / (lod * size1)
 
         if np.isinf(scale):
             scale = np.finfo(float).max
 
         p = int(np.floor(np.log2(scale)))
+        return min(max(p, - int(np.log2(nbins ** (self._depth - 1)))),
+                   int(np.log2(nbins)))
+
+    def _level_vmax(self, p):
+        # The maximum of the (smoothed) contingencies drawn at level `p`
+        key = (p, self._smoothing)
+        if key not in self._level_max:
+            if self._smoothing > 0:
+                self._level_max[key] = self._smoothed_max(p)
+            else:
+                self._level_max[key] = \
+                    max_contingency_resampled(self._root, 2 ** p)
+        return self._level_max[key]
+
+    def _scale_func(self, p):
+        return density.color_scale_func(self._color_scale,
+                                        self._level_vmax(p))
+
+    def _smoothed_max(self, p):
+        # The maximum of the smoothed contingencies drawn at level `p`
+        vmax = 0.0
+        for node, path in self._level_tiles(self._root, (), p):
+            node = self._tile_node(node, path, p)
+            ctng = node.contingencies
+            if not node.is_leaf:
+                ctng = ctng[np.equal(node.children, None)]
+            if ctng.size:
+                vmax = max(vmax, ctng.max())
+        return vmax
 
-        p = min(max(p, - int(np.log2(nbins ** (root.depth() - 1)))),
-                int(np.log2(root.nbins)))
-
-        if (p, cell_shape, cell_size) not in self._cache:
-            rs_root = resample(root, 2 ** p)
-            rs_max = max_contingency(rs_root)
-
-            def log_scale(ctng):
-                log_max = np.log(rs_max + 1)
-                log_ctng = np.log(ctng + 1)
-                return log_ctng / log_max
-
-            def sqrt_scale(ctng):
-                sqrt_max = np.sqrt(rs_max)
-                sqrt_ctng = np.sqrt(ctng)
-                return sqrt_ctng / (sqrt_max or 1)
-
-            def lin_scale(ctng):
-                return ctng / (rs_max or 1)
+    def paint(self, painter, option, widget):
+        root = self._root
+        if root is None:
+            return
 
-            scale = {self.Linear: lin_scale, self.Sqrt: sqrt_scale,
-                     self.Log: log_scale}
-            patch = Patch_create(rs_root, palette=self._palette,
-                                 scale=scale[self._color_scale],
-                                 shape=cell_shape)
-            self._cache[p, cell_shape, cell_size] = patch
-        else:
-            patch = self._cache[p, cell_shape, cell_size]
+        p = self.sampling_level(painter.worldTransform())
 
         painter.setRenderHint(QPainter.Antialiasing)
         painter.setPen(Qt.NoPen)
 
-        for picture in picture_intersect(patch, option.exposedRect):
+        for picture in self._tiles_intersect(root, (), p, option.exposedRect):
             picture.play(painter)
 
-#: A visual patch of a Tree 'rendered' as a QPicture
-Patch = namedtuple(
-  "Patch",
-  ["node",      # : Tree # source node (Tree)
-   "picture",   # : () -> QPicture # combined full QPicture
-   "children",  # : () -> Tuple[Patch] # all child subpatches
-   ]
-)
-
-
-class Patch(Patch):
-    @property
-    def is_leaf(self):
-        """Is this a leaf patch (has no children)."""
-        return len(self.children()) == 0
-
-    @property
-    def rect(self):
-        """Patch bounding rectangle as a QRectF."""
-        return QRectF(*self.node.brect)
-
-Some = namedtuple("Some", ["val"])
-
-
-def once(f):
-    cached = None
-
-    def f_once():
-        nonlocal cached
-        if cached is None:
-            cached = Some(f())
-        return cached.val
-    return f_once
-
-
-def picture_intersect(patch, region):
-    """
-    Return a list of all QPictures in `patch` that intersect region.
-    :type patch: Patch
-    :type region: QRectF
-    :rval: List[Patch]
-
-    """
-    if not region.intersects(patch.rect):
-        return []
-    elif region.contains(patch.rect) or patch.is_leaf:
-        return [patch.picture()]
-    else:
-        accum = reduce(
-            operator.iadd,
-            (picture_intersect(child, region) for child in patch.children()),
-            []
-        )
-        return accum
+    def _tiles_intersect(self, node, path, p, region):
+        """
+        Return a list of the tile pictures for `node` (at `path` from the
+        root) and its descendants intersecting `region`, with the tree
+        sampled at level `p`.
+        """
+        brect = QRectF(*node.brect)
+        if not region.intersects(brect):
+            return []
 
+        tiles = [self._tile(node, path, p)]
+        if self._node_level(node, path, p) < 0 and not node.is_leaf:
+            # Descend only into the children intersecting the region
+            xs, xe, ys, ye = bindices(node, region.intersected(brect))
+            for i, j in zip(*np.nonzero(node.children[xs:xe, ys:ye])):
+                i, j = i + xs, j + ys
+                tiles += self._tiles_intersect(
+                    node.children[i, j], path + ((i, j),), p, region)
+        return tiles
+
+    def _level_tiles(self, node, path, p):
+        """
+        Yield the `(node, path)` of all the tiles drawn at level `p`.
+        """
+        yield node, path
+        if self._node_level(node, path, p) < 0 and not node.is_leaf:
+            for i, j in zip(*np.nonzero(np.not_equal(node.children, None))):
+                yield from self._level_tiles(
+                    node.children[i, j], path + ((i, j),), p)
+
+    @staticmethod
+    def _node_level(node, path, p):
+        # The sampling level relative to the node at depth len(path)
+        return p + len(path) * int(np.log2(node.nbins))
+
+    def _tile(self, node, path, p):
+        key = (path, p, self._cell_shape, self._color_scale, self._smoothing)
+        vmax = self._level_vmax(p)
+        # A cached tile is valid for the same node (nodes are immutable
+        # and a new root shares the unchanged subtrees) and maximum. A
+        # smoothed tile also includes its neighbours, so it is only valid
+        # for the same root.
+        owner = self._root if self._smoothing > 0 else node
+        entry = self._cache.get(key)
+        if entry is not None and entry[0] is owner and entry[1] == vmax:
+            self._cache.move_to_end(key)
+            return entry[2]
+        tile_node = self._tile_node(node, path, p)
+        picture = Tree_level_picture(tile_node, palette=self._palette,
+                                     scale=self._scale_func(p),
+                                     shape=self._cell_shape)
+        self._cache[key] = (owner, vmax, picture)
+        self._cache.move_to_end(key)
+        if len(self._cache) > self.max_tiles:
+            self._cache.popitem(last=False)
+        return picture
+
+    def _tile_node(self, node, path, p):
+        # The (resampled and smoothed) node drawn in the tile
+        node_p = self._node_level(node, path, p)
+        if node_p >= 0:
+            # Join 2 ** node_p neighboring bins (the tile is a leaf)
+            node = resample(node, 2 ** node_p)
+        if self._smoothing > 0:
+            node = node._replace(
+                contingencies=self._smoothed_contingencies(node, path, p))
+        return node
 
-def Patch_create(node, palette=None, scale=None, shape=Rect):
+    def _smoothed_contingencies(self, node, path, p):
+        # Smoothed contingencies are cached separately from the tiles so
+        # changing the colors or shape does not recompute them.
+        key = (path, p, self._smoothing)
+        if key in self._smoothed:
+            self._smoothed.move_to_end(key)
+            return self._smoothed[key]
+        # Smooth the tile padded with the neighbouring cells (sampled
+        # from the whole tree at the tile's resolution) so there are no
+        # seams at the tile borders.
+        N, M = node.contingencies.shape[:2]
+        nbins = self._root.nbins
+        row, col = 0, 0
+        for i, j in path:
+            row, col = row * nbins + i, col * nbins + j
+        row, col = row * N, col * M
+        pad = int(np.ceil(3 * self._smoothing))
+        window = Tree_sample(self._root, nbins ** len(path) * N,
+                             (row - pad, row + N + pad),
+                             (col - pad, col + M + pad))
+        smoothed = gaussian_smooth(window, self._smoothing)
+        smoothed = smoothed[pad: pad + N, pad: pad + M]
+        self._smoothed[key] = smoothed
+        if len(self._smoothed) > self.max_tiles:
+            self._smoothed.popitem(last=False)
+        return smoothed
+
+
+def Tree_level_picture(node, palette=None, scale=None, shape=Rect):
     """
-    Return a `Patch` for visualizing `node`.
+    Return a QPicture drawing the contribution from this level of `node`
+    only.
 
-    .. note::
-        The patch (picture and children fields) are evaluated lazily.
+    This is all regions where the contingency is not empty and does not
+    have a computed sub-contingency (i.e. the node does not have a child
+    in that cell).
 
     :type node: Tree
     :type palette: colorpalette.PaletteGenerator
     :type scale: nparray -> ndarray
     :type shape: int
-    :rtype: Patch
-
+    :rtype: QPicture
     """
+    pic = QPicture()
     if node.is_empty:
-        return Patch(node, once(lambda: QPicture()), once(lambda: ()))
-    else:
-        @once
-        def picture_this_level():
-            # Create a QPicture drawing the contribution from this
-            # level only. This is all regions where the contingency is
-            # not empty and does not have a computed sub-contingency
-            # (i.e. the node does not have a child in that cell).
-
-            pic = QPicture()
-            painter = QPainter(pic)
-            ctng = node.contingencies
-            colors = create_image(ctng, palette, scale=scale)
-            x, y, w, h = node.brect
-            N, M = ctng.shape[:2]
-
-            # Nonzero contingency mask
-            any_mask = Node_mask(node)
+        return pic
 
-            if node.is_leaf:
-                skip = itertools.repeat(False)
-            else:
-                # Skip all None children they were already painted.
-                skip = (ch is not None for ch in node.children.flat)
-
-            painter.save()
-            painter.translate(x, y)
-            painter.scale(w / node.nbins, h / node.nbins)
-
-            indices = itertools.product(range(N), range(M))
-            for (i, j), skip, any_ in zip(indices, skip, any_mask.flat):
-                if not skip and any_:
-                    painter.setBrush(QColor(*colors[i, j]))
-                    if shape == Rect:
-                        painter.drawRect(i, j, 1, 1)
-                    elif shape == Circle:
-                        painter.drawEllipse(i, j, 1, 1)
-                    elif shape == RoundRect:
-                        painter.drawRoundedRect(i, j, 1, 1, 25.0, 25.0,
-                                                Qt.RelativeSize)
-            painter.restore()
-            painter.end()
-            return pic
-
-        @once
-        def child_patches():
-            # Return a tuple of all non empty child patches for this node.
-            if node.is_leaf:
-                children = []
-            else:
-                children = filter(is_not_none, node.children.flat)
-            return tuple(Patch_create(child, palette, scale, shape)
-                         for child in children) + \
-                   (Patch(node, picture_this_level, once(lambda: ())),)
-
-        @once
-        def picture_children():
-            # Return a QPicture displaying all children patches of this
-            # node.
-            pic = QPicture()
-            painter = QPainter(pic)
-            for ch in child_patches():
-                painter.drawPicture(0, 0, ch.picture())
-            painter.end()
-            return pic
-
-        return Patch(node, picture_children, child_patches)
-
-
-def resample(node, samplewidth):
+    painter = QPainter(pic)
+    ctng = node.contingencies
+    class_colors = None
+    if ctng.ndim == 3:
+        ncol = ctng.shape[-1]
+        if palette is None:
+            palette = colorpalette.ColorPaletteGenerator(ncol)
+        class_colors = [[c.red(), c.green(), c.blue()]
+                        for c in (palette[i] for i in range(ncol))]
+    colors = create_image(ctng, class_colors, scale=scale)
+    x, y, w, h = node.brect
+    N, M = ctng.shape[:2]
+
+    # Nonzero contingency mask
+    any_mask = Node_mask(node)
+
+    if not node.is_leaf:
+        # Skip all None children they were already painted.
+        any_mask &= np.equal(node.children, None)
+
+    painter.save()
+    painter.translate(x, y)
+    painter.scale(w / node.nbins, h / node.nbins)
+
+    if shape == Rect:
+        # Draw the whole level as one (unsmoothed) scaled image
+        argb = argb_image_data(colors, any_mask)
+        image = QImage(argb.data, N, M, argb.strides[0],
+                       QImage.Format_ARGB32_Premultiplied)
+        painter.setRenderHint(QPainter.SmoothPixmapTransform, False)
+        painter.drawImage(QRectF(0, 0, N, M), image)
+    else:
+        for i, j in zip(*np.nonzero(any_mask)):
+            painter.setBrush(QColor(*colors[i, j]))
+            if shape == Circle:
+                painter.drawEllipse(i, j, 1, 1)
+            elif shape == RoundRect:
+                painter.drawRoundedRect(i, j, 1, 1, 25.0, 25.0,
+                                        Qt.RelativeSize)
+    painter.restore()
+    painter.end()
+    return pic
+
+
+def argb_image_data(colors, mask):
     """
-    Resample/aggregate the node's contingency, joining `samplewidth` bins.
-
-    `samplewidth` is the number of bins which should be joined and MUST
-    be a power of 2.
-
-    If `samplewidth` == 1 then return the node as is. If larger then
-    1 then sum `samplewidth` neighboring contingency cells returning a
-    new node with shape ``(nbins//samplewidth, nbins//samplewidth)``.
-    If smaller then 1 (i.e. undersampled) recurse into node's
-    subcontingencies with a samplewidth * nbins
+    Return a (M, N) uint32 premultiplied ARGB array for an (N, M, 3)
+    `colors` array (as returned by `create_image`), transparent where
+    `mask` is False.
 
+    The returned array is C contiguous and can be wrapped in a `QImage`
+    (pixel `(i, j)` is `colors[i, j]`) without copying.
     """
-    assert 0 < samplewidth <= node.nbins
-    assert int(np.log2(samplewidth)) == np.log2(samplewidth)
-
-    if samplewidth == 1:
-        return node._replace(children=None)
-    elif samplewidth > 1:
-        samplewidth = int(samplewidth)
-        ctng = blockshaped(node.contingencies, samplewidth, samplewidth)
-        ctng = ctng.sum(axis=(2, 3))
-        assert ctng.shape[0] == node.nbins // samplewidth
-        return Tree(node.xbins[::samplewidth],
-                    node.ybins[::samplewidth],
-                    ctng,
-                    None)
-    elif node.is_leaf:
-        return Tree(*node)
-    else:
-        nbins = node.nbins
-        children = [resample(ch, samplewidth * nbins)
-                    if ch is not None else None
-                    for ch in node.children.flat]
-
-        children_ar = np.full(nbins ** 2, None, dtype=object)
-        children_ar[:] = children
-        return node._replace(children=children_ar.reshape((-1, nbins)))
+    colors = np.asarray(colors, dtype=np.uint32)
+    argb = (0xFF000000 | colors[..., 0] << 16 | colors[..., 1] << 8 |
+            colors[..., 2])
+    argb = np.where(mask, argb, 0).astype(np.uint32)
+    return np.ascontiguousarray(argb.T)
 
 
 class OWScatterMap(widget.OWWidget):
@@ -476,14 +431,24 @@ class OWScatterMap(widget.OWWidget):
     selected_z_values = settings.ContextSetting([])
 
     color_scale = settings.Setting(1)
+    smoothing_index = settings.Setting(0)
     sample_level = settings.Setting(0)
+    #: Bin SqlTable data in the database instead of binning a sample
+    sql_binning = settings.Setting(True)
 
     sample_percentages = []
     sample_percentages_captions = []
     sample_times = [0.5, 3, 5, 20, 40, 80]
     sample_times_captions = ['1 s', '5 s', '10 s', '30 s', '1 min', '2 min']
 
+    #: Smoothing kernel widths (in displayed cells)
+    smoothing_widths = [0, 0.5, 1, 2]
+    smoothing_captions = ["None", "Low", "Medium", "High"]
+
+    #: Store the density maps on disk
     use_cache = settings.Setting(True)
+    #: Memory budget for the density map cache
+    cache_memory = 256 * 2 ** 20
 
     n_bins = 2 ** 4
 
@@ -493,6 +458,7 @@ class OWScatterMap(widget.OWWidget):
 
     class Error(widget.OWWidget.Error):
         no_values = Msg("Feature {} has no values.")
+        sharpen_failed = Msg("Sharpening failed: {}")
 
     def __init__(self):
         super().__init__()
@@ -503,7 +469,17 @@ class OWScatterMap(widget.OWWidget):
         self._root = None
         self._displayed_root = None
         self._item = None
-        self._cache = {}
+        #: The root, the selected class values and the root restricted
+        #: to them (the last displayed with a selection of class values)
+        self._taken = (None, None, None)
+        #: Digests of columns used by density trees (None for SqlTable)
+        self._digests = None
+        self._cache = TreeCache(
+            max_memory=self.cache_memory,
+            directory=os.path.join(cache_dir(), "scattermap"))
+        self._index_cache = {}
+        self._task = None  # type: Optional[self.Task]
+        self._executor = ThreadExecutor(self)
 
         self.colors = colorpalette.ColorPaletteGenerator(10)
 
@@ -538,8 +514,20 @@ class OWScatterMap(widget.OWWidget):
                      orientation=Qt.Horizontal,
                      items=["Linear", "Square root", "Logarithmic"],
                      callback=self._on_color_scale_changed)
+        gui.comboBox(box, self, "smoothing_index", label="Smoothing: ",
+                     orientation=Qt.Horizontal,
+                     items=self.smoothing_captions,
+                     tooltip="Show a kernel density estimate instead of "
+                             "the bin counts",
+                     callback=self._on_smoothing_changed)
 
         self.sampling_box = gui.vBox(self.controlArea, "Sampling")
+        self.sql_binning_check = gui.checkBox(
+            self.sampling_box, self, "sql_binning",
+            "Compute exact density in database",
+            tooltip="Count the bins of the full table with SQL queries\n"
+                    "instead of fetching and binning a sample.",
+            callback=self.update_sample)
         sampling_options = (self.sample_times_captions +
                             self.sample_percentages_captions)
         self.sample_combo = gui.comboBox(
@@ -547,6 +535,10 @@ class OWScatterMap(widget.OWWidget):
             callback=self.update_sample)
         gui.button(self.sampling_box, self, "Sharpen", self.sharpen)
 
+        gui.checkBox(self.controlArea, self, "use_cache",
+                     "Store density maps on disk", box="Cache",
+                     callback=self._on_use_cache_changed)
+
         gui.rubber(self.controlArea)
 
         self.plot = pg.PlotWidget(background="w")
@@ -587,18 +579,26 @@ class OWScatterMap(widget.OWWidget):
         if isinstance(dataset, SqlTable):
             self.original_data = dataset
             self.sample_level = 0
-            self.sample_combo.setEnabled(True)
+            self.sql_binning_check.setEnabled(True)
             self.update_sample()
         else:
             self.dataset = dataset
             self.sample_combo.setCurrentIndex(-1)
             self.sample_combo.setEnabled(False)
+            self.sql_binning_check.setEnabled(False)
             self.set_sampled_data(self.dataset)
 
     def update_sample(self):
         self.closeContext()
         self.clear()
 
+        self.sample_combo.setEnabled(not self.sql_binning)
+        if self.sql_binning:
+            # The bins are counted in the database (see `grid_bin_sql`)
+            self.dataset = self.original_data
+            self.set_sampled_data(self.dataset)
+            return
+
         if self.sample_level < len(self.sample_times):
             sample_type = 'time'
             level = self.sample_times[self.sample_level]
@@ -651,9 +651,12 @@ class OWScatterMap(widget.OWWidget):
                 item.setIcon(colorpalette.ColorPixmap(self.colors[i]))
 
         self.error("Data contains no continuous features", shown=not cvars)
+        if not isinstance(dataset, SqlTable):
+            self._digests = {}
         self.setup_plot()
 
     def clear(self):
+        self.cancel()
         self.dataset = None
         self.x_var_model[:] = []
         self.y_var_model[:] = []
@@ -662,7 +665,12 @@ class OWScatterMap(widget.OWWidget):
         self._root = None
         self._displayed_root = None
         self._item = None
-        self._cache = {}
+        self._taken = (None, None, None)
+        if self._digests is None:
+            # Trees of data without a digest can not be told apart
+            self._cache.clear()
+        self._digests = None
+        self._index_cache = {}
         self.plot.clear()
         self.clear_messages()
 
@@ -687,9 +695,17 @@ class OWScatterMap(widget.OWWidget):
         if self._displayed_root is not None:
             self.update_map(self._displayed_root)
 
+    def _on_smoothing_changed(self):
+        if self._item is not None:
+            self._item.set_smoothing(
+                self.smoothing_widths[self.smoothing_index])
+
     def setup_plot(self):
         """Setup the density map plot"""
+        self.cancel()
         self.plot.clear()
+        self._item = None
+        self._taken = (None, None, None)
         self.clear_messages()
         self.x_var_index = min(self.x_var_index, len(self.x_var_model) - 1)
         self.y_var_index = min(self.y_var_index, len(self.y_var_model) - 1)
@@ -710,18 +726,40 @@ class OWScatterMap(widget.OWWidget):
         axis = self.plot.getAxis("left")
         axis.setLabel(yvar.name)
 
-        if (xvar, yvar, zvar) in self._cache:
-            root = self._cache[xvar, yvar, zvar]
-        else:
+        key = self._cache_key(xvar, yvar, zvar)
+        root = self._cache.get(key)
+        if root is None:
             root = self.get_root(data, xvar, yvar, zvar)
             if root is None:
                 return
-            self._cache[xvar, yvar, zvar] = root
+            self._cache.put(key, root, persist=self.use_cache)
 
         self._root = root
 
         self.update_map(root)
 
+    def _cache_key(self, xvar, yvar, zvar=None):
+        names = (xvar.name, yvar.name, zvar.name if zvar is not None else None)
+        digest = None
+        if self._digests is not None:
+            digest = self._digests.get(names)
+            if digest is None:
+                variables = [var for var in (xvar, yvar, zvar)
+                             if var is not None]
+                digest = columns_digest(self.dataset, variables)
+                self._digests[names] = digest
+        return (digest,) + names + (self.n_bins,)
+
+    def _on_use_cache_changed(self):
+        if self.use_cache and self._root is not None:
+            xvar = self.x_var_model[self.x_var_index]
+            yvar = self.y_var_model[self.y_var_index]
+            if 0 <= self.z_var_index < len(self.z_var_model):
+                zvar = self.z_var_model[self.z_var_index]
+            else:
+                zvar = None
+            self._cache.persist(self._cache_key(xvar, yvar, zvar))
+
     def get_root(self, data, xvar, yvar, zvar=None):
         """Compute the root density map item"""
         assert self.n_bins > 2
@@ -754,16 +792,54 @@ class OWScatterMap(widget.OWWidget):
         xbins1 = np.r_[-np.inf, xbins[1:-1], np.inf]
         ybins1 = np.r_[-np.inf, ybins[1:-1], np.inf]
 
-        t = grid_bin(data, xvar, yvar, xbins1, ybins1, zvar=zvar)
+        bin_func = self.grid_bin_func(data, xvar, yvar, zvar)
+        t = bin_func(xbins1, ybins1)
         return t._replace(xbins=xbins, ybins=ybins)
 
+    def spatial_index(self, data, xvar, yvar):
+        """Return the (cached) `SpatialIndex` for the `xvar`, `yvar` pair."""
+        key = (xvar, yvar)
+        if key not in self._index_cache:
+            x = data.get_column_view(xvar)[0]
+            y = data.get_column_view(yvar)[0]
+            self._index_cache[key] = SpatialIndex(x, y)
+        return self._index_cache[key]
+
+    def grid_bin_func(self, data, xvar, yvar, zvar=None):
+        """
+        Return a `(xbins, ybins) -> Tree` binning function for the data.
+
+        In memory data is binned through a spatial index built once per
+        (xvar, yvar) pair, so refining a cell only touches the points
+        inside it. SQL data is binned in the database.
+        """
+        if isinstance(data, SqlTable):
+            def bin_func(xbins, ybins):
+                return grid_bin_sql(data, xvar, yvar, xbins, ybins, zvar)
+            return bin_func
+
+        index = self.spatial_index(data, xvar, yvar)
+        if zvar is not None and zvar.is_discrete:
+            zcol = data.get_column_view(zvar)[0].astype(float)
+            nvalues = len(zvar.values)
+        else:
+            zcol, nvalues = None, 0
+
+        def bin_func(xbins, ybins):
+            return grid_bin_indexed(index, xbins, ybins, zcol, nvalues)
+        return bin_func
+
     def replot(self):
         self.setup_plot()
 
     def update_map(self, root):
-        self.plot.clear()
-        self._item = None
+        """
+        Display `root` (with the selected class values).
 
+        The density item is updated in place, so its cached tiles are
+        reused; it is only recreated by `setup_plot` (for new data or
+        axes).
+        """
         self._displayed_root = root
 
         palette = self.colors
@@ -785,70 +861,40 @@ class OWScatterMap(widget.OWWidget):
 
         if contingencies.ndim == 3:
             if not self.selected_z_values:
+                if self._item is not None:
+                    self.plot.removeItem(self._item)
+                    self._item = None
                 return
 
             _, _, k = contingencies.shape
 
-            if self.selected_z_values != list(range(k)):
-                palette = [palette[i] for i in self.selected_z_values]
-                root = Tree_take(root, self.selected_z_values, 2)
-
-        self._item = item = DensityPatch(
-            root, cell_size=10,
-            cell_shape=DensityPatch.Rect,
-            color_scale=self.color_scale + 1,
-            palette=palette
-        )
-        self.plot.addItem(item)
-
-    def sharpen(self):
-        viewb = self.plot.getViewBox()
-        rect = viewb.boundingRect()
-        p1 = viewb.mapToView(rect.topLeft())
-        p2 = viewb.mapToView(rect.bottomRight())
-        rect = QRectF(p1, p2).normalized()
-
-        self.sharpen_region(rect)
-
-    def sharpen_root_region(self, region):
-        data = self.dataset
-        xvar = self.x_var_model[self.x_var_index]
-        yvar = self.y_var_model[self.y_var_index]
+            selected = list(self.selected_z_values)
+            if selected != list(range(k)):
+                palette = [palette[i] for i in selected]
+                if self._taken[0] is not root or \
+                        self._taken[1] != selected:
+                    self._taken = \
+                        (root, selected, Tree_take(root, selected, 2))
+                root = self._taken[2]
 
-        if 0 <= self.z_var_index < len(self.z_var_model):
-            zvar = self.z_var_model[self.z_var_index]
+        smoothing = self.smoothing_widths[self.smoothing_index]
+        if self._item is None:
+            self._item = DensityPatch(
+                root, cell_size=10,
+                cell_shape=DensityPatch.Rect,
+                color_scale=self.color_scale + 1,
+                palette=palette,
+                smoothing=smoothing
+            )
+            self.plot.addItem(self._item)
         else:
-            zvar = None
+            self._item.set_root(root)
+            self._item.set_color_scale(self.color_scale + 1)
+            self._item.set_palette(palette)
+            self._item.set_smoothing(smoothing)
 
-        root = self._root
-
-        if not QRectF(*root.brect).intersects(region):
-            return
-
-        nbins = self.n_bins
-
-        def bin_func(xbins, ybins):
-            return grid_bin(data, xvar, yvar, xbins, ybins, zvar)
-
-        last_node = root
-        update_time = time.time()
-        changed = False
-
-        with self.progressBar(nbins ** 2) as progress_bar:
-            for i, node in enumerate(
-                    sharpen_region(self._root, region, nbins, bin_func)):
-                tick = time.time() - update_time
-                changed = changed or node is not last_node
-                if changed and ((i % nbins == 0) or tick > 2.0):
-                    self.update_map(node)
-                    last_node = node
-                    changed = False
-                    update_time = time.time()
-                    progress_bar.advance()
-
-        self._root = last_node
-        self._cache[xvar, yvar, zvar] = self._root
-        self.update_map(self._root)
+    def sharpen(self):
+        self.sharpen_region(self._view_rect())
 
     def _sampling_width(self):
         if self._item is None:
@@ -869,6 +915,7 @@ class OWScatterMap(widget.OWWidget):
         return 2 ** int(p)
 
     def sharpen_region(self, region):
+        self.cancel()
         data = self.dataset
         root = self._root
         nbins = self.n_bins
@@ -887,8 +934,7 @@ class OWScatterMap(widget.OWWidget):
         if not QRectF(*root.brect).intersects(region):
             return
 
-        def bin_func(xbins, ybins):
-            return grid_bin(data, xvar, yvar, xbins, ybins, zvar)
+        bin_func = self.grid_bin_func(data, xvar, yvar, zvar)
 
         def min_depth(node, region):
             if not region.intersects(QRectF(*node.brect)):
@@ -917,35 +963,126 @@ class OWScatterMap(widget.OWWidget):
         nodes = self.select_nodes_to_sharpen(self._root, region, bw,
                                              depth + 1)
 
-        def update_rects(node):
-            scored = score_candidate_rects(node, region)
-            ind1 = set(zip(*Node_nonzero(node)))
-            ind2 = set(zip(*node.children.nonzero())) \
-                   if not node.is_leaf else set()
-            ind = ind1 - ind2
-            return [(score, r) for score, i, j, r in scored if (i, j) in ind]
-
-        scored_rects = reduce(operator.iadd, map(update_rects, nodes), [])
-        scored_rects = sorted(scored_rects, reverse=True,
-                              key=operator.itemgetter(0))
+        candidates = [score_candidate_rects(node, region) for node in nodes]
+        if not candidates:
+            return
+        scores, rows, cols = map(np.concatenate, zip(*candidates))
+        if not scores.size:
+            return
+        node_index = np.repeat(np.arange(len(nodes)),
+                               [c[0].size for c in candidates])
+        # A stable sort by descending score
+        order = np.argsort(-scores, kind="mergesort")
+        rects = [QRectF(*cell_rect(nodes[n], i, j)).intersected(region)
+                 for n, i, j in zip(node_index[order], rows[order],
+                                    cols[order])]
+
+        # Cells are refined concurrently on the (immutable) current root
+        # and the binned subtrees are merged back on this thread in order
+        # of score (see `_on_sharpen_cell_done`).
+        self.Error.sharpen_failed.clear()
+        self._task = task = self.Task()
+        task.key = self._cache_key(xvar, yvar, zvar)
+        task.region = region
+        task.depth = depth + 1
+        task.bin_func = bin_func
+        task.rects = rects
+        task.update_time = time.time()
+
+        self.progressBarInit()
+        for rect in task.rects:
+            future = self._executor.submit(
+                sharpen_cell_bins, root, rect, nbins, task.depth, bin_func,
+                lambda: task.cancelled)
+            watcher = FutureWatcher(future)
+            watcher.done.connect(self._on_sharpen_cell_done)
+            task.futures.append(future)
+            task.watchers.append(watcher)
+
+    class Task:
+        key = ...  # type: tuple
+        region = ...  # type: QRectF
+        depth = ...  # type: int
+        bin_func = ...  # type: Callable[[np.ndarray, np.ndarray], Tree]
+        rects = ...  # type: List[QRectF]
+        update_time = ...  # type: float
+        cancelled = False  # type: bool
+
+        def __init__(self):
+            self.futures = []  # type: List[concurrent.futures.Future]
+            self.watchers = []  # type: List[FutureWatcher]
+            #: Index of the next result to merge into the tree
+            self.merged = 0
+
+        def cancel(self):
+            """Cancel the task without waiting for the running futures.
+
+            They check `cancelled` and stop early; their late results are
+            dropped (see `OWScatterMap._on_sharpen_cell_done`).
+            """
+            self.cancelled = True
+            for future in self.futures:
+                future.cancel()
+
+    def cancel(self):
+        """Cancel the running sharpening task (if any).
+
+        Subtrees that were already merged into the displayed root are kept.
+        """
+        if self._task is not None:
+            task = self._task
+            task.cancel()
+            for watcher in task.watchers:
+                watcher.done.disconnect(self._on_sharpen_cell_done)
+            self._task = None
+            self.progressBarFinished()
+            if self.use_cache and task.merged:
+                self._cache.persist(task.key)
+
+    @Slot(concurrent.futures.Future)
+    def _on_sharpen_cell_done(self, future):
+        assert self.thread() is QThread.currentThread()
+        task = self._task
+        # A (queued) result of a cancelled task
+        if task is None or future not in task.futures:
+            return
+
         root = self._root
-        update_time = time.time()
-
-        with self.progressBar(len(scored_rects)) as progress_bar:
-            for i, (_, rect) in enumerate(scored_rects):
-                root = sharpen_region_recur(
-                    root, rect.intersected(region),
-                    nbins, depth + 1, bin_func)
-                tick = time.time() - update_time
-                if tick > 2.0:
-                    self.update_map(root)
-                    update_time = time.time()
-                progress_bar.advance()
+        # Merge all finished results in order of score.
+        while task.merged < len(task.futures) and \
+                task.futures[task.merged].done():
+            future, rect = task.futures[task.merged], task.rects[task.merged]
+            task.merged += 1
+            if future.cancelled():
+                continue
+            try:
+                bins = future.result()
+            except Exception as err:  # pylint: disable=broad-except
+                # Keep the cells merged so far and stop the task
+                self._root = root
+                self._cache.put(task.key, root, persist=False)
+                self.cancel()
+                self.Error.sharpen_failed(str(err))
+                self.update_map(root)
+                return
+            root = sharpen_region_recur(
+                root, rect, self.n_bins, task.depth,
+                lookup_bin_func(bins, task.bin_func))
 
         self._root = root
-
-        self._cache[xvar, yvar, zvar] = self._root
-        self.update_map(self._root)
+        # The tree is written to disk only when done (or cancelled)
+        self._cache.put(task.key, root, persist=False)
+        self.progressBarSet(100 * task.merged / len(task.futures))
+
+        if task.merged == len(task.futures):
+            self._task = None
+            self.progressBarFinished()
+            if self.use_cache:
+                self._cache.persist(task.key)
+            self.update_map(root)
+        elif time.time() - task.update_time > 2.0:
+            self.update_map(root)
+            task.update_time = time.time()
 
     def select_nodes_to_sharpen(self, node, region, bw, depth):
         """
@@ -966,19 +1103,14 @@ class OWScatterMap(widget.OWWidget):
             return [node]
         else:
             xs, xe, ys, ye = bindices(node, region)
-
-            def intersect_indices(rows, cols):
-                mask = (xs <= rows) & (rows < xe) & (ys <= cols) & (cols < ye)
-                return rows[mask], cols[mask]
-
-            indices1 = intersect_indices(*Node_nonzero(node))
-            indices2 = intersect_indices(*node.children.nonzero())
+            children = node.children[xs: xe, ys: ye]
+            expanded = np.not_equal(children, None)
             # If there are any non empty and non expanded cells in the
             # intersection return the node for sharpening, ...
-            if np.any(np.array(indices1) != np.array(indices2)):
+            if np.any(Node_mask(node)[xs: xe, ys: ye] & ~expanded):
                 return [node]
 
-            children = node.children[indices2]
+            children = children[expanded]
             # ... else run down the children in the intersection
             return reduce(operator.iadd,
                           (self.select_nodes_to_sharpen(
@@ -986,11 +1118,30 @@ class OWScatterMap(widget.OWWidget):
                            for ch in children.flat),
                           [])
 
+    def _view_rect(self):
+        viewb = self.plot.getViewBox()
+        rect = viewb.boundingRect()
+        p1 = viewb.mapToView(rect.topLeft())
+        p2 = viewb.mapToView(rect.bottomRight())
+        return QRectF(p1, p2).normalized()
+
     def _on_transform_changed(self, *args):
-        pass
+        # Cancel the sharpening if the user panned or zoomed away from the
+        # region being sharpened.
+        if self._task is None:
+            return
+        region, view = self._task.region, self._view_rect()
+        area = region.width() * region.height()
+        common = region.intersected(view)
+        if not area or \
+                common.width() * common.height() < area / 2 or \
+                not area / 2 <= view.width() * view.height() <= area * 2:
+            self.cancel()
+            self.update_map(self._root)
 
     def onDeleteWidget(self):
         self.clear()
+        self._executor.shutdown(wait=True)
         super().onDeleteWidget()
 
     def get_widget_name_extension(self):
@@ -1011,370 +1162,6 @@ class OWScatterMap(widget.OWWidget):
         self.report_caption(caption)
 
 
-def grid_bin(data, xvar, yvar, xbins, ybins, zvar=None):
-    x_disc = Discretizer.create_discretized_var(xvar, xbins[1:-1])
-    y_disc = Discretizer.create_discretized_var(yvar, ybins[1:-1])
-
-    x_min, x_max = xbins[0], xbins[-1]
-    y_min, y_max = ybins[0], ybins[-1]
-
-    querydomain = [x_disc, y_disc]
-    if zvar is not None:
-        querydomain = querydomain + [zvar]
-
-    querydomain = Orange.data.Domain(querydomain)
-
-    def interval_filter(var, low, high):
-        return Orange.data.filter.Values(
-            [Orange.data.filter.FilterContinuous(
-                 var, max=high, min=low,
-                 oper=Orange.data.filter.FilterContinuous.Between)]
-        )
-
-    def value_filter(var, val):
-        return Orange.data.filter.Values(
-            [Orange.data.filter.FilterDiscrete(var, [val])]
-        )
-
-    def filters_join(filters):
-        return Orange.data.filter.Values(
-            reduce(list.__iadd__, (f.conditions for f in filters), [])
-        )
-
-    inf_bounds = np.isinf([x_min, x_max, y_min, y_max])
-    if not all(inf_bounds):
-        # No need to filter the data
-        range_filters = [interval_filter(xvar, x_min, x_max),
-                         interval_filter(yvar, y_min, y_max)]
-        range_filter = filters_join(range_filters)
-        subset = range_filter(data)
-    else:
-        subset = data
-
-    if zvar and zvar.is_discrete:
-        filters = [value_filter(zvar, val) for val in zvar.values]
-        contingencies = [
-            contingency.get_contingency(
-                filter_(subset.from_table(querydomain, subset)),
-                col_variable=y_disc, row_variable=x_disc
-            )
-            for filter_ in filters
-        ]
-        contingencies = np.dstack(contingencies)
-    else:
-        contingencies = contingency.get_contingency(
-            subset.from_table(querydomain, subset),
-            col_variable=y_disc, row_variable=x_disc
-        )
-
-    contingencies = np.asarray(contingencies)
-    return Tree(xbins, ybins, contingencies, None)
-
-
-def sharpen_node_cell(node, i, j, nbins, gridbin_func):
-    if node.is_leaf:
-        children = np.full((nbins, nbins), None, dtype=object)
-    else:
-        children = np.array(node.children, dtype=None)
-
-    xbins = np.linspace(node.xbins[i], node.xbins[i + 1], nbins + 1)
-    ybins = np.linspace(node.ybins[j], node.ybins[j + 1], nbins + 1)
-
-    if node.contingencies[i, j].any():
-        t = gridbin_func(xbins, ybins)
-        assert t.contingencies.shape[:2] == (nbins, nbins)
-        children[i, j] = t
-        return node._replace(children=children)
-    else:
-        return node
-
-
-def sharpen_node_cell_range(node, xrange, yrange, nbins, gridbin_func):
-    if node.is_leaf:
-        children = np.full((nbins, nbins), None, dtype=object)
-    else:
-        children = np.array(node.children, dtype=None)
-
-    xs, xe = xrange.start, xrange.stop
-    ys, ye = yrange.start, yrange.stop
-
-    xbins = np.linspace(node.xbins[xs], node.xbins[xe], (xe - xs) * nbins + 1)
-    ybins = np.linspace(node.ybins[ys], node.ybins[ye], (ye - ys) * nbins + 1)
-
-    if node.contingencies[xs: xe, ys: ye].any():
-        t = gridbin_func(xbins, ybins)
-        for i, j in itertools.product(range(xs, xe), range(ys, ye)):
-            children[i, j] = Tree(t.xbins[i * nbins: (i + 1) * nbins + 1],
-                                  t.ybins[j * nbins: (j + 1) * nbins + 1],
-                                  t.contingencies[xs: xe, ys: ye])
-            assert children[i, j].shape[:2] == (nbins, nbins)
-        return node._replace(children=children)
-    else:
-        return node
-
-
-def sharpen_region(node, region, nbins, gridbin_func):
-    if not QRectF(*node.brect).intersects(region):
-        raise ValueError()
-#         return node
-
-    xs, xe, ys, ye = bindices(node, region)
-    ndim = node.contingencies.ndim
-
-    if node.children is not None:
-        children = np.array(node.children, dtype=object)
-        assert children.ndim == 2
-    else:
-        children = np.full((nbins, nbins), None, dtype=object)
-
-    if ndim == 3:
-        # compute_chisqares expects classes in 1 dim
-        c = node.contingencies
-        chi_lr, chi_up = compute_chi_squares(
-            c[xs: xe, ys: ye, :].swapaxes(1, 2).swapaxes(0, 1)
-        )
-
-        def max_chisq(i, j):
-            def valid(i, j):
-                return 0 <= i < chi_up.shape[0] and \
-                       0 <= j < chi_lr.shape[1]
-
-            return max(chi_lr[i, j] if valid(i, j) else 0,
-                       chi_lr[i, j - 1] if valid(i, j - 1) else 0,
-                       chi_up[i, j] if valid(i, j) else 0,
-                       chi_up[i - 1, j] if valid(i - 1, j) else 0)
-
-        heap = [(-max_chisq(i - xs, j - ys), (i, j))
-                for i in range(xs, xe)
-                for j in range(ys, ye)
-                if children[i, j] is None]
-    else:
-        heap = list(enumerate((i, j)
-                    for i in range(xs, xe)
-                    for j in range(ys, ye)
-                    if children[i, j] is None))
-
-    heap = sorted(heap)
-    update_node = node
-    while heap:
-        _, (i, j) = heapq.heappop(heap)
-
-        xbins = np.linspace(node.xbins[i], node.xbins[i + 1], nbins + 1)
-        ybins = np.linspace(node.ybins[j], node.ybins[j + 1], nbins + 1)
-
-        if node.contingencies[i, j].any():
-            t = gridbin_func(xbins, ybins)
-            assert t.contingencies.shape[:2] == (nbins, nbins)
-        else:
-            t = None
-
-        children[i, j] = t
-        if t is None:
-            yield update_node
-        else:
-            update_node = update_node._replace(
-                children=np.array(children, dtype=object)
-            )
-            yield update_node
-
-
-def Node_mask(node):
-    if node.contingencies.ndim == 3:
-        return node.contingencies.any(axis=2)
-    else:
-        return node.contingencies > 0
-
-
-def Node_nonzero(node):
-    return np.nonzero(Node_mask(node))
-
-
-def sharpen_region_recur(node, region, nbins, depth, gridbin_func):
-    if depth <= 1:
-        return node
-    elif not QRectF(*node.brect).intersects(region):
-        return node
-    elif node.is_empty:
-        return node
-    elif node.is_leaf:
-        xs, xe, ys, ye = bindices(node, region)
-        # indices in need of update
-        indices = Node_nonzero(node)
-        for i, j in zip(*indices):
-            if xs <= i < xe and ys <= j < ye:
-                node = sharpen_node_cell(node, i, j, nbins, gridbin_func)
-
-        # if the exposed region is empty the node.is_leaf property
-        # is preserved
-        if node.is_leaf:
-            return node
-
-        return sharpen_region_recur(node, region, nbins, depth, gridbin_func)
-    else:
-        xs, xe, ys, ye = bindices(node, region)
-
-        # indices is need of update
-        indices1 = Node_nonzero(node)
-        indices2 = node.children.nonzero()
-        indices = sorted(set(list(zip(*indices1))) - set(list(zip(*indices2))))
-
-        for i, j in indices:
-            if xs <= i < xe and ys <= j < ye:
-                node = sharpen_node_cell(node, i, j, nbins, gridbin_func)
-
-        children = np.array(node.children, dtype=object)
-        children[xs: xe, ys: ye] = [
-            [sharpen_region_recur(ch, region, nbins, depth - 1, gridbin_func)
-             if ch is not None else None
-             for ch in row]
-            for row in np.array(children[xs: xe, ys: ye])
-        ]
-        return node._replace(children=children)
-
-
-def stack_tile_blocks(blocks):
-    return np.vstack(list(map(np.hstack, blocks)))
-
-
-def bindices(node, rect):
-    assert rect.normalized() == rect
-    assert not rect.intersected(QRectF(*node.brect)).isEmpty()
-
-    xs = np.searchsorted(node.xbins, rect.left(), side="left") - 1
-    xe = np.searchsorted(node.xbins, rect.right(), side="right")
-    ys = np.searchsorted(node.ybins, rect.top(), side="left") - 1
-    ye = np.searchsorted(node.ybins, rect.bottom(), side="right")
-
-    return np.clip([xs, xe, ys, ye],
-                   [0, 0, 0, 0],
-                   [node.xbins.size - 2, node.xbins.size - 1,
-                    node.ybins.size - 2, node.ybins.size - 1])
-
-
-def create_image(contingencies, palette=None, scale=None):
-#     import scipy.signal
-#     import scipy.ndimage
-
-    if scale is None:
-        scale = lambda c: c / (contingencies.max() or 1)
-
-    P = scale(contingencies)
-
-#     if scale > 0:
-#         P = contingencies / scale
-#     else:
-#         P = contingencies
-
-#     nbins = node.xbins.shape[0] - 1
-#     smoothing = 32
-#     bandwidth = nbins / smoothing
-
-    if P.ndim == 3:
-        ncol = P.shape[-1]
-        if palette is None:
-            palette = colorpalette.ColorPaletteGenerator(ncol)
-        colors = [palette[i] for i in range(ncol)]
-        colors = np.array(
-            [[c.red(), c.green(), c.blue()] for c in colors]
-        )
-#         P = scipy.ndimage.filters.gaussian_filter(
-#             P, bandwidth, mode="constant")
-#         P /= P.max()
-
-        argmax = np.argmax(P, axis=2)
-        irow, icol = np.indices(argmax.shape)
-        P_max = P[irow, icol, argmax]
-        positive = P_max > 0
-        P_max = np.where(positive, P_max * 0.95 + 0.05, 0.0)
-
-        colors = 255 - colors[argmax.ravel()]
-
-        # XXX: Non linear intensity scaling
-        colors = colors * P_max.ravel().reshape(-1, 1)
-        colors = colors.reshape(P_max.shape + (3,))
-        colors = 255 - colors
-    elif P.ndim == 2:
-        palette = colorpalette.ColorPaletteBW()
-        mix = P
-        positive = mix > 0
-        mix = np.where(positive, mix * 0.99 + 0.01, 0.0)
-
-#         mix = scipy.ndimage.filters.gaussian_filter(
-#             mix, bandwidth, mode="constant")
-#         mix /= mix.max() if total else 1.0
-
-        colors = np.zeros((np.prod(mix.shape), 3)) + 255
-        colors = colors - mix.ravel().reshape(-1, 1) * 255
-        colors = colors.reshape(mix.shape + (3,))
-
-    return colors.astype(int)
-
-
-def score_candidate_rects(node, region):
-    """
-    Score candidate bin rects in node.
-
-    Return a list of (score, i, j QRectF) list)
-
-    """
-    xs, xe, ys, ye = bindices(node, region)
-
-    if node.contingencies.ndim == 3:
-        c = node.contingencies
-        # compute_chisqares expects classes in 1 dim
-        chi_lr, chi_up = compute_chi_squares(
-            c[xs: xe, ys: ye, :].swapaxes(1, 2).swapaxes(0, 1)
-        )
-
-        def max_chisq(i, j):
-            def valid(i, j):
-                return 0 <= i < chi_up.shape[0] and \
-                       0 <= j < chi_lr.shape[1]
-
-            return max(chi_lr[i, j] if valid(i, j) else 0,
-                       chi_lr[i, j - 1] if valid(i, j - 1) else 0,
-                       chi_up[i, j] if valid(i, j) else 0,
-                       chi_up[i - 1, j] if valid(i - 1, j) else 0)
-
-        return [(max_chisq(i - xs, j - ys), i, j,
-                 QRectF(QPointF(node.xbins[i], node.ybins[j]),
-                        QPointF(node.xbins[i + 1], node.ybins[j + 1])))
-                 for i, j in itertools.product(range(xs, xe), range(ys, ye))]
-    else:
-        return [(1, i, j,
-                 QRectF(QPointF(node.xbins[i], node.ybins[j]),
-                        QPointF(node.xbins[i + 1], node.ybins[j + 1])))
-                 for i, j in itertools.product(range(xs, xe), range(ys, ye))]
-
-
-def compute_chi_squares(observes):
-    """Compute chi2 scores of given observations.
-
-    Assumes that data is generated by two independent distributions,
-    one for rows and one for columns and estimate distribution parameters
-    from data.
-
-    Parameters
-    ----------
-    observes : numpy array with dimensions (N_CLASSES * N_ROWS * N_COLUMNS)
-        Multiple contingencies containing observations for multiple classes.
-    """
-    CLASSES, COLS, ROWS = 0, 1, 2
-
-    n = observes.sum((ROWS, COLS), keepdims=True)
-    row_sums = observes.sum(ROWS, keepdims=True)
-    col_sums = observes.sum(COLS, keepdims=True)
-    estimates = row_sums * col_sums / n
-
-    chi2 = np.nan_to_num(np.nansum((observes - estimates)**2 / estimates, axis=CLASSES))
-
-    # compute chi squares for left-right neighbours
-    chi2lr = chi2[:,:-1] + chi2[:,1:]
-    chi2ud = chi2[:-1,:] + chi2[1:,:]
-
-    return chi2lr, chi2ud
-
-
 def main(argv=None):
     import sip
     from AnyQt.QtWidgets import QApplication
@@ -1405,5 +1192,6 @@ def main(argv=None):
     app.processEvents()
     return rval
 
+
 if __name__ == "__main__":
     sys.exit(main())
@@ -1,15 +1,21 @@
+import os
+import tempfile
 from collections import OrderedDict
-from operator import itemgetter
 
 import numpy as np
 
 from PyQt4.QtCore import Qt, QTimer
 from PyQt4.QtGui import QApplication, QListView
 
-from Orange.data import Table
+from Orange.data import Table, Domain, ContinuousVariable
+from Orange.data.sql.backend.base import ToSql
+from Orange.data.sql.table import SqlTable
 from Orange.widgets import widget, gui, settings
+from Orange.widgets.utils.concurrent import ThreadExecutor, FutureWatcher
 from Orange.widgets.utils.itemmodels import VariableListModel
 
+from orangecontrib.prototypes.hashing import hash_rows
+
 
 class DnDListView(QListView):
     def __init__(self, callback, *args, **kwargs):
@@ -21,6 +27,180 @@ class DnDListView(QListView):
         QTimer.singleShot(1, self._callback)
 
 
+def column_codes(column):
+    """
+    Return integer codes of the values in the column and the number of
+    distinct values. Missing values (NaN) get the same code.
+    """
+    if column.dtype == object:
+        column = column.astype(str)
+    uniques, codes = np.unique(column, return_inverse=True)
+    return codes.reshape(-1), len(uniques)
+
+
+def group_sizes(order, starts, counts):
+    """Return the size of each row's group (see `group_rows`)."""
+    sizes = np.empty(len(order), dtype=np.int64)
+    sizes[order] = np.repeat(counts, counts)
+    return sizes
+
+
+def group_rows(columns):
+    """
+    Group the rows by the values in `columns`.
+
+    The columns' codes are combined into a single mixed-radix integer key,
+    which is compacted whenever it would overflow. Return a tuple with the
+    row indices sorted by the key (and by their order within groups), and
+    the start and size of each group in it.
+    """
+    key, radix = None, 1
+    for column in columns:
+        codes, n_values = column_codes(column)
+        if key is None:
+            key, radix = codes.astype(np.int64), n_values
+            continue
+        if radix * n_values >= 2 ** 62:
+            key, radix = column_codes(key)
+        key = key * n_values + codes
+        radix *= n_values
+    if key is None:
+        empty = np.empty(0, dtype=np.intp)
+        return empty, empty, empty
+    order = np.argsort(key, kind='stable')
+    starts = np.flatnonzero(np.diff(key[order], prepend=-1))
+    counts = np.diff(np.append(starts, len(key)))
+    return order, starts, counts
+
+
+def _bit_length(values):
+    """Return the number of bits of (uint64) values."""
+    lengths = np.zeros(len(values), dtype=np.int64)
+    for shift in (32, 16, 8, 4, 2, 1):
+        large = values >= np.uint64(1 << shift)
+        lengths[large] += shift
+        values = np.where(large, values >> np.uint64(shift), values)
+    return lengths + (values > 0)
+
+
+def estimate_distinct(hashes, p=14):
+    """
+    Estimate the number of distinct `hashes` (uint64) with a HyperLogLog
+    sketch with `2 ** p` registers (with a relative error of about
+    `1.04 / sqrt(2 ** p)`).
+    """
+    m = 1 << p
+    index = (hashes >> np.uint64(64 - p)).astype(np.intp)
+    rest = hashes & np.uint64((1 << (64 - p)) - 1)
+    registers = np.zeros(m, dtype=np.int64)
+    np.maximum.at(registers, index, 64 - p - _bit_length(rest) + 1)
+    estimate = 0.7213 / (1 + 1.079 / m) * m * m \
+        / np.sum(np.ldexp(1.0, -registers))
+    zeros = np.count_nonzero(registers == 0)
+    if estimate <= 2.5 * m and zeros:
+        # Linear counting is more accurate for small cardinalities
+        estimate = m * np.log(m / zeros)
+    return estimate
+
+
+def size_histogram(counts, edges=(1, 2, 3, 5, 10)):
+    """
+    Return a list of `(label, n_groups)` for groups with sizes between
+    the consecutive `edges` (the last bin is open).
+    """
+    hist, _ = np.histogram(counts, bins=list(edges) + [np.inf])
+    labels = [str(low) if high == low + 1
+              else '{}\u2013{}'.format(low, high - 1)
+              for low, high in zip(edges, edges[1:])] + \
+        ['{}+'.format(edges[-1])]
+    return list(zip(labels, hist))
+
+
+def unique_partitioned(columns, choose, n_partitions, chunk_size=2 ** 20):
+    """
+    Return the sorted indices of rows chosen from groups of equal values
+    in `columns` by the tiebreaker `choose` (see `OWUnique.TIEBREAKERS`)
+    and the sizes of their groups, using memory for about
+    `1 / n_partitions` of the rows.
+
+    Chunks of rows are distributed into `n_partitions` temporary files by
+    the hashes of their keys, so all rows of a group are in the same
+    partition, in their original order. Partitions are then grouped (with
+    `group_rows`) one at a time.
+    """
+    n_rows = len(columns[0])
+    selected = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        paths = [os.path.join(tmpdir, str(i)) for i in range(n_partitions)]
+        files = [open(path, 'wb') for path in paths]
+        try:
+            for start in range(0, n_rows, chunk_size):
+                stop = min(start + chunk_size, n_rows)
+                hashes = hash_rows([column[start:stop] for column in columns])
+                parts = (hashes >> np.uint64(32)) % np.uint64(n_partitions)
+                order = np.argsort(parts, kind='stable')
+                bounds = np.searchsorted(parts[order],
+                                         np.arange(n_partitions + 1))
+                rows = np.arange(start, stop, dtype=np.int64)[order]
+                for file, low, high in zip(files, bounds, bounds[1:]):
+                    rows[low:high].tofile(file)
+        finally:
+            for file in files:
+                file.close()
+        for path in paths:
+            rows = np.fromfile(path, dtype=np.int64)
+            if rows.size:
+                groups = group_rows([column[rows] for column in columns])
+                chosen = choose(*groups)
+                selected.append((rows[chosen], group_sizes(*groups)[chosen]))
+    if not selected:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    rows, sizes = map(np.concatenate, zip(*selected))
+    order = np.argsort(rows)
+    return rows[order], sizes[order]
+
+
+def unique_sql(data, key_vars, condition, order='', size_var=None):
+    """
+    Return a `SqlTable` with the rows of `data` chosen from groups with
+    equal `key_vars` in the database.
+
+    Rows are numbered within groups (in the database's order or by SQL
+    `order`) by a window query, and those satisfying the `condition` on
+    the row number `__unique_row` and the group size `__unique_size` are
+    kept (see `OWUnique.SQL_TIEBREAKERS`).
+
+    If `size_var` is given, it is added to metas with the group sizes.
+    """
+    keys = ', '.join(var.to_sql() for var in key_vars)
+    ranked = data._sql_query([
+        '*',
+        'ROW_NUMBER() OVER (PARTITION BY {}{}) AS __unique_row'.format(
+            keys, ' ORDER BY ' + order if order else ''),
+        'COUNT(*) OVER (PARTITION BY {}) AS __unique_size'.format(keys)])
+    table = data.copy()
+    table.table_name = \
+        '(SELECT * FROM ({}) AS ranked WHERE {}) AS unique_rows'.format(
+            ranked, condition)
+    table.row_filters = ()
+    if size_var is not None:
+        size_var.to_sql = ToSql('__unique_size')
+        domain = data.domain
+        table.domain = Domain(domain.attributes, domain.class_vars,
+                              domain.metas + (size_var, ))
+    return table
+
+
+def with_group_sizes(table, sizes, size_var):
+    """Return the table with `size_var` with group sizes added to metas."""
+    domain = table.domain
+    domain = Domain(domain.attributes, domain.class_vars,
+                    domain.metas + (size_var, ))
+    metas = np.hstack((table.metas, sizes.reshape(-1, 1)))
+    return Table.from_numpy(domain, table.X, table.Y, metas,
+                            table.W if table.has_weights() else None)
+
+
 class OWUnique(widget.OWWidget):
     name = 'Unique'
     icon = 'icons/Unique.svg'
@@ -33,18 +213,38 @@ class OWUnique(widget.OWWidget):
 
     settingsHandler = settings.DomainContextHandler()
 
-    TIEBREAKERS = OrderedDict([('last', itemgetter(-1)),
-                               ('first', itemgetter(0)),
-                               ('middle', lambda seq: seq[len(seq) // 2]),
-                               ('random', np.random.choice),
-                               ('none (discard all instances with non-unique keys)',
-                                lambda seq: seq[0] if len(seq) == 1 else None)])
+    # Each tiebreaker chooses the rows from groups given by `group_rows`
+    TIEBREAKERS = OrderedDict([
+        ('last', lambda order, starts, counts: order[starts + counts - 1]),
+        ('first', lambda order, starts, counts: order[starts]),
+        ('middle', lambda order, starts, counts: order[starts + counts // 2]),
+        ('random', lambda order, starts, counts:
+            order[starts + np.random.randint(counts)]),
+        ('none (discard all instances with non-unique keys)',
+         lambda order, starts, counts: order[starts[counts == 1]])])
+    # The same choices for `SqlTable`, as arguments of `unique_sql`
+    SQL_TIEBREAKERS = OrderedDict(zip(TIEBREAKERS, [
+        ('__unique_row = __unique_size', ),
+        ('__unique_row = 1', ),
+        ('__unique_row = __unique_size / 2 + 1', ),
+        ('__unique_row = 1', 'random()'),
+        ('__unique_size = 1', )]))
+
+    #: Larger tables are deduplicated in partitions of about this size
+    partition_rows = 2 ** 22
+    #: The size of the sample for the histogram of group sizes
+    preview_rows = 100000
 
     model_attrs = settings.ContextSetting(([], []))
     tiebreaker = settings.Setting(next(iter(TIEBREAKERS)))
+    add_group_size = settings.Setting(False)
     autocommit = settings.Setting(True)
 
     def __init__(self):
+        self._executor = ThreadExecutor(self)
+        #: The (future, watcher) of the running estimate of distinct keys
+        self._preview = None
+
         hbox = gui.hBox(self.controlArea)
         _properties = dict(alternatingRowColors=True,
                            defaultDropAction=Qt.MoveAction,
@@ -54,11 +254,11 @@ class OWUnique(widget.OWWidget):
                            selectionBehavior=QListView.SelectRows,
                            showDropIndicator=True,
                            acceptDrops=True)
-        listview_avail = DnDListView(lambda: self.commit(), self, **_properties)
+        listview_avail = DnDListView(self._keys_changed, self, **_properties)
         self.model_avail = model = VariableListModel(parent=self, enable_dnd=True)
         listview_avail.setModel(model)
 
-        listview_key = DnDListView(lambda: self.commit(), self, **_properties)
+        listview_key = DnDListView(self._keys_changed, self, **_properties)
         self.model_key = model = VariableListModel(parent=self, enable_dnd=True)
         listview_key.setModel(model)
 
@@ -67,11 +267,17 @@ class OWUnique(widget.OWWidget):
         box = gui.vBox(hbox, 'Group-By Key')
         box.layout().addWidget(listview_key)
 
+        box = gui.vBox(self.controlArea, 'Key Preview')
+        self.preview_label = gui.widgetLabel(box, '')
+
         gui.comboBox(self.controlArea, self, 'tiebreaker',
                      label='Which instance to select in each group:',
                      items=tuple(self.TIEBREAKERS.keys()),
                      callback=lambda: self.commit(),
                      sendSelectedValue=True)
+        gui.checkBox(self.controlArea, self, 'add_group_size',
+                     'Add group size column',
+                     callback=lambda: self.commit())
         gui.auto_commit(self.controlArea, self, 'autocommit', 'Commit',
                         orientation=Qt.Horizontal)
 
@@ -80,6 +286,7 @@ class OWUnique(widget.OWWidget):
         if data is None:
             self.model_avail.wrap([])
             self.model_key.wrap([])
+            self.update_preview()
             self.commit()
             return
 
@@ -89,24 +296,117 @@ class OWUnique(widget.OWWidget):
 
         self.model_avail.wrap(self.model_attrs[0])
         self.model_key.wrap(self.model_attrs[1])
+        self.update_preview()
         self.commit()
 
+    def _keys_changed(self):
+        self.update_preview()
+        self.commit()
+
+    def update_preview(self):
+        """
+        Show the number of distinct keys and the histogram of group sizes
+        in a sample of rows.
+
+        If the sample is smaller than the data, the number of distinct keys
+        is estimated (with HyperLogLog) from all rows in a background
+        thread.
+        """
+        if self._preview is not None:
+            # A running estimate is not interrupted, but its result is
+            # ignored
+            self._preview[0].cancel()
+            self._preview = None
+        data = self.data
+        if data is None or not len(self.model_key):
+            self.preview_label.setText('')
+            return
+        if isinstance(data, SqlTable):
+            self.preview_label.setText('No preview for SQL tables.')
+            return
+        columns = [data.get_column_view(attr)[0] for attr in self.model_key]
+        n_sample = min(len(data), self.preview_rows)
+        if n_sample < len(data):
+            sample = np.random.RandomState(0).choice(
+                len(data), n_sample, replace=False)
+            columns_sample = [column[sample] for column in columns]
+        else:
+            columns_sample = columns
+        _, _, counts = group_rows(columns_sample)
+        histogram = 'Group sizes in a sample of {:,} rows:\n{}'.format(
+            n_sample, ', '.join('{}: {:,}'.format(label, n)
+                                for label, n in size_histogram(counts)))
+        if n_sample == len(data):
+            self.preview_label.setText(
+                '{:,} distinct keys in {:,} rows\n{}'.format(
+                    len(counts), len(data), histogram))
+            return
+
+        self.preview_label.setText(
+            'Estimating distinct keys in {:,} rows\u2026\n{}'.format(
+                len(data), histogram))
+        future = self._executor.submit(
+            lambda: estimate_distinct(hash_rows(columns)))
+        watcher = FutureWatcher(future)
+        watcher.done.connect(
+            lambda future: self._on_preview_done(future, histogram))
+        self._preview = (future, watcher)
+
+    def _on_preview_done(self, future, histogram):
+        if self._preview is None or self._preview[0] is not future:
+            return
+        self._preview = None
+        try:
+            n_keys = '~{:,.0f}'.format(future.result())
+        except Exception:  # pylint: disable=broad-except
+            n_keys = '?'
+        self.preview_label.setText(
+            '{} distinct keys in {:,} rows\n{}'.format(
+                n_keys, len(self.data), histogram))
+
     def commit(self):
         if self.data is None:
             self.send('Unique Data', None)
             return
 
-        uniques = OrderedDict()
-        keys = zip(*[self.data.get_column_view(attr)[0]
-                     for attr in self.model_key])
-        for i, key in enumerate(keys):
-            uniques.setdefault(key, []).append(i)
+        key_vars = list(self.model_key)
+        if not key_vars:
+            self.send('Unique Data', None)
+            return
+        size_var = ContinuousVariable('Group size') \
+            if self.add_group_size else None
+        if isinstance(self.data, SqlTable):
+            self.send('Unique Data',
+                      unique_sql(self.data, key_vars,
+                                 *self.SQL_TIEBREAKERS[self.tiebreaker],
+                                 size_var=size_var))
+            return
 
+        columns = [self.data.get_column_view(attr)[0] for attr in key_vars]
         choose = self.TIEBREAKERS[self.tiebreaker]
-        selection = sorted([x for x in (choose(inds)
-                                        for inds in uniques.values())
-                            if x is not None])
-        self.send('Unique Data', self.data[selection] if selection else None)
+        if len(self.data) > self.partition_rows:
+            selection, sizes = unique_partitioned(
+                columns, choose, -(-len(self.data) // self.partition_rows))
+        else:
+            groups = group_rows(columns)
+            selection = choose(*groups)
+            sizes = group_sizes(*groups)[selection]
+            order = np.argsort(selection)
+            selection, sizes = selection[order], sizes[order]
+        if not len(selection):
+            self.send('Unique Data', None)
+            return
+        data = self.data[selection]
+        if size_var is not None:
+            data = with_group_sizes(data, sizes, size_var)
+        self.send('Unique Data', data)
+
+    def onDeleteWidget(self):
+        if self._preview is not None:
+            self._preview[0].cancel()
+            self._preview = None
+        self._executor.shutdown(wait=True)
+        super().onDeleteWidget()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,382 @@
+# Test methods with long descriptive names can omit docstrings
+# pylint: disable=missing-docstring
+import json
+import re
+import sqlite3
+import unittest
+from contextlib import contextmanager
+
+import numpy as np
+
+from Orange.data import Table, Domain, ContinuousVariable, DiscreteVariable
+from Orange.data.sql.table import SqlTable
+
+from orangecontrib.prototypes.density import (
+    SpatialIndex, grid_bin_indexed, grid_bin_sql, gaussian_smooth,
+    max_chi_squares, compute_chi_squares, DensityMap, density_image,
+    create_image, color_scale_func, Sqrt, columns_digest, Tree_raster,
+    Tree_sample
+)
+
+
+def brute_grid_bin(x, y, xbins, ybins, z=None, nvalues=0):
+    """Bin the points one by one (the grid bounds are inclusive)."""
+    nx, ny = xbins.size - 1, ybins.size - 1
+    shape = (nx, ny, nvalues) if z is not None else (nx, ny)
+    counts = np.zeros(shape)
+    for k, (xk, yk) in enumerate(zip(x, y)):
+        if not (xbins[0] <= xk <= xbins[-1] and ybins[0] <= yk <= ybins[-1]):
+            continue
+        i = min(np.flatnonzero(xbins <= xk)[-1], nx - 1)
+        j = min(np.flatnonzero(ybins <= yk)[-1], ny - 1)
+        if z is None:
+            counts[i, j] += 1
+        elif not np.isnan(z[k]):
+            counts[i, j, int(z[k])] += 1
+    return counts
+
+
+class SqliteBackend:
+    """
+    A stand-in for the PostgreSQL backend running the queries in SQLite.
+
+    The PostgreSQL specific casts are removed and `ARRAY[...]` and
+    `width_bucket` are emulated with user defined functions.
+    """
+    def __init__(self, connection):
+        self.connection = connection
+        self.connection.create_function(
+            "ARRAY", -1, lambda *values: json.dumps(values))
+        self.connection.create_function(
+            "width_bucket", 2,
+            lambda value, thresholds:
+            sum(t <= value for t in json.loads(thresholds)))
+        self.queries = []
+
+    @staticmethod
+    def create_sql_query(table_name, fields, filters=(), group_by=None,
+                         order_by=None, offset=None, limit=None,
+                         use_time_sample=None):
+        # pylint: disable=unused-argument
+        sql = ["SELECT", ", ".join(fields), "FROM", table_name]
+        if filters:
+            sql.extend(["WHERE", " AND ".join(filters)])
+        if group_by:
+            sql.extend(["GROUP BY", ", ".join(group_by)])
+        return " ".join(sql)
+
+    @contextmanager
+    def execute_sql_query(self, query):
+        self.queries.append(query)
+        query = re.sub(r"'([^']*)'::double precision", r"\1", query)
+        query = query.replace("::double precision[]", "") \
+                     .replace("::double precision", "")
+        query = re.sub(r"ARRAY\[([^\]]*)\]", r"ARRAY(\1)", query)
+        yield self.connection.execute(query)
+
+
+class SqliteTable:
+    """The parts of `SqlTable` used by `grid_bin_sql`."""
+    _sql_query = SqlTable._sql_query
+
+    def __init__(self, x, y, z=None, zvalues=()):
+        connection = sqlite3.connect(":memory:")
+        connection.execute("CREATE TABLE data (x REAL, y REAL, z TEXT)")
+        z = [None] * len(x) if z is None else \
+            [None if np.isnan(v) else zvalues[int(v)] for v in z]
+        connection.executemany(
+            "INSERT INTO data VALUES (?, ?, ?)",
+            [(None if np.isnan(a) else float(a),
+              None if np.isnan(b) else float(b), c)
+             for a, b, c in zip(x, y, z)])
+        self.table_name = "data"
+        self.row_filters = ()
+        self.backend = SqliteBackend(connection)
+
+
+def sql_variable(var, column):
+    var.to_sql = lambda: column
+    return var
+
+
+class TestSpatialIndex(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.x = rng.normal(size=2000)
+        self.y = rng.normal(size=2000)
+        self.x[::97] = np.nan
+        self.y[::89] = np.inf
+        # duplicated points on the query boundaries
+        self.x[1::50] = 0.5
+        self.y[2::50] = -0.25
+
+    def test_query(self):
+        index = SpatialIndex(self.x, self.y, leaf_size=16)
+        rng = np.random.RandomState(1)
+        rects = [(0.5, 1.5, -0.25, 2), (-np.inf, np.inf, -np.inf, np.inf),
+                 (3, 4, 3, 4), (0.5, 0.5, -0.25, -0.25)]
+        rects += [tuple(np.sort(rng.normal(size=2))) +
+                  tuple(np.sort(rng.normal(size=2))) for _ in range(20)]
+        for xmin, xmax, ymin, ymax in rects:
+            rows = np.sort(index.order[index.query(xmin, xmax, ymin, ymax)])
+            expected = np.flatnonzero(
+                (xmin <= self.x) & (self.x <= xmax) &
+                (ymin <= self.y) & (self.y <= ymax) & np.isfinite(self.y))
+            np.testing.assert_array_equal(rows, expected)
+
+    def test_empty(self):
+        index = SpatialIndex(np.array([np.nan]), np.array([1.]))
+        self.assertEqual(len(index), 0)
+        self.assertEqual(index.query(-np.inf, np.inf, -np.inf, np.inf).size,
+                         0)
+
+    def test_grid_bin_indexed(self):
+        index = SpatialIndex(self.x, self.y, leaf_size=16)
+        z = np.arange(self.x.size) % 3.
+        z[::7] = np.nan
+        for xbins, ybins in [
+                (np.linspace(-1, 0.5, 4), np.linspace(-0.25, 2, 6)),
+                (np.linspace(-5, 5, 11), np.linspace(-5, 5, 3))]:
+            node = grid_bin_indexed(index, xbins, ybins)
+            np.testing.assert_array_equal(
+                node.contingencies,
+                brute_grid_bin(self.x, self.y, xbins, ybins))
+            node = grid_bin_indexed(index, xbins, ybins, z, 3)
+            np.testing.assert_array_equal(
+                node.contingencies,
+                brute_grid_bin(self.x, self.y, xbins, ybins, z, 3))
+
+
+class TestGridBinSql(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.x = np.round(rng.normal(size=500), 1)
+        self.y = np.round(rng.normal(size=500), 1)
+        self.z = (np.arange(500) % 3).astype(float)
+        self.x[::31] = np.nan
+        self.z[::11] = np.nan
+        self.xvar = sql_variable(ContinuousVariable("x"), "x")
+        self.yvar = sql_variable(ContinuousVariable("y"), "y")
+        self.zvar = sql_variable(DiscreteVariable("z", values=("a", "b", "c")),
+                                 "z")
+
+    def test_counts(self):
+        data = SqliteTable(self.x, self.y)
+        # bin edges coincide with (rounded) data values
+        for xbins, ybins in [
+                (np.linspace(-1, 0.5, 4), np.linspace(-0.2, 2, 12)),
+                (np.array([-np.inf, 0, np.inf]),
+                 np.array([-np.inf, -0.5, 0.5, np.inf]))]:
+            node = grid_bin_sql(data, self.xvar, self.yvar, xbins, ybins)
+            np.testing.assert_array_equal(
+                node.contingencies,
+                brute_grid_bin(self.x, self.y, xbins, ybins))
+
+    def test_class_counts(self):
+        data = SqliteTable(self.x, self.y, self.z, self.zvar.values)
+        xbins, ybins = np.linspace(-1, 0.5, 4), np.linspace(-0.2, 2, 12)
+        node = grid_bin_sql(data, self.xvar, self.yvar, xbins, ybins,
+                            self.zvar)
+        np.testing.assert_array_equal(
+            node.contingencies,
+            brute_grid_bin(self.x, self.y, xbins, ybins, self.z, 3))
+
+    def test_query(self):
+        data = SqliteTable(self.x, self.y, self.z, self.zvar.values)
+        grid_bin_sql(data, self.xvar, self.yvar, np.array([-1., 0., 1.]),
+                     np.array([-np.inf, 0.5, np.inf]), self.zvar)
+        query, = data.backend.queries
+        self.assertIn("width_bucket((x)::double precision, "
+                      "ARRAY['0.0'::double precision]::double precision[])",
+                      query)
+        self.assertIn("(x)::double precision >= '-1.0'::double precision",
+                      query)
+        self.assertIn("(x)::double precision <= '1.0'::double precision",
+                      query)
+        # infinite bounds are not filtered
+        self.assertNotIn("(y)::double precision >=", query)
+        self.assertIn("y IS NOT NULL", query)
+        self.assertIn("z IS NOT NULL", query)
+        self.assertRegex(query, r"GROUP BY width_bucket.*, z$")
+
+
+class TestSmoothing(unittest.TestCase):
+    @staticmethod
+    def brute_smooth(ctng, sigma):
+        radius = int(np.ceil(3 * sigma))
+        offsets = np.arange(-radius, radius + 1)
+        weights = np.exp(-0.5 * (offsets / sigma) ** 2)
+        weights /= weights.sum()
+        N, M = ctng.shape[:2]
+        smoothed = np.zeros(ctng.shape)
+        for i in range(N):
+            for j in range(M):
+                for di, wi in zip(offsets, weights):
+                    for dj, wj in zip(offsets, weights):
+                        if 0 <= i - di < N and 0 <= j - dj < M:
+                            smoothed[i, j] += wi * wj * ctng[i - di, j - dj]
+        return smoothed
+
+    def test_gaussian_smooth(self):
+        rng = np.random.RandomState(0)
+        ctng = rng.poisson(2, size=(7, 9)).astype(float)
+        ctng[:2] = 0
+        for sigma in (0.5, 1, 2.5):
+            np.testing.assert_allclose(gaussian_smooth(ctng, sigma),
+                                       self.brute_smooth(ctng, sigma),
+                                       atol=1e-9)
+        np.testing.assert_array_equal(gaussian_smooth(ctng, 0), ctng)
+
+    def test_gaussian_smooth_classes(self):
+        rng = np.random.RandomState(0)
+        ctng = rng.poisson(2, size=(6, 5, 3)).astype(float)
+        smoothed = gaussian_smooth(ctng, 1)
+        self.assertEqual(smoothed.shape, ctng.shape)
+        for k in range(3):
+            np.testing.assert_allclose(smoothed[:, :, k],
+                                       self.brute_smooth(ctng[:, :, k], 1),
+                                       atol=1e-9)
+
+    def test_gaussian_smooth_empty_stays_empty(self):
+        ctng = np.zeros((20, 20))
+        ctng[0, 0] = 1000
+        smoothed = gaussian_smooth(ctng, 1)
+        self.assertTrue(np.all(smoothed[10:, 10:] == 0))
+        self.assertTrue(np.all(smoothed >= 0))
+
+
+class TestChiSquares(unittest.TestCase):
+    @staticmethod
+    def brute_chi2(ctng):
+        N, M, K = ctng.shape
+        chi2 = np.zeros((N, M))
+        for k in range(K):
+            n = ctng[:, :, k].sum()
+            if not n:
+                continue
+            for i in range(N):
+                for j in range(M):
+                    expected = ctng[i, :, k].sum() * ctng[:, j, k].sum() / n
+                    if expected:
+                        chi2[i, j] += \
+                            (ctng[i, j, k] - expected) ** 2 / expected
+        return chi2
+
+    def test_max_chi_squares(self):
+        rng = np.random.RandomState(0)
+        ctng = rng.poisson(3, size=(5, 6, 3)).astype(float)
+        ctng[:, :, 2] = 0
+        ctng[1, 2] = 0
+        chi2 = self.brute_chi2(ctng)
+        np.testing.assert_allclose(
+            compute_chi_squares(np.moveaxis(ctng, 2, 0))[0],
+            chi2[:, :-1] + chi2[:, 1:])
+
+        N, M = chi2.shape
+        n, m = N - 1, M - 1
+        expected = np.zeros((N, M))
+        for i in range(N):
+            for j in range(M):
+                pairs = []
+                # the right and the left neighbour
+                if i < n and j < m:
+                    pairs.append(chi2[i, j] + chi2[i, j + 1])
+                if i < n and 1 <= j <= m:
+                    pairs.append(chi2[i, j - 1] + chi2[i, j])
+                # the upper and the lower neighbour
+                if i < n and j < m:
+                    pairs.append(chi2[i, j] + chi2[i + 1, j])
+                if 1 <= i <= n and j < m:
+                    pairs.append(chi2[i - 1, j] + chi2[i, j])
+                expected[i, j] = max(pairs + [0])
+        np.testing.assert_allclose(max_chi_squares(ctng), expected)
+
+
+class TestDensityMap(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.x = rng.normal(size=3000)
+        self.y = rng.normal(size=3000) * 2 + self.x
+        self.z = (self.x > 0).astype(float)
+
+    def brute_raster(self, bins, z=None):
+        xbins = np.linspace(self.x.min(), self.x.max(), bins + 1)
+        ybins = np.linspace(self.y.min(), self.y.max(), bins + 1)
+        return brute_grid_bin(self.x, self.y, xbins, ybins, z,
+                              0 if z is None else 2)
+
+    def test_raster(self):
+        dmap = DensityMap(self.x, self.y, nbins=4)
+        np.testing.assert_array_equal(dmap.raster(), self.brute_raster(4))
+        dmap.refine(depth=2)
+        self.assertEqual(dmap.depth(), 2)
+        np.testing.assert_allclose(dmap.raster(), self.brute_raster(16))
+
+        dmap = DensityMap(self.x, self.y, self.z, 2, nbins=4)
+        dmap.refine(depth=2)
+        np.testing.assert_allclose(dmap.raster(),
+                                   self.brute_raster(16, self.z))
+
+    def test_query(self):
+        dmap = DensityMap(self.x, self.y, nbins=4)
+        rows = dmap.query((0, 1, 0.5, 2))
+        np.testing.assert_array_equal(
+            rows, np.flatnonzero((0 <= self.x) & (self.x <= 0.5) &
+                                 (1 <= self.y) & (self.y <= 3)))
+
+    def test_density_image(self):
+        for z, nvalues in ((None, None), (self.z, 2)):
+            image = density_image(self.x, self.y, z, nvalues, nbins=4,
+                                  depth=2, smoothing=1)
+            raster = gaussian_smooth(self.brute_raster(16, z), 1)
+            rgb = create_image(raster, None,
+                               scale=color_scale_func(Sqrt, raster.max()))
+            self.assertEqual(image.shape, (16, 16, 3))
+            self.assertEqual(image.dtype, np.uint8)
+            np.testing.assert_array_equal(image, rgb.swapaxes(0, 1)[::-1])
+
+    def test_tree_sample(self):
+        dmap = DensityMap(self.x, self.y, self.z, 2, nbins=4)
+        dmap.refine(depth=2)
+        dmap.refine((-1, -1, 0.5, 0.5), depth=3)
+        raster = Tree_raster(dmap.root, 3)
+        np.testing.assert_allclose(
+            Tree_sample(dmap.root, 64, (0, 64), (0, 64)), raster)
+        # coarser grids sum the bins
+        coarse = raster.reshape((16, 4, 16, 4, 2)).sum(axis=(1, 3))
+        np.testing.assert_allclose(
+            Tree_sample(dmap.root, 16, (0, 16), (0, 16)), coarse)
+        # windows extending outside the map are zero padded
+        window = Tree_sample(dmap.root, 16, (-3, 5), (10, 20))
+        np.testing.assert_allclose(window[3:, :6], coarse[:5, 10:])
+        self.assertFalse(window[:3].any() or window[:, 6:].any())
+        window = Tree_sample(dmap.root, 64, (30, 41), (7, 13))
+        np.testing.assert_allclose(window, raster[30:41, 7:13])
+
+    def test_pickle(self):
+        import pickle
+        dmap = DensityMap(self.x, self.y, self.z, 2, nbins=4)
+        dmap.refine((0, 0, 1, 1))
+        copy = pickle.loads(pickle.dumps(dmap))
+        np.testing.assert_array_equal(copy.raster(), dmap.raster())
+
+
+class TestColumnsDigest(unittest.TestCase):
+    def test_columns_digest(self):
+        a, b = ContinuousVariable("a"), ContinuousVariable("b")
+        X = np.arange(12.).reshape(6, 2)
+        data = Table.from_numpy(Domain([a, b]), X)
+        digest = columns_digest(data, [a, b])
+        self.assertEqual(digest, columns_digest(data.copy(), [a, b]))
+        self.assertNotEqual(digest, columns_digest(data, [b, a]))
+        self.assertNotEqual(digest, columns_digest(data[:5], [a, b]))
+        # the table may share (and lock) X, so change a copy
+        X = X.copy()
+        X[0, 0] = 42
+        self.assertNotEqual(
+            digest,
+            columns_digest(Table.from_numpy(Domain([a, b]), X), [a, b]))
+
+
+if __name__ == "__main__":
+    unittest.main()
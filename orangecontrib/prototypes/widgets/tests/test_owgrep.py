@@ -3,11 +3,16 @@
 # Tests test protected methods
 # pylint: disable=protected-access
 import os
+import re
+import tempfile
+import time
 import unittest
 from unittest.mock import Mock, patch
 
 import numpy as np
-from AnyQt.QtWidgets import QApplication
+from AnyQt.QtCore import Qt
+from AnyQt.QtGui import QFont
+from AnyQt.QtWidgets import QApplication, QStyleOptionViewItem
 
 from Orange.widgets.utils.filedialogs import RecentPath
 from Orange.widgets.tests.base import WidgetTest
@@ -109,7 +114,7 @@ class TestOWGrep(WidgetTest):
         self.assertFalse(widget.Warning.no_lines.is_shown())
 
     @patch_file_dlg("test_owgrep_file.txt")
-    @patch.object(owgrep.Table, "from_file")
+    @patch.object(owgrep.Table, "from_numpy", wraps=owgrep.Table.from_numpy)
     def test_unreadable(self, table_mock, _):
         widget = self.widget
         widget.pattern = "ef"
@@ -201,6 +206,18 @@ class TestOWGrep(WidgetTest):
         self.assertTrue(widget.Error.file_not_found.is_shown())
         self.assertCalledAgain(widget.grep_lines)
 
+    def test_open_file_preview(self):
+        widget = self.widget
+        widget.grep_lines = Mock()
+        widget.last_path = Mock(return_value=self.test_file)
+
+        widget.preview_size = 10
+        widget.open_file()
+        text = widget.in_view.toPlainText()
+        self.assertTrue(text.startswith("abc\ndef\n"))
+        self.assertNotIn("longer", text)
+        self.assertIn("showing the first 8 of", text)
+
     def _grep_and_check(self, expected):
         widget = self.widget
         widget.set_out_view = Mock()
@@ -291,6 +308,12 @@ class TestOWGrep(WidgetTest):
         widget.regular_expression = True
         self._grep_and_check(["a longer line", "another long line"])
 
+        # Matches must not span lines
+        widget.pattern = "line.*---"
+        self._grep_and_check([])
+        widget.pattern = "^a.*e$"
+        self._grep_and_check(["a longer line", "another long line"])
+
     def test_grep_lines_case_sensitive(self):
         widget = self.widget
         widget.current_file = self.test_file
@@ -314,6 +337,47 @@ class TestOWGrep(WidgetTest):
         widget.case_sensitive = True
         self._grep_and_check([])
 
+    def test_grep_lines_non_ascii(self):
+        text = "naïve café\nCAFÉ au lait\nx\xe9y a.b\nStraße\nabc\n"
+        buf = text.encode("utf-8") + b"caf\xc3 bad\n"
+        lines = buf.decode("utf-8", errors="surrogateescape").splitlines()
+        offsets = np.cumsum(
+            [0] + [len(line.encode("utf-8", errors="surrogateescape")) + 1
+                   for line in lines])
+        for pattern, case_sensitive, regular_expression in [
+                ("café", False, False), (r"caf.\b", True, True),
+                (r"^\w+$", True, True), ("x.y", True, True),
+                ("[ïß]", True, True), ("é", False, False),
+                (r"caf.?\sbad", True, True), ("a.b", True, False)]:
+            flags = re.MULTILINE | (0 if case_sensitive else re.IGNORECASE)
+            expected = re.compile(
+                pattern if regular_expression else re.escape(pattern),
+                flags)
+            expected = [offset for offset, line in zip(offsets, lines)
+                        if expected.search(line)]
+            compiled = owgrep.compile_pattern(
+                pattern, case_sensitive, regular_expression)
+            self.assertEqual(list(owgrep.match_index(buf, compiled)),
+                             expected, pattern)
+            with patch.object(owgrep.TextPattern, "min_chunk", 4), \
+                    patch.object(owgrep.TextPattern, "max_chunk", 16):
+                self.assertEqual(list(owgrep.match_index(buf, compiled)),
+                                 expected, pattern)
+
+    def test_grep_lines_crlf(self):
+        buf = b"x ab\r\nab c\r\n\r\na$b\r\nab\n"
+        offsets = [0, 6, 12, 14, 19]
+        for pattern, case_sensitive, regular_expression, expected in [
+                ("ab$", True, True, [0, 19]), ("AB$", False, True, [0, 19]),
+                ("^$", True, True, [12]), (r"^\w+ \w$", True, True, [6]),
+                (r"a\$b", True, True, [14]), ("[$]b$", True, True, [14]),
+                ("a$b", True, False, [14]), ("c", True, True, [6])]:
+            compiled = owgrep.compile_pattern(
+                pattern, case_sensitive, regular_expression)
+            matches = list(owgrep.match_index(buf, compiled))
+            self.assertEqual(matches, expected, pattern)
+            self.assertTrue(set(matches) <= set(offsets))
+
     def test_grep_lines_eof(self):
         widget = self.widget
         widget.current_file = self.test_file
@@ -342,33 +406,211 @@ class TestOWGrep(WidgetTest):
         self._grep_and_check(["def", "def"])
         self.assertFalse(widget.Warning.no_lines.is_shown())
 
+    def test_match_index(self):
+        pattern = owgrep.compile_pattern("ef")
+        with owgrep.MappedFile(self.test_file) as buf:
+            matches = owgrep.match_index(buf, pattern)
+            for size in (1, 10, 25):
+                offsets = owgrep.split_lines(buf, size)
+                np.testing.assert_equal(
+                    np.concatenate([
+                        owgrep.index_range(
+                            self.test_file, pattern, start, end)
+                        for start, end in zip(offsets, offsets[1:])]),
+                    matches)
+            for skip_lines, block_length in [(3, 2), (0, 3), (1, 12)]:
+                self.assertEqual(
+                    list(owgrep.iter_indexed_blocks(
+                        buf, matches, skip_lines, block_length)),
+                    list(owgrep.iter_blocks(
+                        buf, pattern, skip_lines, block_length)))
+
+    def test_cached_index(self):
+        widget = self.widget
+        widget.current_file = self.test_file
+        widget.pattern = "ef"
+        widget.skip_lines = 3
+        widget.block_length = 2
+        with patch.object(owgrep, "match_index",
+                          wraps=owgrep.match_index) as index:
+            widget.grep_lines()
+            self.assertCalledAgain(index)
+            self.assertEqual(widget.selected_lines,
+                             ["a b c", "1 2.123 blue", "d e f", "3.1 1 red"])
+
+            widget.block_length = 1
+            widget.grep_lines()
+            index.assert_not_called()
+            self.assertEqual(widget.selected_lines, ["a b c", "d e f"])
+
+            widget.pattern = "abc"
+            widget.grep_lines()
+            self.assertCalledAgain(index)
+
+            stat = os.stat(self.test_file)
+            os.utime(self.test_file,
+                     ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+            try:
+                widget.grep_lines()
+                self.assertCalledAgain(index)
+            finally:
+                os.utime(self.test_file,
+                         ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+    def test_grep_appended(self):
+        pattern = owgrep.compile_pattern("ef")
+        with owgrep.MappedFile(self.test_file) as buf:
+            ends = [i + 1 for i in range(len(buf)) if buf[i:i + 1] == b"\n"]
+            for skip_lines, block_length in [(3, 2), (0, 3), (1, 12)]:
+                expected = list(owgrep.grep_blocks(
+                    buf[:ends[-1]], pattern, skip_lines, block_length))
+                pos, cutoff, lines = 0, None, []
+                for end in ends:
+                    new, pos, cutoff = owgrep.grep_appended(
+                        buf, pattern, skip_lines, block_length,
+                        pos, cutoff, end)
+                    lines += new
+                self.assertEqual(lines, expected)
+
+    def test_follow(self):
+        widget = self.widget
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, "log.txt")
+            with open(filename, "w") as f:
+                f.write("a b\nref 1\n2 3\n4 ")
+            widget.pattern = "ref"
+            widget.skip_lines = 1
+            widget.block_length = 3
+            widget.has_header_row = False
+            widget.follow = True
+            widget.current_file = filename
+            widget.grep_lines()
+            self.assertTrue(widget._follow_timer.isActive())
+            self.assertEqual(widget.selected_lines, ["2 3"])
+
+            # Complete the line and the block, add another block
+            with open(filename, "a") as f:
+                f.write("5\n6 7\n8 9\nref 2\n10 11\n")
+            widget._poll_file()
+            self.assertEqual(widget.selected_lines,
+                             ["2 3", "4 5", "6 7", "10 11"])
+            table = self.get_output(widget.Outputs.data)
+            self.assertEqual(table.X.tolist(),
+                             [[2, 3], [4, 5], [6, 7], [10, 11]])
+
+            widget._poll_file()
+            self.assertEqual(len(widget.selected_lines), 4)
+
+            # A truncated file is searched again
+            with open(filename, "w") as f:
+                f.write("ref 3\n12 13\n")
+            widget._poll_file()
+            self.assertEqual(widget.selected_lines, ["12 13"])
+
+            widget.follow = False
+            widget.grep_lines()
+            self.assertFalse(widget._follow_timer.isActive())
+
+    def test_multiple_files(self):
+        widget = self.widget
+        widget.pattern = "ef"
+        widget.skip_lines = 3
+        widget.block_length = 2
+        widget.has_header_row = True
+        widget.multiple_files = True
+        widget.files_pattern = os.path.join(self.curdir, "test_owgrep_*.txt")
+        widget.grep_lines()
+        timeout = time.time() + 30
+        while widget._task is not None and time.time() < timeout:
+            QApplication.processEvents()
+        self.assertEqual(widget.selected_lines,
+                         ["a b c", "1 2.123 blue", "d e f", "3.1 1 red"])
+        table = self.get_output(widget.Outputs.data)
+        self.assertEqual([x.name for x in table.domain.variables],
+                         ["a", "b", "c"])
+        self.assertEqual(list(table.get_column_view("Source file")[0]),
+                         [self.test_base] * 2)
+
+        widget.files_pattern = os.path.join(self.curdir, "no_such_*.txt")
+        widget.grep_lines()
+        self.assertTrue(widget.Warning.no_files.is_shown())
+        self.assertIsNone(self.get_output(widget.Outputs.data))
+
+    def test_multiple_files_short_block(self):
+        widget = self.widget
+        widget.pattern = "#"
+        widget.skip_lines = 1
+        widget.block_length = 3
+        widget.has_header_row = True
+        widget.multiple_files = True
+        with tempfile.TemporaryDirectory() as tmpdir:
+            # The last block of the first file is cut short
+            for name, content in (("1.txt", "#\nx y\n1 2\n3 4\n#\nx y\n5 6\n"),
+                                  ("2.txt", "#\nx y\n7 8\n9 10\n")):
+                with open(os.path.join(tmpdir, name), "w") as f:
+                    f.write(content)
+            widget.files_pattern = os.path.join(tmpdir, "*.txt")
+            widget.grep_lines()
+            timeout = time.time() + 30
+            while widget._task is not None and time.time() < timeout:
+                QApplication.processEvents()
+        self.assertEqual(widget.selected_lines,
+                         ["x y", "1 2", "3 4", "x y", "5 6",
+                          "x y", "7 8", "9 10"])
+        self.assertEqual(widget.block_starts, [0, 3, 5])
+        table = self.get_output(widget.Outputs.data)
+        self.assertEqual([x.name for x in table.domain.variables], ["x", "y"])
+        np.testing.assert_equal(table.X, [[1, 2], [3, 4], [5, 6],
+                                          [7, 8], [9, 10]])
+        self.assertEqual(list(table.get_column_view("Source file")[0]),
+                         ["1.txt"] * 3 + ["2.txt"] * 2)
+        model = widget.out_view.model()
+        self.assertEqual(
+            [model.data(model.index(row), owgrep.HeaderRole)
+             for row in range(8)],
+            [1, None, None, 2, None, 2, None, None])
+
     def test_set_out_view(self):
         widget = self.widget
+        model = widget.out_view.model()
         widget.selected_lines = list("abcde")
-        text = "\n".join("abcde")
+
+        def shown(role):
+            return [model.index(i).data(role)
+                    for i in range(model.rowCount())]
 
         widget.has_header_row = False
         widget.block_length = 1
         widget.set_out_view()
-        self.assertEqual(widget.out_view.toPlainText(), text)
+        self.assertEqual(shown(Qt.DisplayRole), list("abcde"))
+        self.assertEqual(shown(owgrep.HeaderRole), [None] * 5)
 
         widget.has_header_row = True
         widget.block_length = 1
         widget.set_out_view()
-        self.assertEqual(widget.out_view.toPlainText(), text)
+        self.assertEqual(shown(Qt.DisplayRole), list("abcde"))
+        self.assertEqual(shown(owgrep.HeaderRole), [1, 2, 2, 2, 2])
 
         widget.has_header_row = False
         widget.block_length = 2
         widget.set_out_view()
-        self.assertEqual(widget.out_view.toPlainText(), text)
+        self.assertEqual(shown(Qt.DisplayRole), list("abcde"))
+        self.assertEqual(shown(owgrep.HeaderRole), [None] * 5)
 
         widget.has_header_row = True
-        widget.block_length = 1
+        widget.block_length = 2
         widget.set_out_view()
-        self.assertEqual(widget.out_view.toPlainText(), text)
+        self.assertEqual(shown(Qt.DisplayRole), list("abcde"))
+        self.assertEqual(shown(owgrep.HeaderRole), [1, None, 2, None, 2])
+
+        option = QStyleOptionViewItem()
+        widget.out_view.itemDelegate().initStyleOption(option, model.index(2))
+        self.assertGreater(option.font.weight(), QFont.Normal)
+        option = QStyleOptionViewItem()
+        widget.out_view.itemDelegate().initStyleOption(option, model.index(1))
+        self.assertEqual(option.font.weight(), QFont.Normal)
 
-    @patch("os.remove", wraps=os.remove)
-    def test_construct_table_with_header(self, remove_mock):
+    def test_construct_table_with_header(self):
         widget = self.widget
 
         widget.selected_lines = \
@@ -381,12 +623,16 @@ class TestOWGrep(WidgetTest):
             table.X, np.array([[1, 2.123, 0], [2.4, 1.1, 1], [3.1, 1, 1]]))
         self.assertEqual([x.name for x in table.domain.variables],
                          ["a", "b", "c"])
-        self.assertCalledAgain(remove_mock)
+        self.assertEqual(table.domain["c"].values, ("blue", "red"))
 
-        widget.selected_lines = ["1 2.123 blue", "2.4 1.1 red", "3.1 1 red"]
+        widget.selected_lines = ["1 2.123 5", "2.4 1.1 6", "3.1 1 7"]
+        widget.block_length = 3
+        table = widget._construct_table(True)
+        self.assertEqual([x.name for x in table.domain.variables],
+                         ["Feature 1", "Feature 2", "Feature 3"])
+        self.assertEqual(len(table), 3)
 
-    @patch("os.remove", wraps=os.remove)
-    def test_construct_table_without_header(self, remove_mock):
+    def test_construct_table_without_header(self):
         widget = self.widget
         widget.selected_lines = \
             ["1 2.123 blue", "2.4 1.1 red", "3.1 1 red",
@@ -401,7 +647,38 @@ class TestOWGrep(WidgetTest):
                 err_msg="at block length={}".format(widget.block_length))
             self.assertEqual([x.name for x in table.domain.variables],
                              ["var001", "var002", "var003"])
-            self.assertCalledAgain(remove_mock)
+
+    def test_construct_table_types(self):
+        widget = self.widget
+        widget.selected_lines = \
+            ["x y z w", "0 a 1.5 id1", "1   b ? id2", "", "1 a 2 id3",
+             "0 b 3 id4", "1 a 4 id5", "0 b 5 id6", "1 a 6 id7"]
+        widget.block_length = len(widget.selected_lines)
+        table = widget._construct_table(True)
+        domain = table.domain
+        self.assertTrue(domain["x"].is_discrete)
+        self.assertTrue(domain["y"].is_discrete)
+        self.assertTrue(domain["z"].is_continuous)
+        self.assertIn(domain["w"], domain.metas)
+        self.assertEqual(len(table), 7)
+        np.testing.assert_equal(table.get_column_view("z")[0],
+                                [1.5, np.nan, 2, 3, 4, 5, 6])
+
+    def test_header_toggle_reuses_tokens(self):
+        widget = self.widget
+        widget.selected_lines = \
+            ["a b c", "1 2.123 blue", "2.4 1.1 red", "d e f", "3.1 1 red"]
+        widget.block_length = 3
+        with patch.object(owgrep, "tokenize_lines",
+                          wraps=owgrep.tokenize_lines) as tokenize:
+            widget._construct_table(True)
+            widget._construct_table(False)
+            widget._construct_table(True)
+            self.assertEqual(tokenize.call_count, 1)
+
+            widget.selected_lines = widget.selected_lines[:3]
+            widget._construct_table(True)
+            self.assertEqual(tokenize.call_count, 2)
 
     def test_get_data_block_too_short(self):
         widget = self.widget
@@ -446,7 +723,7 @@ class TestOWGrep(WidgetTest):
 
         widget.has_header_row = True
         widget.block_length = 5
-        with patch.object(owgrep.Table, "from_file", side_effect=ValueError):
+        with patch.object(owgrep.Table, "from_numpy", side_effect=ValueError):
             self.assertIsNone(widget._get_data())
             self.assertTrue(widget.Error.unreadable.is_shown())
             self.assertFalse(widget.Warning.no_header_row.is_shown())
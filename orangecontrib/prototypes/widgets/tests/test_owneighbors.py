@@ -1,8 +1,14 @@
 # Test methods with long descriptive names can omit docstrings
 # pylint: disable=missing-docstring
+import os
+import tempfile
+from unittest.mock import patch
+
 import numpy as np
+from scipy.spatial.distance import cdist
 
-from Orange.data import Table
+from Orange.data import Table, Domain, StringVariable
+from orangecontrib.prototypes.neighbors import IVFIndex
 from orangecontrib.prototypes.widgets.owneighbors import OWNeighbors
 from Orange.widgets.tests.base import WidgetTest, ParameterMapping
 
@@ -98,6 +104,132 @@ class TestOWNeighbors(WidgetTest):
         self.assertIn("similarity", neighbors.domain)
         self.assertTrue(all(100 >= ins["similarity"] >= 0 for ins in neighbors))
 
+    def test_nearest_neighbors(self):
+        """Check neighbors against brute-force distances"""
+        self.widget.exclude_ref_check.setCheckState(False)
+        reference = self.iris[[0, 60, 120]]
+        self.send_signal("Data", self.iris)
+        self.send_signal("Reference", reference)
+        for index, metric in ((0, "euclidean"), (1, "cityblock"),
+                              (3, "cosine")):
+            self.widget.distance_combo.setCurrentIndex(index)
+            self.widget.distance_combo.activated[int].emit(index)
+            self.assertEqual(self.widget.distance_index, index)
+            self.widget.apply_button.button.click()
+            neighbors = self.get_output("Neighbors")
+            dist = cdist(self.iris.X, reference.X, metric).min(axis=1)
+            np.testing.assert_almost_equal(
+                cdist(neighbors.X, reference.X, metric).min(axis=1),
+                np.sort(dist)[:10])
+
+    def test_brute_force(self):
+        """Check that brute force and metric trees give equal neighbors"""
+        reference = self.iris[[0, 60, 120]]
+        self.send_signal("Data", self.iris)
+        self.send_signal("Reference", reference)
+        for per_reference in (False, True):
+            self.widget.per_reference = per_reference
+            self.widget.brute_force = False
+            self.widget.apply_button.button.click()
+            tree = self.get_output("Neighbors")
+            self.widget.brute_force = True
+            self.widget.memory_limit = 16
+            self.widget.apply_button.button.click()
+            self.assertEqual(self.widget.neighbor_index().method, "vectors")
+            np.testing.assert_array_equal(
+                tree.X, self.get_output("Neighbors").X)
+
+    def test_per_reference(self):
+        """Check neighbors of each reference row"""
+        self.widget.per_reference = True
+        reference = self.iris[[0, 60, 120]]
+        self.send_signal("Data", self.iris)
+        self.send_signal("Reference", reference)
+        self.widget.apply_button.button.click()
+        neighbors = self.get_output("Neighbors")
+        self.assertEqual(len(neighbors), 30)
+        ref_indices = neighbors.get_column_view("reference")[0]
+        np.testing.assert_array_equal(ref_indices, np.repeat([0, 1, 2], 10))
+        for i, inst in enumerate(reference):
+            self.assertNotIn(inst, neighbors)
+            own = neighbors[ref_indices == i]
+            dist = cdist(self.iris.X, reference.X[i:i + 1])[:, 0]
+            dist = dist[dist > 0]
+            np.testing.assert_almost_equal(
+                cdist(own.X, reference.X[i:i + 1])[:, 0],
+                np.sort(dist)[:10])
+
+    def test_approximate(self):
+        """Check approximate neighbors and the cached search index"""
+        self.widget.approximate = True
+        self.widget.n_probe = 1
+        reference = self.iris[:10]
+        self.send_signal("Data", self.iris)
+        self.send_signal("Reference", reference)
+        self.widget.apply_button.button.click()
+        neighbors = self.get_output("Neighbors")
+        self.assertEqual(len(neighbors), 10)
+        for inst in reference:
+            self.assertNotIn(inst, neighbors)
+        ivf = self.widget.neighbor_index().ivf
+        self.assertIsNotNone(ivf)
+        self.assertEqual(len(ivf.order), len(self.iris))
+
+        # with all lists searched the neighbors are exact
+        self.widget.n_probe = ivf.n_lists
+        self.widget.apply_button.button.click()
+        approximate = self.get_output("Neighbors")
+        self.widget.approximate = False
+        self.widget.apply_button.button.click()
+        np.testing.assert_array_equal(approximate.X,
+                                      self.get_output("Neighbors").X)
+
+        # the index is loaded from the cache for the same data
+        self.widget.approximate = True
+        self.send_signal("Data", self.iris.copy())
+        with patch.object(IVFIndex, "build", wraps=IVFIndex.build) as build:
+            self.widget.apply_button.button.click()
+            build.assert_not_called()
+        np.testing.assert_array_equal(
+            self.widget.neighbor_index().ivf.order, ivf.order)
+
+    def test_approximate_cache(self):
+        """Check the search index is cached for data with string metas"""
+        def with_names():
+            # equal tables whose string metas are distinct objects
+            names = np.array([str(i) for i in range(len(self.iris))],
+                             dtype=object).reshape(-1, 1)
+            domain = Domain(self.iris.domain.attributes,
+                            metas=[StringVariable("name")])
+            return Table.from_numpy(domain, self.iris.X, metas=names)
+
+        self.widget.approximate = True
+        with patch.object(IVFIndex, "build", wraps=IVFIndex.build) as build:
+            for _ in range(2):
+                data = with_names()
+                self.send_signal("Reference", data[:5])
+                self.send_signal("Data", data)
+                self.widget.apply_button.button.click()
+                self.assertIsNotNone(self.widget.neighbor_index().ivf)
+            self.assertLessEqual(build.call_count, 1)
+
+    def test_ivf_load(self):
+        X = np.random.RandomState(0).rand(100, 3)
+        ivf = IVFIndex.build(X, n_lists=4)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, "index.npz")
+            ivf.save(filename, ("key", (100, 3)))
+            loaded = IVFIndex.load(filename, ("key", (100, 3)), X.shape)
+            np.testing.assert_array_equal(loaded.order, ivf.order)
+            np.testing.assert_array_equal(loaded.centroids, ivf.centroids)
+            self.assertIsNone(IVFIndex.load(filename, ("other", (100, 3))))
+            self.assertIsNone(
+                IVFIndex.load(filename, ("key", (100, 3)), (99, 3)))
+            self.assertIsNone(
+                IVFIndex.load(filename, ("key", (100, 3)), (100, 4)))
+            self.assertIsNone(
+                IVFIndex.load(os.path.join(tmpdir, "no.npz"), "key"))
+
     def test_missing_values(self):
         data = Table("iris")
         reference = data[:3]
@@ -0,0 +1,226 @@
+# Test methods with long descriptive names can omit docstrings
+# pylint: disable=missing-docstring
+import unittest
+
+import numpy as np
+from scipy import sparse as sp
+
+from Orange.data import (
+    Table, Domain, ContinuousVariable, DiscreteVariable, StringVariable
+)
+from orangecontrib.prototypes.widgets.owreshape import (
+    reshape_long, reshape_wide, defined_entries, compact_codes
+)
+
+
+class TestDefinedEntries(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.X = rng.rand(50, 7) + 1
+        self.X[rng.rand(*self.X.shape) < 0.4] = np.nan
+
+    def expected(self, X, columns):
+        rows, cols = np.nonzero(~np.isnan(X[:, columns]))
+        return rows, cols, X[:, columns][rows, cols]
+
+    def assert_entries_equal(self, entries, expected):
+        for actual, desired in zip(entries, expected):
+            np.testing.assert_array_equal(actual, desired)
+
+    def test_chunks(self):
+        # chunks of one, of a few and of all rows
+        for columns in ([0, 2, 3, 6], [1, 2, 3], [4], []):
+            for chunk_size in (1, 3, 7, 10, 49, 10000):
+                self.assert_entries_equal(
+                    defined_entries(self.X, columns, chunk_size),
+                    self.expected(self.X, columns))
+
+    def test_empty(self):
+        rows, cols, values = defined_entries(self.X[:0], [0, 1], 3)
+        self.assertEqual((rows.size, cols.size, values.size), (0, 0, 0))
+
+    def test_sparse(self):
+        X = sp.csr_matrix(np.nan_to_num(self.X))
+        # an explicitly stored nan is not defined
+        X.data[0] = np.nan
+        dense = X.toarray()
+        dense[dense == 0] = np.nan
+        for columns in ([0, 2, 3, 6], [1, 2, 3]):
+            self.assert_entries_equal(defined_entries(X, columns),
+                                      self.expected(dense, columns))
+
+
+class TestCompactCodes(unittest.TestCase):
+    def test_dtypes(self):
+        for n_values, dtype in [(0, np.uint8), (1, np.uint8),
+                                (256, np.uint8), (257, np.uint16),
+                                (70000, np.uint32)]:
+            codes = compact_codes(np.array([0., n_values - 1]), n_values)
+            self.assertEqual(codes.dtype, dtype, n_values)
+        codes = compact_codes(np.array([0., 1.]), 2)
+        np.testing.assert_array_equal(codes, [0, 1])
+        # missing codes can not be stored in an integer type
+        codes = np.array([0., np.nan])
+        self.assertIs(compact_codes(codes, 2), codes)
+
+
+class TestReshapeLong(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        X = rng.rand(300, 4) + 1
+        X[rng.rand(*X.shape) < 0.3] = np.nan
+        self.name = StringVariable("name")
+        self.attributes = [ContinuousVariable(name) for name in "pqrs"]
+        self.metas = np.array([str(i) for i in range(len(X))],
+                              dtype=object).reshape(-1, 1)
+        self.X = X
+        self.item = DiscreteVariable("item", values=tuple("pqrs"))
+        self.value = ContinuousVariable("value")
+
+    def long(self, X, n_rows=None, sparse=False):
+        table = Table.from_numpy(
+            Domain(self.attributes, metas=[self.name]), X[:n_rows],
+            metas=self.metas[:n_rows])
+        return reshape_long(table, self.name, self.item, self.value,
+                            sparse=sparse)
+
+    def test_sparse_output(self):
+        for n_rows, dtype in [(200, np.uint8), (300, np.uint16)]:
+            dense = self.long(self.X, n_rows)
+            table = self.long(self.X, n_rows, sparse=True)
+            self.assertTrue(sp.issparse(table.X))
+            self.assertEqual(table.X.format, "csr")
+            self.assertEqual(table.X.dtype, dtype)
+            np.testing.assert_array_equal(table.X.toarray(), dense.X)
+            np.testing.assert_array_equal(table.Y, dense.Y)
+
+    def test_sparse_input(self):
+        dense = self.long(self.X)
+        X = sp.csr_matrix(np.nan_to_num(self.X))
+        for sparse in (False, True):
+            table = self.long(X, sparse=sparse)
+            self.assertEqual(sp.issparse(table.X), sparse)
+            np.testing.assert_array_equal(
+                table.X.toarray() if sparse else table.X, dense.X)
+            np.testing.assert_array_equal(table.Y, dense.Y)
+
+
+class TestReshapeWide(unittest.TestCase):
+    def setUp(self):
+        self.id = DiscreteVariable("id", values=("u", "v", "w"))
+        self.item = DiscreteVariable("item", values=("a", "b", "c", "d"))
+        self.value = ContinuousVariable("value")
+        # (id, item, value) with duplicate pairs (u, a), (v, c) and
+        # a missing id, item and value; item d is never used
+        rows = [[0, 0, 1], [0, 0, 2], [0, 1, 3], [1, 2, 4], [1, 2, 5],
+                [1, 2, 6], [2, 0, 7], [2, 1, np.nan], [np.nan, 1, 8],
+                [2, np.nan, 9], [0, 0, 4]]
+        self.long = Table.from_numpy(
+            Domain([self.id, self.item], [self.value]),
+            np.array(rows)[:, :2], np.array(rows)[:, 2])
+
+    def wide(self, aggregation, **kwargs):
+        table = reshape_wide(self.long, self.id, self.item, self.value,
+                             aggregation, **kwargs)
+        self.assertEqual([var.name for var in table.domain.attributes],
+                         ["a", "b", "c"])
+        self.assertEqual(table.domain.metas[0].values, ("u", "v", "w"))
+        np.testing.assert_equal(table.metas[:, 0], [0, 1, 2])
+        return table
+
+    def test_sum(self):
+        np.testing.assert_equal(
+            self.wide("sum").X,
+            [[7, 3, np.nan], [np.nan, np.nan, 15], [7, np.nan, np.nan]])
+
+    def test_mean(self):
+        np.testing.assert_equal(
+            self.wide("mean").X,
+            [[7 / 3, 3, np.nan], [np.nan, np.nan, 5], [7, np.nan, np.nan]])
+
+    def test_first(self):
+        np.testing.assert_equal(
+            self.wide("first").X,
+            [[1, 3, np.nan], [np.nan, np.nan, 4], [7, np.nan, np.nan]])
+
+    def test_count(self):
+        np.testing.assert_equal(
+            self.wide("count").X,
+            [[3, 1, np.nan], [np.nan, np.nan, 3], [1, np.nan, np.nan]])
+
+    def test_sparse_threshold(self):
+        # 4 of 9 cells are defined
+        self.assertFalse(sp.issparse(self.wide("sum").X))
+        table = self.wide("sum", sparse_threshold=0.5)
+        self.assertTrue(sp.issparse(table.X))
+        np.testing.assert_equal(
+            table.X.toarray(), [[7, 3, 0], [0, 0, 15], [7, 0, 0]])
+        table = self.wide("count", sparse_threshold=0.5)
+        np.testing.assert_equal(
+            table.X.toarray(), [[3, 1, 0], [0, 0, 3], [1, 0, 0]])
+
+    def test_csr_below_threshold(self):
+        def diagonal(n):
+            # n ids with a single (different) item each fill 1 / n cells
+            ids = DiscreteVariable("id", values=tuple(map(str, range(n))))
+            items = DiscreteVariable("item",
+                                     values=tuple(map(str, range(n))))
+            X = np.repeat(np.arange(n, dtype=float), 2).reshape(n, 2)
+            long = Table.from_numpy(Domain([ids, items], [self.value]),
+                                    X, np.arange(n) + 1.)
+            return reshape_wide(long, ids, items, self.value)
+
+        # 1 / 11 of the cells is below the default threshold of 10 %
+        table = diagonal(11)
+        self.assertTrue(sp.issparse(table.X))
+        self.assertEqual(table.X.format, "csr")
+        np.testing.assert_equal(table.X.toarray(), np.diag(np.arange(11) + 1))
+        table = diagonal(10)
+        self.assertFalse(sp.issparse(table.X))
+        expected = np.full((10, 10), np.nan)
+        np.fill_diagonal(expected, np.arange(10) + 1)
+        np.testing.assert_equal(table.X, expected)
+
+    def test_unknown_aggregation(self):
+        with self.assertRaises(ValueError):
+            reshape_wide(self.long, self.id, self.item, self.value, "max")
+        with self.assertRaises(ValueError):
+            reshape_wide(self.long, self.id, self.id, self.value)
+
+    def test_string_id(self):
+        name = StringVariable("name")
+        metas = np.array([["x"], ["y"], ["x"], [""]], dtype=object)
+        table = Table.from_numpy(
+            Domain([self.item, self.value], metas=[name]),
+            np.array([[0, 1], [1, 2], [0, 3], [1, 4]]), metas=metas)
+        wide = reshape_wide(table, name, self.item, self.value, "sum")
+        self.assertIsInstance(wide.domain.metas[0], StringVariable)
+        self.assertEqual(list(wide.metas[:, 0]), ["x", "y"])
+        np.testing.assert_equal(wide.X, [[4, np.nan], [np.nan, 2]])
+
+    def test_round_trip(self):
+        rng = np.random.RandomState(0)
+        X = rng.randint(0, 100, size=(20, 5)).astype(float)
+        X[rng.rand(*X.shape) < 0.3] = np.nan
+        X[0] = rng.rand(5)  # every column is defined somewhere
+        names = [str(i) for i in rng.permutation(20)]
+        attributes = [ContinuousVariable(name) for name in "pqrst"]
+        name = StringVariable("name")
+        table = Table.from_numpy(
+            Domain(attributes, metas=[name]), X,
+            metas=np.array(names, dtype=object).reshape(-1, 1))
+        item = DiscreteVariable("item", values=tuple("pqrst"))
+        value = ContinuousVariable("value")
+        for sparse in (False, True):
+            long = reshape_long(table, name, item, value, sparse=sparse)
+            idvar = long.domain.attributes[0]
+            wide = reshape_wide(long, idvar, item, value)
+            self.assertEqual([var.name for var in wide.domain.attributes],
+                             list("pqrst"))
+            ids = [idvar.values[int(i)] for i in wide.metas[:, 0]]
+            order = [names.index(id_) for id_ in ids]
+            np.testing.assert_equal(wide.X, X[order])
+
+
+if __name__ == "__main__":
+    unittest.main()
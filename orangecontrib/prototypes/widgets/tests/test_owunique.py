@@ -0,0 +1,359 @@
+# Test methods with long descriptive names can omit docstrings
+# pylint: disable=missing-docstring
+import copy
+import os
+import sqlite3
+import subprocess
+import sys
+import unittest
+from collections import OrderedDict
+
+import numpy as np
+
+from Orange.data import (
+    Table, Domain, ContinuousVariable, DiscreteVariable, StringVariable
+)
+from Orange.data.sql.backend.base import ToSql
+from Orange.data.sql.table import SqlTable
+from Orange.widgets.tests.base import WidgetTest
+from orangecontrib.prototypes.hashing import hash_rows
+from orangecontrib.prototypes.widgets.owunique import (
+    OWUnique, group_rows, group_sizes, unique_partitioned, unique_sql,
+    estimate_distinct, size_histogram
+)
+
+
+# The tiebreakers of the original (dict based) implementation
+REFERENCE_TIEBREAKERS = OrderedDict(zip(OWUnique.TIEBREAKERS, [
+    lambda seq: seq[-1],
+    lambda seq: seq[0],
+    lambda seq: seq[len(seq) // 2],
+    None,
+    lambda seq: seq[0] if len(seq) == 1 else None]))
+
+
+def reference_groups(columns):
+    """Group the row indices by keys in a dict (in the order of rows)."""
+    groups = OrderedDict()
+    for i, key in enumerate(zip(*columns)):
+        # Missing values are equal (nan != nan would make each a group)
+        key = tuple(None if isinstance(value, float) and np.isnan(value)
+                    else value for value in key)
+        groups.setdefault(key, []).append(i)
+    return list(groups.values())
+
+
+def reference_unique(columns, tiebreaker):
+    choose = REFERENCE_TIEBREAKERS[tiebreaker]
+    return sorted(row for row in map(choose, reference_groups(columns))
+                  if row is not None)
+
+
+def reference_group_ids(columns):
+    """Return the index of each row's group (see `reference_groups`)."""
+    ids = np.empty(len(columns[0]), dtype=int)
+    for i, group in enumerate(reference_groups(columns)):
+        ids[group] = i
+    return ids
+
+
+def key_columns(n_rows=300, seed=0):
+    rng = np.random.RandomState(seed)
+    number = rng.choice([0.0, -0.0, 1.5, 2, np.nan], n_rows)
+    code = rng.randint(3, size=n_rows).astype(float)
+    code[rng.rand(n_rows) < 0.1] = np.nan
+    text = rng.choice(["a", "b", "ab", "", "ä"], n_rows).astype(object)
+    return [number, code, text]
+
+
+class TestTiebreakers(unittest.TestCase):
+    def test_group_rows(self):
+        columns = key_columns()
+        for keys in (columns[:1], columns[1:], columns):
+            order, starts, counts = group_rows(keys)
+            groups = sorted(order[start:start + count].tolist()
+                            for start, count in zip(starts, counts))
+            self.assertEqual(groups, sorted(reference_groups(keys)))
+            sizes = group_sizes(order, starts, counts)
+            for group in groups:
+                np.testing.assert_equal(sizes[group], len(group))
+
+    def test_zero_and_missing(self):
+        order, starts, counts = group_rows(
+            [np.array([0.0, np.nan, -0.0, 1, np.nan])])
+        groups = sorted(order[start:start + count].tolist()
+                        for start, count in zip(starts, counts))
+        self.assertEqual(groups, [[0, 2], [1, 4], [3]])
+
+    def test_tiebreakers(self):
+        columns = key_columns()
+        for keys in (columns[:1], columns[1:], columns):
+            groups = group_rows(keys)
+            for name, choose in OWUnique.TIEBREAKERS.items():
+                chosen = np.sort(choose(*groups))
+                if name == "random":
+                    # One row of each group
+                    np.testing.assert_equal(
+                        np.sort(reference_group_ids(keys)[chosen]),
+                        np.arange(len(groups[1])))
+                else:
+                    self.assertEqual(chosen.tolist(),
+                                     reference_unique(keys, name), name)
+
+
+class TestPreview(unittest.TestCase):
+    def test_hash_rows(self):
+        columns = key_columns(10000)
+        hashes = hash_rows(columns)
+        ids = reference_group_ids(columns)
+        # equal keys have equal hashes and there are no collisions
+        self.assertEqual(len(np.unique(hashes)), ids.max() + 1)
+        self.assertEqual(len(np.unique(np.column_stack((hashes, ids)),
+                                       axis=0)), ids.max() + 1)
+        grid = np.indices((20, 20, 20)).reshape(3, -1).astype(float)
+        self.assertEqual(len(np.unique(hash_rows(list(grid)))), 8000)
+
+    def test_estimate_distinct(self):
+        rng = np.random.RandomState(0)
+        for n in (0, 1, 10, 1000, 30000, 200000):
+            values = rng.permutation(n).astype(float)
+            # duplicates do not change the estimate
+            values = np.concatenate((values, values[:n // 2]))
+            estimate = estimate_distinct(hash_rows([values]))
+            # three standard errors of a sketch with 2 ** 14 registers
+            self.assertLessEqual(abs(estimate - n), 3 * 0.0081 * n + 1e-9, n)
+        # equal keys (including nan, 0.0 and -0.0) have equal hashes;
+        # three standard errors of a sketch with 2 ** 10 registers
+        columns = key_columns(10000)
+        n = len(group_rows(columns)[1])
+        self.assertAlmostEqual(estimate_distinct(hash_rows(columns), p=10),
+                               n, delta=3 * 1.04 / np.sqrt(2 ** 10) * n)
+
+    def test_hash_strings(self):
+        strings = np.array(["", "a", "ab", "ba", "\u010d", "a" * 50, None,
+                            float("nan")], dtype=object)
+        hashes = hash_rows([strings])
+        self.assertEqual(len(np.unique(hashes)), len(strings))
+        # hashes do not depend on the other values or on the process
+        np.testing.assert_array_equal(hash_rows([strings[1:3]]), hashes[1:3])
+        script = "import numpy as np; " \
+            "from orangecontrib.prototypes.hashing import hash_rows; " \
+            "print(hash_rows([np.array(['ab', 'x'], dtype=object)]))"
+        outputs = {
+            subprocess.check_output(
+                [sys.executable, "-c", script],
+                env=dict(os.environ, PYTHONHASHSEED=seed,
+                         PYTHONPATH=os.pathsep.join(sys.path)))
+            for seed in ("0", "1")}
+        self.assertEqual(len(outputs), 1)
+        self.assertIn(str(hashes[2]).encode(), outputs.pop())
+
+    def test_size_histogram(self):
+        self.assertEqual(
+            size_histogram(np.array([1, 1, 2, 3, 4, 5, 9, 10, 50])),
+            [("1", 2), ("2", 1), ("3\u20134", 2), ("5\u20139", 2),
+             ("10+", 2)])
+        self.assertEqual(size_histogram(np.array([], dtype=int), (1, 3)),
+                         [("1\u20132", 0), ("3+", 0)])
+
+
+class TestUniquePartitioned(unittest.TestCase):
+    def test_unique_partitioned(self):
+        columns = key_columns(1000)
+        for keys in (columns[:1], columns):
+            groups = group_rows(keys)
+            for name, choose in OWUnique.TIEBREAKERS.items():
+                expected = np.sort(choose(*groups))
+                for n_partitions, chunk_size in ((1, 1000), (3, 17), (7, 1)):
+                    rows, sizes = unique_partitioned(
+                        keys, choose, n_partitions, chunk_size)
+                    if name == "random":
+                        # One row from each group
+                        np.testing.assert_equal(
+                            np.sort(reference_group_ids(keys)[rows]),
+                            np.arange(len(expected)))
+                    else:
+                        np.testing.assert_equal(rows, expected, name)
+                    np.testing.assert_equal(sizes, group_sizes(*groups)[rows])
+
+    def test_unique_partitioned_empty(self):
+        rows, sizes = unique_partitioned(
+            [np.empty(0)], OWUnique.TIEBREAKERS["first"], 3)
+        self.assertEqual(len(rows), 0)
+        self.assertEqual(len(sizes), 0)
+
+
+class SqliteBackend:
+    """A stand-in for a database backend running the queries in SQLite."""
+    @staticmethod
+    def create_sql_query(table_name, fields, filters=(), group_by=None,
+                         order_by=None, offset=None, limit=None,
+                         use_time_sample=None):
+        # pylint: disable=unused-argument
+        sql = ["SELECT", ", ".join(fields), "FROM", table_name]
+        if filters:
+            sql.extend(["WHERE", " AND ".join(filters)])
+        return " ".join(sql)
+
+
+class SqliteTable:
+    """The parts of `SqlTable` used by `unique_sql`."""
+    _sql_query = SqlTable._sql_query
+
+    def __init__(self, domain, rows):
+        self.domain = domain
+        for var in domain.variables:
+            var.to_sql = ToSql('"{}"'.format(var.name))
+        self.connection = sqlite3.connect(":memory:")
+        self.connection.execute("CREATE TABLE data ({})".format(
+            ", ".join('"{}"'.format(var.name) for var in domain.variables)))
+        self.connection.executemany(
+            "INSERT INTO data VALUES ({})".format(
+                ", ".join("?" * len(domain.variables))), rows)
+        self.table_name = "data"
+        self.row_filters = ()
+        self.backend = SqliteBackend()
+
+    def copy(self):
+        return copy.copy(self)
+
+    def fetch(self):
+        return self.connection.execute(
+            "SELECT * FROM {}".format(self.table_name)).fetchall()
+
+
+class TestUniqueSql(unittest.TestCase):
+    def setUp(self):
+        self.key = ContinuousVariable("key")
+        keys = [1, 2, 2, 3, 3, 3, None, None, 4]
+        self.data = SqliteTable(Domain([self.key, ContinuousVariable("i")]),
+                                [(key, i) for i, key in enumerate(keys)])
+        self.sizes = {1: 1, 2: 2, 3: 3, None: 2, 4: 1}
+
+    def test_query(self):
+        for name, args in OWUnique.SQL_TIEBREAKERS.items():
+            query = unique_sql(self.data, [self.key], *args).table_name
+            self.assertTrue(query.startswith("(SELECT * FROM (SELECT *, "))
+            self.assertIn(
+                'ROW_NUMBER() OVER (PARTITION BY "key"{}) AS __unique_row'
+                .format(" ORDER BY random()" if name == "random" else ""),
+                query)
+            self.assertIn(
+                'COUNT(*) OVER (PARTITION BY "key") AS __unique_size', query)
+            self.assertTrue(query.endswith(
+                " AS ranked WHERE {}) AS unique_rows".format(args[0])))
+        self.assertEqual(self.data.table_name, "data")
+
+        conditions = {
+            name: unique_sql(self.data, [self.key], *args).table_name
+            for name, args in OWUnique.SQL_TIEBREAKERS.items()}
+        for name, condition in (
+                ("last", "__unique_row = __unique_size"),
+                ("first", "__unique_row = 1"),
+                ("middle", "__unique_row = __unique_size / 2 + 1"),
+                ("random", "__unique_row = 1"),
+                ("none (discard all instances with non-unique keys)",
+                 "__unique_size = 1")):
+            self.assertIn("WHERE {})".format(condition), conditions[name])
+
+    def test_rows(self):
+        for name, args in OWUnique.SQL_TIEBREAKERS.items():
+            rows = unique_sql(self.data, [self.key], *args).fetch()
+            keys = [row[0] for row in rows]
+            if name.startswith("none"):
+                self.assertEqual(sorted(keys), [1, 4])
+            else:
+                self.assertEqual(len(keys), len(self.sizes))
+                self.assertEqual(set(keys), set(self.sizes))
+            for key, _, row_number, size in rows:
+                self.assertEqual(size, self.sizes[key])
+                if name in ("first", "random"):
+                    self.assertEqual(row_number, 1)
+                elif name == "last":
+                    self.assertEqual(row_number, size)
+                elif name == "middle":
+                    self.assertEqual(row_number, size // 2 + 1)
+
+    def test_size_var(self):
+        size_var = ContinuousVariable("Group size")
+        table = unique_sql(self.data, [self.key],
+                           *OWUnique.SQL_TIEBREAKERS["first"],
+                           size_var=size_var)
+        self.assertEqual(table.domain.metas, (size_var, ))
+        self.assertEqual(size_var.to_sql(), "__unique_size")
+        self.assertEqual(self.data.domain.metas, ())
+
+
+class TestOWUnique(WidgetTest):
+    def setUp(self):
+        self.widget = self.create_widget(OWUnique)
+        number, code, text = key_columns(100)
+        self.domain = Domain(
+            [ContinuousVariable("number"),
+             DiscreteVariable("code", values=("x", "y", "z"))],
+            metas=[StringVariable("text")])
+        self.data = Table.from_numpy(
+            self.domain, np.column_stack((number, code)),
+            metas=text.reshape(-1, 1))
+        self.variables = self.domain.variables + self.domain.metas
+        self.columns = [number, code, text]
+
+    def test_commit(self):
+        widget = self.widget
+        widget.set_data(self.data)
+        for keys in ([0], [2], [0, 1, 2]):
+            widget.model_key.wrap([self.variables[i] for i in keys])
+            for name in OWUnique.TIEBREAKERS:
+                if name == "random":
+                    continue
+                widget.tiebreaker = name
+                widget.commit()
+                rows = reference_unique([self.columns[i] for i in keys],
+                                        name)
+                output = self.get_output("Unique Data")
+                if not rows:
+                    self.assertIsNone(output)
+                    continue
+                np.testing.assert_equal(output.X, self.data.X[rows])
+                np.testing.assert_equal(output.metas, self.data.metas[rows])
+
+    def test_preview(self):
+        widget = self.widget
+        widget.set_data(self.data)
+        widget.model_key.wrap([self.domain["code"]])
+        widget.update_preview()
+        n_groups = len(reference_groups([self.columns[1]]))
+        self.assertIsNone(widget._preview)
+        self.assertTrue(widget.preview_label.text().startswith(
+            "{} distinct keys in 100 rows".format(n_groups)))
+
+        # The estimate for the whole data is computed in a thread
+        widget.preview_rows = 50
+        widget.update_preview()
+        self.assertIn("Estimating", widget.preview_label.text())
+        self.assertIn("sample of 50 rows", widget.preview_label.text())
+        self.process_events(lambda: widget._preview is None)
+        self.assertTrue(widget.preview_label.text().startswith(
+            "~{} distinct keys in 100 rows".format(n_groups)))
+
+        # Changing the keys ignores the running estimate
+        widget.update_preview()
+        future = widget._preview[0]
+        widget.model_key.wrap([])
+        widget.update_preview()
+        self.assertIsNone(widget._preview)
+        widget._on_preview_done(future, "")
+        self.assertEqual(widget.preview_label.text(), "")
+
+    def test_group_size(self):
+        widget = self.widget
+        widget.add_group_size = True
+        widget.set_data(self.data)
+        widget.model_key.wrap([self.domain["code"]])
+        widget.tiebreaker = "first"
+        widget.commit()
+        output = self.get_output("Unique Data")
+        groups = reference_groups([self.columns[1]])
+        np.testing.assert_equal(
+            output.get_column_view("Group size")[0],
+            [len(group) for group in sorted(groups)])